@@ -2,14 +2,20 @@ import json
 import os
 from dotenv import load_dotenv
 from langgraph.graph import StateGraph, END
-from typing import TypedDict, Annotated, List, Dict, Optional
+from typing import TypedDict, Annotated, List, Dict, Optional, Tuple
 import operator
 from src.agent_handler import ConversationHistoryManager
 from langchain_core.messages import AnyMessage, SystemMessage, HumanMessage, AIMessage, ChatMessage
 from langchain_google_genai import ChatGoogleGenerativeAI
 from src.RAG import VectorEmbeddings, DocumentType
+from src.model_router import ModelRouter
+from src.resilience import ResilientInvoker
+from src.inference_pool import InferenceExecutor
+from src.answer_cache import AnswerCache
+from src.profiling import traced
 import uuid
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 
 # Cargamos las variables de entorno y configuramos la memoria para la persistencia
@@ -22,6 +28,7 @@ class AgentState(TypedDict):
     tipo: str
     contenido: str
     consulta_RAG: str
+    subconsultas: List[str]
     plan: str
     contexto: str
     respuesta: str
@@ -29,15 +36,53 @@ class AgentState(TypedDict):
     num_revisiones: int
     max_revisiones: int
     thread_id: str
+    fragmentos: List[Dict]
+    presupuesto_latencia_ms: Optional[float]
+    presupuesto_coste: Optional[float]
+    decisiones_modelo: Annotated[List[Dict], operator.add]
     conversation_history: Optional[List[Dict[str,str]]]
+    # Búsqueda por similitud en la caché de respuestas tras el triaje (solo preguntas sin historial previo)
+    embedding_pregunta: Optional[List[float]]
+    version_corpus: Optional[str]
+    cache: Optional[Dict]
 
-model_thinking = ChatGoogleGenerativeAI(model="gemini-2.0-flash-thinking-exp-01-21", google_api_key=GOOGLE_API_KEY, temperature=0.3)
-model_flash = ChatGoogleGenerativeAI(model="gemini-2.0-flash-001", google_api_key=GOOGLE_API_KEY, temperature=0.3)
-model_lite = ChatGoogleGenerativeAI(model="gemini-2.0-flash-lite-preview-02-05", google_api_key=GOOGLE_API_KEY, temperature=0.3)
-model_pro = ChatGoogleGenerativeAI(model="gemini-2.0-pro-exp-02-05", google_api_key=GOOGLE_API_KEY, temperature=0.3)
+# Los reintentos los gestiona ResilientInvoker, por lo que cada modelo hace un único intento por llamada.
+# El timeout de petición (el plazo del nodo más largo) libera los hilos de las llamadas colgadas que el
+# invoker ya ha abandonado
+LLM_REQUEST_TIMEOUT_S = ResilientInvoker.request_timeout_s()
+model_thinking = ChatGoogleGenerativeAI(model="gemini-2.0-flash-thinking-exp-01-21", google_api_key=GOOGLE_API_KEY, temperature=0.3, max_retries=1, timeout=LLM_REQUEST_TIMEOUT_S)
+model_flash = ChatGoogleGenerativeAI(model="gemini-2.0-flash-001", google_api_key=GOOGLE_API_KEY, temperature=0.3, max_retries=1, timeout=LLM_REQUEST_TIMEOUT_S)
+model_lite = ChatGoogleGenerativeAI(model="gemini-2.0-flash-lite-preview-02-05", google_api_key=GOOGLE_API_KEY, temperature=0.3, max_retries=1, timeout=LLM_REQUEST_TIMEOUT_S)
+model_pro = ChatGoogleGenerativeAI(model="gemini-2.0-pro-exp-02-05", google_api_key=GOOGLE_API_KEY, temperature=0.3, max_retries=1, timeout=LLM_REQUEST_TIMEOUT_S)
+models = {"lite": model_lite, "flash": model_flash, "pro": model_pro, "thinking": model_thinking}
 
+# Plazos por nodo, reintentos con backoff, peticiones duplicadas y modelo de respaldo para cada llamada
+invoker = ResilientInvoker(models)
 
-rag = VectorEmbeddings(collection_name="normativa_tributaria-RAG")
+# El router elige el modelo de cada nodo por petición (temas, contexto, historial y presupuesto)
+router = ModelRouter(models, invoker=invoker)
+
+
+rag = VectorEmbeddings(collection_name="normativa_tributaria-RAG", cpu_precision=os.getenv("RAG_CPU_PRECISION", "fp32"))
+
+# Las consultas al RAG de todas las peticiones concurrentes pasan por un pool de inferencia con un número
+# fijo de workers y de hilos de torch por worker, para no saturar los núcleos con encode/predict simultáneos
+inference = InferenceExecutor(
+    workers=int(os.getenv("INFERENCE_WORKERS")) if os.getenv("INFERENCE_WORKERS") else None,
+    threads_per_worker=int(os.getenv("INFERENCE_THREADS")) if os.getenv("INFERENCE_THREADS") else None,
+    models=[rag.model, rag.reranker]
+)
+
+# Búsqueda jerárquica por bloques del BOE (ver src/block_index.py): RAG_HIERARCHICAL=1 para activarla
+RAG_HIERARCHICAL = os.getenv("RAG_HIERARCHICAL", "0") == "1"
+# Búsqueda híbrida densa + léxica (ver src/sparse.py): RAG_HYBRID=1 para activarla. Con la primera etapa
+# más precisa se re-rankean menos candidatos por consulta
+RAG_HYBRID = os.getenv("RAG_HYBRID", "0") == "1"
+RAG_N_RESULTS = int(os.getenv("RAG_N_RESULTS", "20" if RAG_HYBRID else "50"))
+
+# Respuestas completas para preguntas sin historial previo, ligadas a la versión del corpus.
+# src/cache_warmer.py la rellena con las preguntas más frecuentes del historial tras cada ingesta
+answer_cache = AnswerCache(similarity_threshold=float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.97")))
 
 
 
@@ -115,6 +160,17 @@ Devuelve tan solamente la respuesta reformulada.
 """
 
 
+# Instrucción que se añade al reformulador cuando la pregunta abarca varios temas del triaje
+MAX_SUBCONSULTAS = 3
+SUBCONSULTA_PREFIX = "SUBCONSULTA:"
+PROMPT_SUBCONSULTAS = f"""
+La pregunta abarca varios impuestos o Comunidades Autónomas ({{temas}}). Después de la consulta reformulada, añade
+hasta {MAX_SUBCONSULTAS} subconsultas breves, una por línea y empezando por "{SUBCONSULTA_PREFIX}", cada una centrada en uno de
+los aspectos que no cubra bien la consulta principal (por ejemplo, la normativa de una Comunidad Autónoma concreta).
+Si no son necesarias, no añadas ninguna.
+"""
+
+
 PROMPT_ESPECIALISTA = """Eres un asistente especialista en normativa tributaria de las agencias tributarias autonómicas de España. Debes tener en cuenta que vas a asistir a contribuyentes en preguntas sobres cuestiones referentes al
 ámbito fiscal en España. Para ello se te va proveer de un contexto. Debes seguir los siguientes pasos:
 1 - Analiza la consulta del contribuyente y comprende el contexto proporcionado.
@@ -157,6 +213,9 @@ def create_context_string(context):
             contexto += f"Documento de origen: {r['metadata']['título']}\n"
             contexto += f"Ámbito documento: {r['metadata']['ámbito']}\n"
             contexto += f"Fecha de carga del documento: {r['metadata']['processing_date']}\n"
+            if r.get('duplicates'):
+                titulos = list(dict.fromkeys(d['metadata'].get('título', '') for d in r['duplicates']))
+                contexto += f"Texto reproducido también en: {'; '.join(titulos)}\n"
             contexto += f"\nContenido:\n{r['document']}\n\n" 
         return contexto
     else:
@@ -166,9 +225,10 @@ def create_context_string(context):
 # Instanciamos el administrador de historial
 conversation_manager = ConversationHistoryManager()
 
+@traced("triage_agent")
 def triage_agent(state:AgentState):
     if state.get("thread_id"):
-        history = conversation_manager.get_conversation_history(state["thread_id"])
+        history = conversation_manager.get_conversation_history(state["thread_id"], include_payload=False)
         state["conversation_history"] = history
     
     system_prompt = PROMPT_TRIAGE
@@ -181,19 +241,20 @@ def triage_agent(state:AgentState):
         system_prompt += f"\n\nTen en cuenta el siguiente historial de conversación con el usuario:\n{history_str}"
 
     messages = [SystemMessage(content=system_prompt), HumanMessage(content=state["pregunta"])]
-    response = model_flash.invoke(messages)
+    response, decision = router.invoke("triage_agent", state, messages)
     try:
         contenido_json = response.content
         contenido_json = contenido_json.replace("```", "").replace("json\n", "")
         json_response = json.loads(contenido_json)
         tipo = json_response["tipo"]
         contenido = json_response["contenido"]
-        return {"tipo": tipo, "contenido": contenido}
-    except json.JSONDecodeError:
-        return {"tipo": "error", "contenido": "Error al procesar la respuesta"}
+        return {"tipo": tipo, "contenido": contenido, "conversation_history": state.get("conversation_history"), "decisiones_modelo": [decision]}
+    except (json.JSONDecodeError, KeyError, TypeError):
+        return {"tipo": "error", "contenido": "Error al procesar la respuesta", "conversation_history": state.get("conversation_history"), "decisiones_modelo": [decision]}
     
 
 
+@traced("reformulador")
 def reformulador(state: AgentState):
     system_prompt = PROMPT_RAG_REFORMULADOR
 
@@ -222,53 +283,173 @@ def reformulador(state: AgentState):
 
             system_prompt += f"\n\n {questions_context}"
 
+    temas = [t.strip() for t in (state.get("contenido") or "").split(";") if t.strip()]
+    if len(temas) >= 2:
+        system_prompt += PROMPT_SUBCONSULTAS.format(temas="; ".join(temas))
+
     messages = [SystemMessage(content=system_prompt), HumanMessage(content=current_question)]
-    response = model_flash.invoke(messages)
-    return {"consulta_RAG": response.content}
+    response, decision = router.invoke("reformulador", state, messages)
+    consulta, subconsultas = split_subqueries(response.content)
+    return {"consulta_RAG": consulta, "subconsultas": subconsultas, "decisiones_modelo": [decision]}
+
+
+def split_subqueries(text: str) -> Tuple[str, List[str]]:
+    """Separa la consulta reformulada de las subconsultas (líneas que empiezan por SUBCONSULTA:)."""
+    consulta, subconsultas = [], []
+    for line in text.splitlines():
+        stripped = line.strip().lstrip("-* ")
+        if stripped.upper().startswith(SUBCONSULTA_PREFIX):
+            subconsulta = stripped[len(SUBCONSULTA_PREFIX):].strip()
+            if subconsulta:
+                subconsultas.append(subconsulta)
+        else:
+            consulta.append(line)
+    return "\n".join(consulta).strip() or text.strip(), subconsultas[:MAX_SUBCONSULTAS]
     
 
-def specialist_node(state:AgentState):
+def get_document_types(contenido: str) -> List[DocumentType]:
+    """Convierte los temas devueltos por el agente de triaje en tipos de documento del RAG."""
     tipos_docs = []
-    for d in state["contenido"].split(";"):
+    for d in contenido.split(";"):
         tipo_doc = getattr(DocumentType, d.strip().upper())
         tipos_docs.append(tipo_doc)
+    return tipos_docs
+
+
+# Respuestas que se devuelven sin pasar por los modelos cuando no hay nada que generar
+RESPUESTA_SIN_CONTEXTO = ("Lo lamento mucho, no dispongo de información normativa suficiente para responder a esa cuestión. "
+                          "Le recomiendo que reformule la pregunta indicando el impuesto y la Comunidad Autónoma a la que se refiere, "
+                          "o que contacte con un especialista de la agencia tributaria.")
+RESPUESTA_ERROR_TRIAJE = ("Lamento no poder ser de utilidad, no he podido identificar el tipo de consulta. "
+                          "¿Podría reformular la pregunta indicando el impuesto y la Comunidad Autónoma a la que se refiere?")
+RESPUESTA_DERIVACION = ("Su solicitud se ha derivado al agente gestor. Para reservar cita con un especialista tributario o "
+                        "solicitar el aplazamiento o fraccionamiento de una deuda, un gestor se pondrá en contacto con usted.")
+
+# Respuestas del especialista que ya son definitivas y no necesitan pasar por el redactor
+RESPUESTA_NO_AUTORIZADO = "Lo lamento mucho, no estoy autorizado para responder a esa pregunta."
+RESPUESTA_ERROR_ESPECIALISTA = "Lo siento, ha ocurrido un error al procesar su consulta."
 
+
+def is_final_answer(respuesta: str) -> bool:
+    """Indica si la respuesta del especialista es una negativa o un error que no tiene sentido redactar."""
+    respuesta = respuesta.strip()
+    return respuesta.startswith(RESPUESTA_NO_AUTORIZADO) or respuesta == RESPUESTA_ERROR_ESPECIALISTA
+
+
+@traced("recuperador")
+def retrieval_node(state: AgentState):
+    """Recupera y rerankea los fragmentos de normativa para la consulta reformulada."""
     try:
-        result = rag.query_similar(query_text=state["consulta_RAG"], score=0.6, document_types=tipos_docs)
-        contexto = create_context_string(result)
-        messages = [
-            SystemMessage(content=PROMPT_ESPECIALISTA.format(contexto=contexto)), 
-            HumanMessage(content=state["pregunta"])
-        ]
-        response = model_lite.invoke(messages)
-        return {
-            "respuesta": response.content,
-            "contexto": contexto
-        }
+        tipos_docs = get_document_types(state["contenido"])
+        # La consulta principal y las subconsultas se buscan y re-rankean en una única pasada
+        consultas = [state["consulta_RAG"]] + (state.get("subconsultas") or [])
+        result = inference.run(rag.query_similar, query_text=consultas, score=0.6, document_types=tipos_docs,
+                               n_results=RAG_N_RESULTS, hierarchical=RAG_HIERARCHICAL, hybrid=RAG_HYBRID)
+        return {"fragmentos": result}
+    except Exception as e:
+        print(f"Error en retrieval_node: {str(e)}")
+        return {"fragmentos": []}
+
+
+def specialist_answer(state: AgentState, result: List[Dict]):
+    """Genera la respuesta del especialista a partir de los fragmentos ya recuperados por el RAG."""
+    contexto = create_context_string(result)
+    messages = [
+        SystemMessage(content=PROMPT_ESPECIALISTA.format(contexto=contexto)), 
+        HumanMessage(content=state["pregunta"])
+    ]
+    response, decision = router.invoke("especialista", {**state, "contexto": contexto}, messages)
+    respuesta = {
+        "respuesta": response.content,
+        "contexto": contexto,
+        "decisiones_modelo": [decision]
+    }
+    # Si la respuesta ya es definitiva se da por revisada y el grafo se salta el redactor
+    if is_final_answer(response.content):
+        respuesta["revision"] = response.content
+    return respuesta
+
+
+@traced("especialista")
+def specialist_node(state:AgentState):
+    try:
+        return specialist_answer(state, state["fragmentos"])
     except Exception as e:
         # Manejo de errores
         print(f"Error en specialist_node: {str(e)}")
         return {
-            "respuesta": "Lo siento, ha ocurrido un error al procesar su consulta.",
-            "contexto": "No se pudo obtener el contexto debido a un error."
+            "respuesta": RESPUESTA_ERROR_ESPECIALISTA,
+            "contexto": "No se pudo obtener el contexto debido a un error.",
+            "revision": RESPUESTA_ERROR_ESPECIALISTA
         }
 
+
+@traced("respuesta_plantilla")
+def template_answer_node(state: AgentState):
+    """Devuelve una respuesta predefinida sin llamar a ningún modelo."""
+    if state.get("tipo") == "derivación":
+        respuesta = RESPUESTA_DERIVACION
+    elif state.get("tipo") != "consulta":
+        respuesta = RESPUESTA_ERROR_TRIAJE
+    else:
+        respuesta = RESPUESTA_SIN_CONTEXTO
+    return {
+        "respuesta": respuesta,
+        "revision": respuesta,
+        "contexto": create_context_string([])
+    }
+
+
 def need_specialist(state: AgentState):
     if state.get("tipo") == "consulta":
         return "reformulador"
-    elif state.get("tipo") == "derivación":
-        return END
     else:
+        # Derivaciones y errores de triaje se responden con una plantilla
+        return "respuesta_plantilla"
+
+
+@traced("cache_semantica")
+def semantic_cache_node(state: AgentState):
+    """
+    Busca en la caché de respuestas una pregunta parecida ya respondida, ahora que se conocen los temas
+    del triaje: solo se sirve si coinciden los temas y las cifras de la pregunta.
+    """
+    if state.get("embedding_pregunta") is None:
+        return {}
+    entry = answer_cache.get(state["pregunta"], state["embedding_pregunta"], state["version_corpus"], contenido=state["contenido"])
+    if entry is None:
+        return {}
+    print(f"Answer cache semantic hit ({entry['source']}, similarity {entry['similarity']:.3f})")
+    cached = cached_result(state, entry)
+    return {key: cached[key] for key in ("consulta_RAG", "fragmentos", "contexto", "respuesta", "revision", "cache")}
+
+
+def is_cached(state: AgentState):
+    if state.get("revision"):
         return END
+    return "reformulador"
 
 
+def has_context(state: AgentState):
+    if state.get("fragmentos"):
+        return "especialista"
+    return "respuesta_plantilla"
+
+
+def need_redactor(state: AgentState):
+    if state.get("revision"):
+        return END
+    return "redactor"
+
+
+@traced("redactor")
 def redactor(state: AgentState):
     pregunta = state["pregunta"]
     respuesta = state["respuesta"]
     prompt_final = PROMPT_REDACTOR.format(pregunta=pregunta, respuesta=respuesta)
-    response = model_flash.invoke(prompt_final)
+    response, decision = router.invoke("redactor", state, prompt_final)
     
-    return {"revision": response.content}
+    return {"revision": response.content, "decisiones_modelo": [decision]}
     
 
 # Configuración del grafo
@@ -277,25 +458,43 @@ builder = StateGraph(AgentState)
 # Agregar nodos
 builder.add_node("triage_agent", triage_agent)
 builder.add_node("reformulador", reformulador)
+builder.add_node("recuperador", retrieval_node)
 builder.add_node("especialista", specialist_node)
 builder.add_node("redactor", redactor)
+builder.add_node("respuesta_plantilla", template_answer_node)
+builder.add_node("cache_semantica", semantic_cache_node)
 
 # Establecer el punto de entrada
 builder.set_entry_point("triage_agent")
 
-# Agregar arista condicional desde triage_agent
-builder.add_conditional_edges("triage_agent",need_specialist)
+# Agregar aristas condicionales: las rutas sin contexto o con error de triaje terminan con una plantilla
+# y las respuestas definitivas del especialista no pasan por el redactor
+# Las consultas pasan antes por la caché de respuestas, que ya puede comparar los temas del triaje
+builder.add_conditional_edges("triage_agent", need_specialist,
+                              {"reformulador": "cache_semantica", "respuesta_plantilla": "respuesta_plantilla"})
+builder.add_conditional_edges("cache_semantica", is_cached, ["reformulador", END])
+builder.add_conditional_edges("recuperador", has_context)
+builder.add_conditional_edges("especialista", need_redactor)
 
 # Agregar aristas no condicionales
-builder.add_edge("reformulador", "especialista")
-builder.add_edge("especialista", "redactor")
+builder.add_edge("reformulador", "recuperador")
 builder.add_edge("redactor", END)
+builder.add_edge("respuesta_plantilla", END)
 
 # Compilar el grafo
 graph = builder.compile()
 
 
-def run_conversation(question, thread_id=None):
+def run_conversation(question, thread_id=None, latency_budget_ms=None, cost_budget=None):
+    """
+    Ejecuta el grafo de agentes para una pregunta.
+
+    Args:
+        question: Pregunta del contribuyente
+        thread_id: Hilo de conversación (None crea un hilo nuevo)
+        latency_budget_ms: Presupuesto de latencia de los modelos para la petición completa
+        cost_budget: Presupuesto de coste relativo (ver ModelRouter.DEFAULT_COST) para la petición completa
+    """
     if not thread_id:
         thread_id = f"thread_{uuid.uuid4()}"
         print(f"Se ha creado nuevo hilo de conversación: {thread_id}")
@@ -306,23 +505,213 @@ def run_conversation(question, thread_id=None):
         "pregunta": question,
         "thread_id": thread_id,
         "num_revisiones": 0,
-        "max_revisiones": 2
+        "max_revisiones": 2,
+        "presupuesto_latencia_ms": latency_budget_ms,
+        "presupuesto_coste": cost_budget,
+        "decisiones_modelo": []
     }
+
+    # Las respuestas cacheadas solo valen para preguntas que no dependen de un historial previo. La misma
+    # pregunta se sirve antes del triaje; las parecidas, después (ver semantic_cache_node)
+    embedding, corpus_version = None, None
+    if not conversation_manager.get_conversation_history(thread_id, include_payload=False):
+        embedding = inference.run(rag.model.encode, [question])[0]
+        corpus_version = rag.corpus_version
+        cached = answer_cache.get(question, embedding, corpus_version)
+        if cached is not None:
+            print(f"Answer cache hit ({cached['source']})")
+            result = cached_result(initial_state, cached)
+            log_result(thread_id, question, result)
+            return result
+        initial_state["embedding_pregunta"] = embedding
+        initial_state["version_corpus"] = corpus_version
+
     result = graph.invoke(initial_state)
+    if embedding is not None and not result.get("cache") and is_cacheable(result):
+        answer_cache.put(question, embedding, corpus_version, result)
+
+    log_result(thread_id, question, result)
+    return result
+
 
+def is_cacheable(result: Dict) -> bool:
+    """Solo se cachean las consultas respondidas con contexto (no las plantillas, negativas ni errores)."""
+    return (result.get("tipo") == "consulta" and bool(result.get("fragmentos")) and bool(result.get("revision"))
+            and not is_final_answer(result.get("respuesta", "")))
+
+
+def cached_result(state: Dict, entry: Dict) -> Dict:
+    """Construye el resultado de una petición a partir de una respuesta de la caché."""
+    scores = {f["id"]: f["score"] for f in entry["fragmentos"]}
+    fragmentos = rag.get_chunks(list(scores))
+    for fragmento in fragmentos:
+        fragmento["rerank_score"] = scores.get(fragmento["id"])
+    return {
+        **state,
+        "tipo": entry["tipo"],
+        "contenido": entry["contenido"],
+        "consulta_RAG": entry["consulta_RAG"],
+        "fragmentos": fragmentos,
+        "contexto": create_context_string(fragmentos),
+        "respuesta": entry["respuesta"],
+        "revision": entry["revision"],
+        "cache": {"source": entry["source"], "similarity": entry["similarity"]}
+    }
+
+
+def log_result(thread_id: str, question: str, result: Dict):
+    """Registra en el historial el resultado final de una conversación."""
+    # Las rutas que terminan antes de tiempo (plantillas, derivaciones) no rellenan todos los campos
     conversation_manager.log_interaction(
         thread_id = thread_id,
         pregunta = question,
-        tipo = result["tipo"],
-        contenido=result["contenido"],
-        consulta_RAG=result["consulta_RAG"],
+        tipo = result.get("tipo", "error"),
+        contenido=result.get("contenido", ""),
+        consulta_RAG=result.get("consulta_RAG", ""),
         plan="",
-        contexto=result["contexto"],
-        respuesta=result["respuesta"],
-        revision=result["revision"]
+        contexto=result.get("contexto", ""),
+        respuesta=result.get("respuesta", ""),
+        revision=result.get("revision", ""),
+        # En lugar del contexto completo se guardan los ids de los fragmentos y su puntuación
+        fragmentos=[{"id": f["id"], "score": f.get("rerank_score")} for f in result.get("fragmentos") or []]
     )
-    return result
-    
 
 
+def rehydrate_context(interaction: Dict) -> str:
+    """Reconstruye el contexto de una interacción del historial a partir de los fragmentos guardados."""
+    if interaction.get("contexto"):
+        return interaction["contexto"]
+    fragmentos = interaction.get("fragmentos") or []
+    if not fragmentos:
+        return ""
+    scores = {f["id"]: f["score"] for f in fragmentos}
+    chunks = rag.get_chunks([f["id"] for f in fragmentos])
+    for chunk in chunks:
+        chunk["rerank_score"] = scores.get(chunk["id"])
+    return create_context_string(chunks)
+
+
+def _triage_and_reformulate(question: str, thread_id: str) -> Dict:
+    """Ejecuta el triaje y, si se trata de una consulta, la reformulación de una pregunta del lote."""
+    state = {
+        "pregunta": question,
+        "thread_id": thread_id,
+        "num_revisiones": 0,
+        "max_revisiones": 2,
+        "decisiones_modelo": []
+    }
+    _apply(state, triage_agent(state))
+    if need_specialist(state) == "reformulador":
+        _apply(state, reformulador(state))
+    return state
+
+
+def _apply(state: Dict, update: Dict) -> Dict:
+    """Aplica la salida de un nodo al estado fuera del grafo, acumulando las decisiones del router."""
+    decisions = update.pop("decisiones_modelo", [])
+    state.update(update)
+    state["decisiones_modelo"] = state.get("decisiones_modelo", []) + decisions
+    return state
+
+
+def _answer_and_review(state: Dict, result: List[Dict]) -> Dict:
+    """Ejecuta el especialista y, si hace falta, el redactor de una pregunta del lote con los fragmentos ya rerankeados."""
+    state["fragmentos"] = result
+    if has_context(state) == "respuesta_plantilla":
+        state.update(template_answer_node(state))
+        return state
+    _apply(state, specialist_node(state))
+    if need_redactor(state) == "redactor":
+        _apply(state, redactor(state))
+    return state
+
 
+def failed_result(question: str, thread_id: str, error: Exception) -> Dict:
+    """Resultado de una pregunta del lote cuyo procesamiento ha fallado; no se registra en el historial."""
+    print(f"Error processing question in {thread_id}: {type(error).__name__}: {error}")
+    return {"pregunta": question, "thread_id": thread_id, "tipo": "error", "error": f"{type(error).__name__}: {error}"}
+
+
+def run_conversations(questions: List[str], thread_ids: Optional[List[Optional[str]]] = None, max_concurrency: int = 8,
+                      log: bool = True):
+    """
+    Procesa un lote de preguntas compartiendo el trabajo de recuperación entre todas ellas.
+
+    El triaje y la reformulación se lanzan con concurrencia acotada, todas las consultas reformuladas
+    se resuelven con una única llamada a rag.query_similar_batch (un batch de embeddings y un rerank
+    conjunto) y el especialista y el redactor vuelven a ejecutarse en paralelo. Se siguen las mismas
+    rutas que en el grafo: sin contexto o con error de triaje se responde con una plantilla.
+
+    Args:
+        questions: Preguntas de los contribuyentes
+        thread_ids: Hilo de conversación de cada pregunta (None crea un hilo nuevo)
+        max_concurrency: Número máximo de preguntas con llamadas a los modelos en curso a la vez
+        log: Si se registran los resultados en el historial (el precalentamiento de la caché no lo hace)
+
+    Yields:
+        Tuplas (índice de la pregunta, resultado) conforme van terminando. Si una pregunta falla, su
+        resultado tiene tipo "error" y el mensaje en "error", y el resto del lote continúa
+    """
+    if thread_ids is None:
+        thread_ids = [None] * len(questions)
+    thread_ids = [thread_id or f"thread_{uuid.uuid4()}" for thread_id in thread_ids]
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        # 1. Triaje y reformulación con concurrencia acotada
+        futures = {executor.submit(_triage_and_reformulate, q, t): i for i, (q, t) in enumerate(zip(questions, thread_ids))}
+        states = [None] * len(questions)
+        for future in as_completed(futures):
+            i = futures[future]
+            # Un fallo de una pregunta (p.ej. InvocationTimeout) no interrumpe el resto del lote
+            try:
+                states[i] = future.result()
+            except Exception as e:
+                yield i, failed_result(questions[i], thread_ids[i], e)
+
+        # Las derivaciones y los errores de triaje se responden con una plantilla, igual que en el grafo
+        consultas = []
+        tipos_docs = []
+        for i, state in enumerate(states):
+            if state is None:
+                continue
+            try:
+                if need_specialist(state) == "reformulador":
+                    tipos_docs.append(get_document_types(state["contenido"]))
+                    consultas.append(i)
+                    continue
+            except AttributeError as e:
+                print(f"Error en retrieval_node: {str(e)}")
+                state["fragmentos"] = []
+            state.update(template_answer_node(state))
+            if log:
+                log_result(thread_ids[i], questions[i], state)
+            yield i, state
+
+        # 2. Recuperación y rerank compartidos por todas las consultas
+        try:
+            results = inference.run(
+                rag.query_similar_batch,
+                # Como en el grafo, cada pregunta se busca con la consulta principal y sus subconsultas
+                query_texts=[[states[i]["consulta_RAG"]] + (states[i].get("subconsultas") or []) for i in consultas],
+                score=0.6,
+                document_types=tipos_docs,
+                n_results=RAG_N_RESULTS,
+                hierarchical=RAG_HIERARCHICAL,
+                hybrid=RAG_HYBRID
+            )
+        except Exception as e:
+            print(f"Error querying similar documents: {str(e)}")
+            results = [[] for _ in consultas]
+
+        # 3. Especialista y redactor en paralelo, devolviendo cada resultado en cuanto termina
+        futures = {executor.submit(_answer_and_review, states[i], result): i for i, result in zip(consultas, results)}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                state = future.result()
+            except Exception as e:
+                yield i, failed_result(questions[i], thread_ids[i], e)
+                continue
+            if log:
+                log_result(thread_ids[i], questions[i], state)
+            yield i, state
@@ -1,12 +1,24 @@
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import FastAPI, HTTPException, Depends, Request, Response, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, PlainTextResponse
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from typing import List, Optional, Tuple, Dict, Any
 from datetime import datetime
+import asyncio
+import json
 import sqlite3
+import threading
+import time
 import uuid
 import os
-from agents import run_conversation
+import secrets
+from functools import partial
+from agents import run_conversation, run_conversations, router, invoker, inference, answer_cache, rag, conversation_manager, rehydrate_context
+from src.admission import AdmissionController, AdmissionRejected, PRIORITY_CONTINUING, PRIORITY_NEW
+from src.single_flight import SingleFlight, IdempotencyConflict
+from src.agent_handler import search_conversations
+from src.profiling import SamplingProfiler, PROFILES_DIR, save_profile, start_trace, stop_trace
 
 # Inicialización de la aplicación FastAPI
 app = FastAPI(title="Rubén Rubio AI Assistant API")
@@ -23,6 +35,60 @@ app.add_middleware(
 # Configuración de la base de datos
 DB_PATH = "./data/sqlite/conversation_history.db"
 
+# Capa de admisión: concurrencia acotada, cola con prioridad, límite por cliente y rechazo rápido
+admission = AdmissionController(
+    max_concurrency=int(os.getenv("ADMISSION_MAX_CONCURRENCY", "4")),
+    max_queue=int(os.getenv("ADMISSION_MAX_QUEUE", "64")),
+    slo_wait_s=float(os.getenv("ADMISSION_SLO_WAIT_S", "20")),
+    rate_per_minute=float(os.getenv("ADMISSION_RATE_PER_MINUTE", "30")),
+)
+
+# Deduplicación de peticiones idénticas en curso y respuesta inmediata a los reintentos recientes
+single_flight = SingleFlight(ttl_s=float(os.getenv("SINGLE_FLIGHT_TTL_S", "120")))
+
+# Perfilado bajo demanda: solo disponible si se define ADMIN_TOKEN y se envía en la cabecera X-Admin-Token
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+MAX_PROFILE_SECONDS = 120
+profiler = SamplingProfiler(interval=float(os.getenv("PROFILER_INTERVAL_S", "0.005")))
+
+def is_admin(http_request: Request) -> bool:
+    token = http_request.headers.get("X-Admin-Token")
+    return bool(ADMIN_TOKEN) and token is not None and secrets.compare_digest(token, ADMIN_TOKEN)
+
+def require_admin(http_request: Request):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not is_admin(http_request):
+        raise HTTPException(status_code=403, detail="Token de administración no válido")
+
+# Proxies inversos cuya cabecera X-Forwarded-For es de confianza (direcciones separadas por comas)
+TRUSTED_PROXIES = {host.strip() for host in os.getenv("TRUSTED_PROXIES", "").split(",") if host.strip()}
+
+def client_identity(http_request: Request) -> str:
+    """
+    Identidad del cliente para el límite de peticiones: la dirección de la conexión, no una cabecera que
+    el cliente pueda elegir libremente. Detrás de un proxy de confianza se usa la última dirección de
+    X-Forwarded-For que no es de un proxy.
+    """
+    peer = http_request.client.host if http_request.client else "anónimo"
+    if peer in TRUSTED_PROXIES:
+        forwarded = [host.strip() for host in http_request.headers.get("X-Forwarded-For", "").split(",") if host.strip()]
+        for host in reversed(forwarded):
+            if host not in TRUSTED_PROXIES:
+                return host
+    return peer
+
+def traced_call(fn, *args, **kwargs):
+    """Ejecuta fn con una traza activa y guarda la traza en formato folded. Devuelve el resultado y el fichero."""
+    token = start_trace(fn.__name__)
+    try:
+        result = fn(*args, **kwargs)
+    finally:
+        trace = stop_trace(token)
+        name = save_profile(trace.folded(), "trace", fn.__name__)
+        print(f"Trace {name}: {trace.elapsed * 1000:.0f} ms, {len(trace.totals)} stages")
+    return result, name
+
 # Definición de modelos Pydantic
 class Message(BaseModel):
     thread_id: str
@@ -33,10 +99,49 @@ class Message(BaseModel):
 class ResponseRequest(BaseModel):
     thread_id: Optional[str]
     message: str
+    latency_budget_ms: Optional[float] = None
+    cost_budget: Optional[float] = None
 
 class AIResponse(BaseModel):
     response: Any
 
+class BatchRequest(BaseModel):
+    items: List[ResponseRequest]
+    max_concurrency: int = 8
+
+class BatchJob(BaseModel):
+    job_id: str
+    status: str
+    total: int
+    completed: int
+    failed: int = 0
+    error: Optional[str] = None
+    results: List[Dict[str, Any]]
+
+# Trabajos de consultas en lote en memoria: job_id -> estado y resultados conforme van terminando.
+# Los trabajos terminados se eliminan pasado BATCH_JOB_TTL_S y como mucho se guardan MAX_FINISHED_BATCH_JOBS
+batch_jobs: Dict[str, Dict[str, Any]] = {}
+BATCH_JOB_TTL_S = float(os.getenv("BATCH_JOB_TTL_S", "3600"))
+MAX_FINISHED_BATCH_JOBS = int(os.getenv("MAX_FINISHED_BATCH_JOBS", "100"))
+# Límites del servidor para los lotes: preguntas por lote, concurrencia de cada lote y lotes en curso a la vez
+MAX_BATCH_ITEMS = int(os.getenv("MAX_BATCH_ITEMS", "200"))
+MAX_BATCH_CONCURRENCY = int(os.getenv("MAX_BATCH_CONCURRENCY", "8"))
+MAX_RUNNING_BATCH_JOBS = int(os.getenv("MAX_RUNNING_BATCH_JOBS", "2"))
+
+def evict_batch_jobs():
+    """Elimina los trabajos terminados caducados y, si sobran, los terminados más antiguos."""
+    now = time.monotonic()
+    finished = sorted((job["finished_at"], job_id) for job_id, job in list(batch_jobs.items()) if job.get("finished_at") is not None)
+    expired = [job_id for finished_at, job_id in finished if now - finished_at > BATCH_JOB_TTL_S]
+    remaining = [job_id for finished_at, job_id in finished if now - finished_at <= BATCH_JOB_TTL_S]
+    for job_id in expired + remaining[:max(0, len(remaining) - MAX_FINISHED_BATCH_JOBS)]:
+        batch_jobs.pop(job_id, None)
+
+def batch_job_response(job_id: str, job: Dict[str, Any], offset: int = 0) -> BatchJob:
+    results = job["results"]
+    return BatchJob(job_id=job_id, status=job["status"], total=job["total"], completed=len(results),
+                    failed=job["failed"], error=job.get("error"), results=results[offset:])
+
 # Función para asegurar que la base de datos existe
 def init_db():
     if not os.path.exists(DB_PATH):
@@ -68,9 +173,40 @@ def get_db():
 def read_root():
     return {"message": "Bienvenido a la API del Asistente de Rubén Rubio"}
 
+# Se declara antes de /conversations/{thread_id} para que "search" no se interprete como un thread_id
+@app.get("/conversations/search")
+def search_conversation_history(q: str, limit: int = 20, offset: int = 0, thread_id: Optional[str] = None, match_all: bool = False):
+    """
+    Búsqueda de texto completo en las preguntas, consultas y respuestas del historial, ordenada por relevancia.
+    Devuelve una página de resultados con fragmentos resaltados y si hay más páginas.
+    """
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="La búsqueda no puede estar vacía")
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        page = search_conversations(conn, q, limit=min(max(limit, 1), 100), offset=max(offset, 0),
+                                    thread_id=thread_id, match_all=match_all)
+        return {"query": q, "offset": offset, **page}
+    except sqlite3.OperationalError as e:
+        raise HTTPException(status_code=500, detail=f"Error en la búsqueda: {str(e)}")
+    finally:
+        conn.close()
+
 @app.get("/conversations/{thread_id}", response_model=List[dict])
-def get_conversation(thread_id: str):
-    """Obtiene el historial de una conversación específica."""
+def get_conversation(thread_id: str, include_context: bool = False):
+    """
+    Obtiene el historial de una conversación específica.
+    Con include_context=true cada interacción incluye también el contexto normativo con el que se respondió,
+    reconstruido desde el almacén vectorial a partir de los fragmentos guardados.
+    """
+    if include_context:
+        try:
+            history = conversation_manager.get_conversation_history(thread_id)
+            return [{"pregunta": interaction["pregunta"], "revision": interaction["revision"], "timestamp": interaction["timestamp"],
+                     "fragmentos": interaction["fragmentos"], "contexto": rehydrate_context(interaction)}
+                    for interaction in history]
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Error al obtener la conversación: {str(e)}")
     conn = sqlite3.connect(DB_PATH)
     conn.row_factory = sqlite3.Row
     try:
@@ -114,17 +250,208 @@ def get_recent_conversations():
         conn.close()
 
 @app.post("/generate-response", response_model=AIResponse)
-async def generate_ai_response(request: ResponseRequest):
+async def generate_ai_response(request: ResponseRequest, http_request: Request, response: Response):
     """
     Genera una respuesta usando un sistema de agentes.
+    La petición pasa antes por la capa de admisión, que puede responder 429 o 503 con cabecera Retry-After.
+    Las peticiones duplicadas (misma cabecera Idempotency-Key o mismo thread_id y mensaje) no vuelven a ejecutar
+    la conversación: esperan a la que está en curso o reciben su resultado durante unos minutos; la cabecera
+    X-Single-Flight indica si la respuesta se ha calculado (leader), compartido (coalesced) o reutilizado (replayed).
+    Con las cabeceras X-Trace: 1 y X-Admin-Token se traza la petición completa; el nombre de la traza
+    se devuelve en la cabecera X-Trace-Id y se descarga en /admin/profiles/{nombre}.
     """
-    try:
-        result = run_conversation(request.message, thread_id=request.thread_id)
+    client_id = client_identity(http_request)
+    priority = PRIORITY_CONTINUING if request.thread_id else PRIORITY_NEW
+    trace = http_request.headers.get("X-Trace") == "1" and is_admin(http_request)
+
+    async def generate() -> str:
+        async with admission.slot(client_id, priority):
+            conversation = partial(traced_call, run_conversation) if trace else run_conversation
+            result = await run_in_threadpool(
+                conversation,
+                request.message,
+                thread_id=request.thread_id,
+                latency_budget_ms=request.latency_budget_ms,
+                cost_budget=request.cost_budget
+            )
+        if trace:
+            result, trace_name = result
+            response.headers["X-Trace-Id"] = trace_name
         # Extract just the revision field or another specific field you want to return
-        return AIResponse(response=result["revision"])
+        return result["revision"]
+
+    try:
+        if trace:
+            # Una petición trazada siempre ejecuta la conversación
+            revision = await generate()
+        else:
+            # Los duplicados (reintentos, dobles clics) esperan a la petición en curso o reciben su resultado
+            key = single_flight.key(client_id, request.thread_id, request.message, http_request.headers.get("Idempotency-Key"))
+            fingerprint = single_flight.fingerprint(request.thread_id, request.message, request.latency_budget_ms, request.cost_budget)
+            revision, outcome = await single_flight.run(key, fingerprint, generate)
+            response.headers["X-Single-Flight"] = outcome
+        return AIResponse(response=revision)
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail, headers={"Retry-After": str(e.retry_after)})
+    except IdempotencyConflict as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al generar respuesta: {str(e)}")
 
+def run_batch_job(job_id: str, request: BatchRequest):
+    """
+    Ejecuta un lote de preguntas en segundo plano y va guardando los resultados en el trabajo.
+    Las preguntas que fallan se guardan con su error; un fallo del lote completo conserva los resultados ya terminados.
+    """
+    job = batch_jobs[job_id]
+    try:
+        questions = [item.message for item in request.items]
+        thread_ids = [item.thread_id for item in request.items]
+        for index, result in run_conversations(questions, thread_ids=thread_ids, max_concurrency=request.max_concurrency):
+            entry = {
+                "index": index,
+                "thread_id": result["thread_id"],
+                "response": result.get("revision") or result.get("contenido")
+            }
+            if result.get("error"):
+                entry["error"] = result["error"]
+                job["failed"] += 1
+            job["results"].append(entry)
+        job["status"] = "completed"
+    except Exception as e:
+        job["status"] = "failed"
+        job["error"] = str(e)
+    finally:
+        job["finished_at"] = time.monotonic()
+
+@app.post("/generate-response/batch", response_model=BatchJob)
+async def generate_batch_response(request: BatchRequest, http_request: Request):
+    """
+    Lanza un lote de preguntas que comparten la recuperación y el rerank.
+    Devuelve un job_id con el que consultar el progreso o recibir los resultados en streaming.
+    Cada envío cuenta para el límite de peticiones del cliente (429). El lote puede tener como mucho
+    MAX_BATCH_ITEMS preguntas, su concurrencia se limita a MAX_BATCH_CONCURRENCY y, si ya hay
+    MAX_RUNNING_BATCH_JOBS lotes en curso, se responde 503 con cabecera Retry-After.
+    """
+    if not request.items:
+        raise HTTPException(status_code=400, detail="El lote no tiene preguntas")
+    if len(request.items) > MAX_BATCH_ITEMS:
+        raise HTTPException(status_code=413, detail=f"El lote tiene {len(request.items)} preguntas; el máximo es {MAX_BATCH_ITEMS}")
+    try:
+        admission.check_rate_limit(client_identity(http_request))
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail, headers={"Retry-After": str(e.retry_after)})
+    evict_batch_jobs()
+    if sum(1 for job in batch_jobs.values() if job["status"] == "running") >= MAX_RUNNING_BATCH_JOBS:
+        raise HTTPException(status_code=503, detail="Hay demasiados lotes en curso, inténtelo de nuevo más tarde",
+                            headers={"Retry-After": str(max(1, round(admission.service_time_s)))})
+    request.max_concurrency = max(1, min(request.max_concurrency, MAX_BATCH_CONCURRENCY))
+    job_id = str(uuid.uuid4())
+    batch_jobs[job_id] = {"status": "running", "total": len(request.items), "failed": 0, "results": [], "finished_at": None}
+    threading.Thread(target=run_batch_job, args=(job_id, request), daemon=True).start()
+    return batch_job_response(job_id, batch_jobs[job_id])
+
+@app.get("/generate-response/batch/{job_id}", response_model=BatchJob)
+def get_batch_response(job_id: str, offset: int = 0):
+    """
+    Devuelve el estado de un lote y los resultados terminados a partir de la posición offset.
+    Si el lote ha fallado, status es "failed" con el error y se devuelven igualmente los resultados terminados.
+    """
+    evict_batch_jobs()
+    job = batch_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    return batch_job_response(job_id, job, offset)
+
+@app.get("/generate-response/batch/{job_id}/stream")
+async def stream_batch_response(job_id: str):
+    """Devuelve los resultados de un lote en formato NDJSON conforme van terminando."""
+    job = batch_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+
+    async def result_stream():
+        sent = 0
+        while True:
+            results = job["results"]
+            while sent < len(results):
+                yield json.dumps(results[sent], ensure_ascii=False) + "\n"
+                sent += 1
+            if job["status"] != "running" and sent >= len(job["results"]):
+                break
+            await asyncio.sleep(0.2)
+
+    return StreamingResponse(result_stream(), media_type="application/x-ndjson")
+
+@app.get("/metrics/model-router")
+def get_model_router_metrics():
+    """Devuelve las decisiones acumuladas del router de modelos y la latencia estimada de cada nivel."""
+    return router.summary()
+
+@app.get("/metrics/admission")
+def get_admission_metrics():
+    """Devuelve la profundidad de la cola, los tiempos de espera y los rechazos de la capa de admisión."""
+    return admission.metrics()
+
+@app.get("/metrics/single-flight")
+def get_single_flight_metrics():
+    """Devuelve las peticiones calculadas, compartidas con otra en curso y respondidas con un resultado reciente."""
+    return single_flight.metrics()
+
+@app.get("/metrics/llm-resilience")
+def get_llm_resilience_metrics():
+    """Devuelve las tasas de peticiones duplicadas, respaldo, reintentos y plazos agotados de las llamadas a Gemini."""
+    return invoker.summary()
+
+@app.get("/metrics/inference")
+def get_inference_metrics():
+    """Devuelve la configuración del pool de inferencia local, las llamadas en espera y en curso y sus tiempos."""
+    return inference.summary()
+
+@app.get("/metrics/answer-cache")
+def get_answer_cache_metrics():
+    """Aciertos de la caché de respuestas y entradas disponibles para la versión actual del corpus."""
+    return answer_cache.summary(rag.corpus_version)
+
+@app.get("/corpus/version")
+def get_corpus_version():
+    """Versión del corpus en uso: colección lógica, colección física a la que apunta y versión de su contenido."""
+    corpus_version = rag.corpus_version
+    with rag.snapshot() as stores:
+        return {"alias": rag.alias.alias, "collection": stores.name, "corpus_version": corpus_version, "chunks": stores.collection.count()}
+
+@app.post("/admin/profile", dependencies=[Depends(require_admin)])
+async def capture_profile(seconds: float = 10.0, include_idle: bool = False):
+    """
+    Captura un perfil de muestreo de todos los hilos durante seconds segundos y lo devuelve en formato
+    folded (flamegraph.pl, speedscope). También se guarda en el directorio de perfiles.
+    """
+    if not 0 < seconds <= MAX_PROFILE_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds debe estar entre 0 y {MAX_PROFILE_SECONDS}")
+    try:
+        folded = await run_in_threadpool(profiler.run, seconds, include_idle)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    name = save_profile(folded, "cpu")
+    return PlainTextResponse(folded, headers={"X-Profile-Id": name})
+
+@app.get("/admin/profiles", dependencies=[Depends(require_admin)])
+def list_profiles():
+    """Lista los perfiles y trazas guardados, del más reciente al más antiguo."""
+    if not os.path.isdir(PROFILES_DIR):
+        return []
+    names = [name for name in os.listdir(PROFILES_DIR) if name.endswith(".folded")]
+    return sorted(names, key=lambda name: os.path.getmtime(os.path.join(PROFILES_DIR, name)), reverse=True)
+
+@app.get("/admin/profiles/{name}", dependencies=[Depends(require_admin)])
+def get_profile(name: str):
+    """Devuelve un perfil o traza guardado en formato folded."""
+    path = os.path.join(PROFILES_DIR, os.path.basename(name))
+    if not name.endswith(".folded") or not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail="Perfil no encontrado")
+    with open(path, encoding="utf-8") as f:
+        return PlainTextResponse(f.read())
+
 # Inicializar la base de datos al arrancar
 @app.on_event("startup")
 def startup_db_client():
@@ -1,15 +1,31 @@
 import chromadb
-from sentence_transformers import SentenceTransformer, CrossEncoder
 from langchain.text_splitter import MarkdownHeaderTextSplitter, RecursiveCharacterTextSplitter
 from docling.document_converter import DocumentConverter
-from typing import List, Dict, Union
+from typing import List, Dict, NamedTuple, Optional, Union, Iterable, Iterator, Tuple
+from itertools import islice
+from contextlib import contextmanager
 import uuid
 from enum import Enum
 from datetime import datetime
 import os
+import shutil
+import threading
+import time
 import torch
+import numpy as np
 import re
 from huggingface_hub import login, snapshot_download
+from src.vector_store import MemmapCollection
+from src.embedding_cache import EmbeddingCache
+from src.reranking import RerankEngine
+from src.artifact import write_artifact, read_artifact, iter_artifact, iter_artifact_links
+from src.cpu_inference import load_embedder, load_reranker
+from src.citations import CitationIndex
+from src.dedup import NearDuplicateIndex
+from src.block_index import BlockIndex
+from src.sparse import SparseEncoder, SparseIndex, reciprocal_rank_fusion
+from src.profiling import span, traced
+from src.collection_versions import CollectionAlias, VERSION_SEPARATOR, copy_collection, version_name
 
 class DocumentType(Enum):
     GENERAL = "Normativa general aplicable"
@@ -36,25 +52,424 @@ class DocumentType(Enum):
     PAIS_VASCO = "Comunidad Autónoma del País Vasco"
     
 
+EMBEDDING_MODEL_ID = "littlejohn-ai/bge-m3-spa-law-qa"
+RERANKER_MODEL_ID = "BAAI/bge-reranker-v2-m3"
+
+# Marca de inicio de cada bloque (artículo, disposición, ...) en los textos consolidados del BOE
+BLOCK_PATTERN = re.compile(r'\[Bloque \d+: #[^\]]+\]')
+
+
+def hnsw_metadata(hnsw_params: Dict = None) -> Dict:
+    """Metadata de creación de una colección de Chroma con los parámetros HNSW indicados."""
+    metadata = {"hnsw:space": "cosine"}
+    for key, value in (hnsw_params or {}).items():
+        if key not in ("construction_ef", "M", "search_ef"):
+            raise ValueError(f"Parámetro HNSW no soportado: {key}")
+        metadata[f"hnsw:{key}"] = value
+    return metadata
+
+
+def batched(iterable: Iterable, size: int) -> Iterator[List]:
+    """Agrupa los elementos de un iterable en listas de como mucho size elementos."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+class CollectionStores(NamedTuple):
+    """
+    Colección física y sus índices auxiliares. Es inmutable: al cambiar de versión se sustituye la
+    referencia entera, de modo que cada consulta usa todos los almacenes de una misma versión.
+    """
+    name: str
+    collection: object
+    #Un vector por bloque del BOE (media de sus chunks) para la búsqueda jerárquica (ver src/block_index.py)
+    block_index: BlockIndex
+    sparse_index: Optional[SparseIndex]
+    #Índice de citas (norma, artículo) -> chunks, para responder a citas concretas sin búsqueda vectorial
+    citations: CitationIndex
+    #Índice MinHash de chunks casi duplicados (boilerplate del BOE, artículos reproducidos entre normas)
+    dedup: Optional[NearDuplicateIndex]
+    #Versión del corpus: cambia con cada escritura en la colección e invalida las respuestas cacheadas
+    corpus_version_path: str
+
+    def close(self) -> None:
+        """Cierra las conexiones SQLite de los índices auxiliares."""
+        if self.sparse_index is not None:
+            self.sparse_index.close()
+        if self.dedup is not None:
+            self.dedup.close()
+
+
 class VectorEmbeddings:
-    def __init__(self, collection_name: str):
+    def __init__(self,
+                 collection_name: str,
+                 backend: str = "chroma",
+                 memmap_dtype: str = "float16",
+                 chunk_size: int = 2000,
+                 chunk_overlap: int = 200,
+                 insert_batch_size: int = 256,
+                 rerank_max_length: int = 1024,
+                 rerank_token_budget: int = 16384,
+                 hnsw_params: Dict = None,
+                 cpu_precision: str = "fp32",
+                 dedup_threshold: float = 0.9,
+                 sparse: bool = True,
+                 version: str = None):
+        """
+        Args:
+            collection_name: Nombre lógico (alias) de la colección donde se almacenan los embeddings. La colección
+                física es la versión a la que apunta el alias (ver src/collection_versions.py)
+            backend: Almacén vectorial a utilizar. "chroma" (índice HNSW de ChromaDB) o "memmap"
+                (matriz cuantizada en disco con búsqueda exacta, ver src/vector_store.py)
+            memmap_dtype: Cuantización de los vectores con el backend "memmap" ("float16" o "int8")
+            chunk_size: Tamaño máximo en caracteres de cada chunk
+            chunk_overlap: Solapamiento en caracteres entre chunks consecutivos de un mismo bloque
+            insert_batch_size: Número de chunks que se codifican e insertan a la vez en process_document
+            rerank_max_length: Longitud máxima en tokens de cada par (consulta - chunk) en el reranker
+            rerank_token_budget: Tokens por batch del reranker al agrupar los pares por longitud
+            hnsw_params: Parámetros del índice HNSW de Chroma ("construction_ef", "M", "search_ef").
+                Solo se aplican al crear la colección; para cambiarlos en una colección existente
+                usar rebuild_index. Ver src/hnsw_sweep.py para elegirlos
+            cpu_precision: Precisión de los modelos en CPU ("fp32", "bf16", "int8" u "onnx", ver
+                src/cpu_inference.py). Con una precisión distinta de fp32 los modelos no se pueden mover a GPU
+            dedup_threshold: Similitud de Jaccard a partir de la cual un chunk nuevo se enlaza a uno ya
+                almacenado del mismo tipo de documento en lugar de almacenarse (ver src/dedup.py). None desactiva
+                la deduplicación
+            sparse: Guardar en un índice invertido los pesos léxicos de bge-m3 de cada chunk para la búsqueda
+                híbrida (ver src/sparse.py). Se obtienen en la misma pasada del modelo que el embedding denso
+            version: Colección física concreta. Por defecto la del alias, que se sigue si otro proceso la cambia
+        """
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.insert_batch_size = insert_batch_size
         #Modelo para embeddings
-        self.model = SentenceTransformer(snapshot_download(repo_id="littlejohn-ai/bge-m3-spa-law-qa", local_dir="./models/BGE"), trust_remote_code=True)
+        self.model_id = EMBEDDING_MODEL_ID
+        self.cpu_precision = cpu_precision
+        # Los embeddings en precisión reducida difieren ligeramente de los fp32, así que se cachean aparte
+        self.encoder_id = EMBEDDING_MODEL_ID if cpu_precision == "fp32" else f"{EMBEDDING_MODEL_ID}@{cpu_precision}"
+        embedding_path = snapshot_download(repo_id=EMBEDDING_MODEL_ID, local_dir="./models/BGE")
+        self.model = load_embedder(embedding_path, cpu_precision)
         #Modelo para rerankear
-        self.reranker = CrossEncoder(snapshot_download(repo_id="BAAI/bge-reranker-v2-m3", local_dir="./models/Reranker"))
+        self.reranker = load_reranker(snapshot_download(repo_id=RERANKER_MODEL_ID, local_dir="./models/Reranker"), cpu_precision, max_length=rerank_max_length)
+        self.rerank_engine = RerankEngine(self.reranker, max_length=rerank_max_length, token_budget=rerank_token_budget)
+        #Caché de embeddings por (modelo, hash del texto) para no recodificar chunks sin cambios
+        self.embedding_cache = EmbeddingCache()
         self.device = self.model.device
         print(f"Using device: {self.device}")
-        self.name = collection_name
-        if not os.path.exists("./data/chroma"):
-            os.makedirs("./data/chroma")
-        self.chroma_client = chromadb.PersistentClient(path="./data/chroma/vec")
-        self.collection = self.chroma_client.get_or_create_collection(
-            name=collection_name,
-            metadata={"hnsw:space": "cosine"}
+        self.backend = backend
+        self.memmap_dtype = memmap_dtype
+        self.dedup_threshold = dedup_threshold
+        self.sparse = sparse
+        if backend == "chroma":
+            if not os.path.exists("./data/chroma"):
+                os.makedirs("./data/chroma")
+            self.chroma_client = chromadb.PersistentClient(path="./data/chroma/vec")
+        elif backend == "memmap":
+            self.chroma_client = None
+        else:
+            raise ValueError(f"Backend no soportado: {backend}. Opciones: chroma, memmap")
+        #Pesos léxicos de bge-m3 en un índice invertido para la búsqueda híbrida densa + léxica
+        self.sparse_encoder = SparseEncoder(self.model, embedding_path) if sparse else None
+        #Alias de la colección lógica; sin versión explícita se sigue la colección física a la que apunta
+        self.alias = CollectionAlias(collection_name)
+        self.follow_alias = version is None
+        self.alias_mtime = self.alias.mtime()
+        #Almacenes de la versión abierta; los sustituidos se cierran cuando ninguna consulta los está usando
+        self.open_lock = threading.Lock()
+        self.stores: Optional[CollectionStores] = None
+        self.readers: Dict[int, int] = {}
+        self.retired: List[CollectionStores] = []
+        self._open(version or self.alias.current(), hnsw_params)
+        self._check_hnsw_params(hnsw_params)
+
+    def _stores(self, name: str, hnsw_params: Dict = None) -> CollectionStores:
+        """Colección física name y sus índices auxiliares, que se guardan por colección física."""
+        if self.backend == "chroma":
+            collection = self.chroma_client.get_or_create_collection(name=name, metadata=hnsw_metadata(hnsw_params))
+            blocks = self.chroma_client.get_or_create_collection(name=f"{name}-bloques", metadata=hnsw_metadata())
+        else:
+            collection = MemmapCollection(path="./data/memmap", name=name, dtype=self.memmap_dtype)
+            blocks = MemmapCollection(path="./data/memmap", name=f"{name}-bloques", dtype=self.memmap_dtype)
+        return CollectionStores(
+            name=name,
+            collection=collection,
+            block_index=BlockIndex(blocks, collection),
+            sparse_index=SparseIndex(name) if self.sparse else None,
+            citations=CitationIndex(name),
+            dedup=NearDuplicateIndex(name, threshold=self.dedup_threshold) if self.dedup_threshold is not None else None,
+            corpus_version_path=os.path.join("./data/corpus_version", f"{name}.txt"),
         )
 
+    def _swap(self, stores: CollectionStores, retire: bool = True) -> None:
+        """
+        Sustituye los almacenes en uso con una sola asignación. Los anteriores se cierran en cuanto
+        terminan las consultas que los estaban usando (retire=False si comparten índices con los nuevos).
+        """
+        with self.open_lock:
+            previous, self.stores = self.stores, stores
+            if retire and previous is not None and previous is not stores:
+                self.retired.append(previous)
+        self._close_retired()
+
+    def _close_retired(self) -> None:
+        with self.open_lock:
+            if not self.retired:
+                return
+            idle = [stores for stores in self.retired if id(stores) not in self.readers]
+            self.retired = [stores for stores in self.retired if id(stores) in self.readers]
+        for stores in idle:
+            stores.close()
+
+    @contextmanager
+    def snapshot(self) -> Iterator[CollectionStores]:
+        """Almacenes de la versión en uso, que no se cierran mientras dure el bloque aunque se cambie de versión."""
+        self.refresh()
+        with self.open_lock:
+            stores = self.stores
+            self.readers[id(stores)] = self.readers.get(id(stores), 0) + 1
+        try:
+            yield stores
+        finally:
+            with self.open_lock:
+                self.readers[id(stores)] -= 1
+                if not self.readers[id(stores)]:
+                    del self.readers[id(stores)]
+            self._close_retired()
+
+    # Accesos a los almacenes de la versión abierta, para la ingesta y las herramientas de mantenimiento.
+    # Las consultas usan snapshot() para no mezclar almacenes de dos versiones
+    @property
+    def name(self):
+        return self.stores.name
+
+    @property
+    def collection(self):
+        return self.stores.collection
+
+    @property
+    def block_index(self):
+        return self.stores.block_index
+
+    @property
+    def sparse_index(self):
+        return self.stores.sparse_index
+
+    @property
+    def citations(self):
+        return self.stores.citations
+
+    @property
+    def dedup(self):
+        return self.stores.dedup
+
+    @property
+    def corpus_version_path(self):
+        return self.stores.corpus_version_path
+
+    def _open(self, name: str, hnsw_params: Dict = None) -> None:
+        """Pasa a usar la colección física name; los índices se abren antes de sustituir los actuales."""
+        self._swap(self._stores(name, hnsw_params))
+
+    def refresh(self) -> bool:
+        """
+        Si el alias apunta a otra colección física (promocionada por otro proceso), pasa a usarla.
+        Comprobarlo cuesta un os.stat del fichero de alias. Devuelve si se ha cambiado de colección.
+        """
+        if not self.follow_alias:
+            return False
+        mtime = self.alias.mtime()
+        if mtime == self.alias_mtime:
+            return False
+        self.alias_mtime = mtime
+        current = self.alias.current()
+        if current == self.name:
+            return False
+        previous = self.name
+        self._open(current)
+        print(f"Collection alias {self.alias.alias}: switched from {previous} to {current}")
+        return True
+
+    @property
+    def corpus_version(self) -> str:
+        """
+        Identificador de la versión actual del contenido: la colección física a la que apunta el alias y
+        el contador de escrituras de esa colección. Cambia al promocionar otra versión y con cada escritura.
+        """
+        self.refresh()
+        stores = self.stores
+        path, name = stores.corpus_version_path, stores.name
+        if not os.path.exists(path):
+            self._bump_corpus_version()
+        with open(path, "r", encoding="utf-8") as f:
+            return f"{name}:{f.read().strip()}"
+
+    def _bump_corpus_version(self) -> None:
+        os.makedirs(os.path.dirname(self.corpus_version_path), exist_ok=True)
+        tmp_path = self.corpus_version_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(f"{datetime.now().strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}")
+        os.replace(tmp_path, self.corpus_version_path)
+
+    def _check_hnsw_params(self, hnsw_params: Dict = None) -> None:
+        """Avisa si la colección ya existía con parámetros HNSW distintos a los pedidos."""
+        if not hnsw_params:
+            return
+        current = self.collection.metadata or {}
+        for key, value in hnsw_params.items():
+            if current.get(f"hnsw:{key}") != value:
+                print(f"Warning: collection {self.name} was built with hnsw:{key}={current.get(f'hnsw:{key}', 'default')}; "
+                      f"call rebuild_index to apply {value}")
+
+    def rebuild_index(self, hnsw_params: Dict, pause: float = 0.0) -> None:
+        """
+        Reconstruye la colección de Chroma con otros parámetros HNSW sin volver a codificar los chunks.
+
+        Chroma fija construction_ef, M y search_ef del índice al crear la colección, así que se copian
+        los registros (con sus embeddings) y los índices auxiliares a una versión nueva creada con los
+        nuevos parámetros. Si la colección abierta es la que está en uso, la versión nueva se promociona
+        con el alias, de modo que las consultas pasan de una a otra sin ver nunca una colección a medias;
+        si es la versión en construcción, la nueva la sustituye. La colección original se conserva hasta
+        que la elimine gc_versions.
+
+        Args:
+            hnsw_params: Parámetros HNSW de la nueva colección ("construction_ef", "M", "search_ef")
+            pause: Segundos de espera entre páginas copiadas para limitar la carga sobre el almacén
+        """
+        if self.backend != "chroma":
+            print("HNSW parameters only apply to the chroma backend; memmap search is exact")
+            return
+        source = self.name
+        live = source == self.alias.current()
+        building = source == self.alias.building()
+        name = version_name(self.alias.alias)
+        target, count = self._seed_version(source, name, hnsw_params, pause=pause)
+        if building:
+            self.alias.start_build(name)
+        self._swap(target)
+        if live:
+            self.promote_version(name)
+        elif not building:
+            print(f"Rebuilt version {name} is not promoted; use promote_version to serve it")
+        print(f"Rebuilt collection {source} as {name} ({count} chunks) with {hnsw_metadata(hnsw_params)}")
+
+    def versions(self) -> List[str]:
+        """Colecciones físicas del alias: las versionadas y, si existe, la colección sin versión."""
+        if self.backend == "chroma":
+            names = self.chroma_client.list_collections()
+        else:
+            names = os.listdir("./data/memmap") if os.path.isdir("./data/memmap") else []
+        prefix = f"{self.alias.alias}{VERSION_SEPARATOR}"
+        return sorted(name for name in names
+                      if (name == self.alias.alias or name.startswith(prefix)) and not name.endswith("-bloques"))
+
+    def begin_version(self, pause: float = 0.0) -> Tuple[str, Union[str, None]]:
+        """
+        Pasa a escribir en una versión nueva de la colección, sin tocar la que están leyendo las consultas.
+
+        La versión nueva se siembra con una copia de la versión en uso (chunks con sus embeddings e índices
+        auxiliares), de modo que la ingesta solo procesa los documentos que han cambiado. Si una construcción
+        anterior quedó a medias, se retoma.
+
+        Args:
+            pause: Segundos de espera entre páginas copiadas para limitar la carga sobre el almacén
+
+        Returns:
+            El nombre de la versión y la colección desde la que se ha sembrado (None si se retoma una construcción)
+        """
+        self.follow_alias = False
+        building = self.alias.building()
+        if building and building in self.versions():
+            print(f"Collection alias {self.alias.alias}: resuming build of {building}")
+            self._open(building)
+            return building, None
+
+        live = self.alias.current()
+        name = version_name(self.alias.alias)
+        start = time.perf_counter()
+        target, count = self._seed_version(live, name, pause=pause)
+        # Se registra la construcción cuando la siembra está completa; una siembra interrumpida la elimina gc_versions
+        self.alias.start_build(name)
+        self._swap(target)
+        print(f"Collection alias {self.alias.alias}: building {name} seeded with {count} chunks from {live} "
+              f"in {time.perf_counter() - start:.1f}s")
+        return name, live
+
+    def _seed_version(self, source_name: str, name: str, hnsw_params: Dict = None, pause: float = 0.0) -> Tuple[CollectionStores, int]:
+        """
+        Crea la colección física name con una copia de source_name (chunks con sus embeddings e índices
+        auxiliares). Sin hnsw_params se conservan los de source_name. Devuelve los almacenes de name y los
+        chunks copiados.
+        """
+        source = self._stores(source_name)
+        try:
+            # Las citas se guardan en un fichero que se carga al abrir el índice: se copia antes de abrir la versión
+            if os.path.exists(source.citations.path):
+                shutil.copyfile(source.citations.path, os.path.join(os.path.dirname(source.citations.path), f"{name}.json"))
+            if hnsw_params is None:
+                hnsw_params = {key.split(":", 1)[1]: value for key, value in (getattr(source.collection, "metadata", None) or {}).items()
+                               if key.startswith("hnsw:") and key != "hnsw:space"}
+            target = self._stores(name, hnsw_params)
+            count = copy_collection(source.collection, target.collection, pause=pause)
+            copy_collection(source.block_index.blocks, target.block_index.blocks, pause=pause)
+            if target.sparse_index is not None:
+                source.sparse_index.copy_to(name)
+            if target.dedup is not None:
+                source.dedup.copy_to(name)
+        finally:
+            source.close()
+        return target, count
+
+    def promote_version(self, name: str = None) -> None:
+        """Apunta el alias a la versión name (por defecto la abierta) con una sustitución atómica del fichero."""
+        name = name or self.name
+        if name not in self.versions():
+            raise ValueError(f"La colección {name} no existe")
+        previous = self.alias.promote(name)
+        if previous is None:
+            print(f"Collection alias {self.alias.alias} already points to {name}")
+        else:
+            print(f"Collection alias {self.alias.alias}: promoted {name} (previous: {previous})")
+
+    def drop_version(self, name: str) -> None:
+        """Elimina una versión que ya no está en uso ni en construcción, con sus índices auxiliares."""
+        state = self.alias.read()
+        if name in (self.alias.current(), state["building"], self.name):
+            raise ValueError(f"La colección {name} está en uso o en construcción")
+        for collection in (name, f"{name}-bloques"):
+            if self.backend == "chroma":
+                if collection in self.chroma_client.list_collections():
+                    self.chroma_client.delete_collection(collection)
+            else:
+                shutil.rmtree(os.path.join("./data/memmap", collection), ignore_errors=True)
+        for index in (SparseIndex(name), NearDuplicateIndex(name)):
+            index.clear()
+            index.close()
+        for path in (os.path.join("./data/citations", f"{name}.json"), os.path.join("./data/corpus_version", f"{name}.txt")):
+            if os.path.exists(path):
+                os.remove(path)
+        self.alias.forget(name)
+
+    def gc_versions(self, keep: int = 2) -> List[str]:
+        """
+        Elimina las versiones antiguas del alias. Se conservan la versión en uso, la que está en
+        construcción y las keep - 1 promocionadas más recientemente (para poder volver atrás).
+        """
+        state = self.alias.read()
+        keep_names = {self.alias.current(), state["building"], self.name} | set(state["history"][:max(keep - 1, 0)])
+        dropped = [name for name in self.versions() if name not in keep_names]
+        for name in dropped:
+            self.drop_version(name)
+            print(f"Collection alias {self.alias.alias}: dropped {name}")
+        return dropped
+
     def move_to_gpu(self):
-        if torch.cuda.is_available():
+        if self.cpu_precision != "fp32":
+            print(f"Models loaded with cpu_precision={self.cpu_precision}; they remain on CPU")
+        elif torch.cuda.is_available():
             self.model.to("cuda")
             print(f"Moved model to {self.model.device}") 
         else:
@@ -62,6 +477,7 @@ class VectorEmbeddings:
             
             
             
+    @traced("docling")
     def extract_MD(self, source: str) -> str:
         """
         Extrae contenido Markdown desde una fuente utilizando la librería Docling.
@@ -78,78 +494,145 @@ class VectorEmbeddings:
             raise
 
 
-    def split_markdown_BOE(self, md_text: str, base_metadata: Dict) -> List[Dict]:
+    def split_markdown_BOE(self, md_text: str, base_metadata: Dict) -> Iterator[Dict]:
         """
         Divide el texto Markdown en chunks manejables con metadata conforme a la estructura de las leyes del BOE (Boletín Oficial del Estado)
 
+        Los chunks se generan de forma perezosa a partir de un único recorrido de la expresión regular de bloques,
+        por lo que nunca se mantiene en memoria la lista completa de bloques ni de chunks.
+
         Args:
             md_text: Texto en formato Markdown
             base_metadata: Metadata base que se incluirá en cada chunk
+
+        Yields:
+            Diccionarios con el contenido del chunk y su metadata
         """
         try:
-            # Encontrar todos los bloques que coinciden con la expresión regular
-            blocks = re.findall(r'\[Bloque \d+: #[^\]]+\]', md_text)
-
-            # Dividir el texto en base a los bloques encontrados
-            split_texts = re.split(r'\[Bloque \d+: #[^\]]+\]', md_text)
-
-            # Eliminar el primer elemento si está vacío (puede ocurrir si el texto comienza con un bloque)
-            if split_texts[0] == '':
-                split_texts = split_texts[1:]
-
-            # Crear una lista de diccionarios con el contenido y el bloque correspondiente
-            header_splits = [{"content": text, "block": block} for text, block in zip(split_texts, blocks)]
-
             text_splitter = RecursiveCharacterTextSplitter(
-                chunk_size=2000,
-                chunk_overlap=200,
+                chunk_size=self.chunk_size,
+                chunk_overlap=self.chunk_overlap,
                 separators=["\n\n", "\n", " ", ""]
             )
 
-            final_chunks = []
-            for split in header_splits:
+            # Recorrer los bloques: el contenido de cada bloque va desde su marca hasta la marca siguiente.
+            # El texto previo a la primera marca (cabecera de la página) no pertenece a ningún bloque
+            matches = BLOCK_PATTERN.finditer(md_text)
+            current = next(matches, None)
+            while current is not None:
+                following = next(matches, None)
+                end = following.start() if following is not None else len(md_text)
+                content = md_text[current.end():end]
+
                 # Combinar metadata del bloque con base_metadata
-                chunk_metadata = {**base_metadata, "block": split["block"]}
+                chunk_metadata = {**base_metadata, "block": current.group(0)}
 
-                if len(split["content"]) > 2000:
-                    smaller_chunks = text_splitter.split_text(split["content"])
+                if len(content) > self.chunk_size:
+                    smaller_chunks = text_splitter.split_text(content)
                     for i, chunk in enumerate(smaller_chunks):
-                        final_chunks.append({
+                        yield {
                             "content": chunk,
                             "metadata": {
                                 **chunk_metadata,
                                 "chunk_index": i,
                                 "total_chunks": len(smaller_chunks)
                             }
-                        })
+                        }
                 else:
-                    final_chunks.append({
-                        "content": split["content"],
+                    yield {
+                        "content": content,
                         "metadata": {
                             **chunk_metadata,
                             "chunk_index": 0,
                             "total_chunks": 1
                         }
-                    })
-
-            return final_chunks
+                    }
+                current = following
         except Exception as e:
             print(f"Error splitting markdown: {str(e)}")
             raise e
         
 
-    def get_embeddings(self, texts: List[str]) -> List[List[float]]:
-        """Genera embeddings para una lista de textos."""
+    @traced("embed_chunks")
+    def get_embeddings(self, texts: List[str], use_cache: bool = True) -> List[List[float]]:
+        """
+        Genera embeddings para una lista de textos.
+
+        Antes de codificar se consulta la caché de embeddings, de modo que solo se pasan por el modelo
+        los textos que no se han codificado nunca con este modelo.
+
+        Args:
+            texts: Textos a codificar
+            use_cache: Si se consulta y actualiza la caché de embeddings
+        """
         try:
-            embeddings = []
-            for text in texts:
-                embedding = self.model.encode(text)
-                embeddings.append(embedding.tolist())
-            return embeddings
+            cached = self.embedding_cache.get_many(self.encoder_id, texts) if use_cache else [None] * len(texts)
+            missing = [i for i, embedding in enumerate(cached) if embedding is None]
+
+            if missing:
+                missing_texts = [texts[i] for i in missing]
+                new_embeddings = self.model.encode(missing_texts)
+                for i, embedding in zip(missing, new_embeddings):
+                    cached[i] = embedding
+                if use_cache:
+                    self.embedding_cache.put_many(self.encoder_id, missing_texts, new_embeddings)
+
+            print(f"Embeddings: {len(texts) - len(missing)} from cache, {len(missing)} encoded")
+            return [embedding.tolist() for embedding in cached]
         except Exception as e:
             print(f"Error generating embeddings: {str(e)}")
             raise
 
+    def encode_chunks(self, texts: List[str], use_cache: bool = True) -> Tuple[List[List[float]], Optional[List[Dict[int, float]]]]:
+        """
+        Embeddings densos y, si hay índice léxico, pesos léxicos de los chunks, con una sola pasada del modelo.
+
+        Los pesos léxicos se guardan en la caché junto al embedding denso, así que solo pasan por el modelo
+        (una vez, obteniendo ambos) los textos que no están en la caché o que se guardaron sin pesos léxicos.
+
+        Returns:
+            (embeddings de cada texto, pesos token -> peso de cada texto o None si no hay índice léxico)
+        """
+        if self.sparse_encoder is None:
+            return self.get_embeddings(texts, use_cache=use_cache), None
+        cached = self.embedding_cache.get_many(self.encoder_id, texts, with_sparse=True) if use_cache else [None] * len(texts)
+        missing = [i for i, entry in enumerate(cached) if entry is None]
+
+        if missing:
+            missing_texts = [texts[i] for i in missing]
+            sparse, dense = self.sparse_encoder.encode(missing_texts, with_dense=True)
+            for i, embedding, token_weights in zip(missing, dense, sparse):
+                cached[i] = (embedding, token_weights)
+            if use_cache:
+                self.embedding_cache.put_many(self.encoder_id, missing_texts, dense, sparse)
+
+        print(f"Embeddings: {len(texts) - len(missing)} from cache, {len(missing)} encoded (with sparse weights)")
+        return [embedding.tolist() for embedding, _ in cached], [token_weights for _, token_weights in cached]
+
+    def referenced_text_hashes(self, page_size: int = 5000) -> set:
+        """Devuelve los hashes de los textos de todos los chunks almacenados en cualquier colección del backend."""
+        if self.backend == "chroma":
+            collections = [self.chroma_client.get_collection(name) for name in self.chroma_client.list_collections()]
+        else:
+            root = os.path.dirname(self.collection.dir)
+            collections = [MemmapCollection(path=root, name=name) for name in os.listdir(root)
+                           if os.path.isdir(os.path.join(root, name))]
+
+        hashes = set()
+        for collection in collections:
+            offset = 0
+            while True:
+                page = collection.get(include=["documents"], limit=page_size, offset=offset)
+                if not page["ids"]:
+                    break
+                hashes.update(EmbeddingCache.text_hash(document) for document in page["documents"])
+                offset += len(page["ids"])
+        return hashes
+
+    def gc_embedding_cache(self) -> int:
+        """Elimina de la caché los embeddings de textos que ya no están en ninguna colección."""
+        return self.embedding_cache.collect_garbage(self.encoder_id, self.referenced_text_hashes())
+
     def process_document(self, 
                         source: str,
                         document_type: DocumentType,
@@ -175,116 +658,557 @@ class VectorEmbeddings:
                 document_id = str(uuid.uuid4())
 
             # Metadata base del documento
-            base_metadata = {
-                "document_id": document_id,
-                "document_type": document_type.value,
-                "processing_date": datetime.now().isoformat(),
-                "related_documents": ",".join(related_docs) if related_docs else ""
-            }
-
-            # Combinar con metadata adicional si existe
-            if metadata:
-                base_metadata.update(metadata)
+            base_metadata = self.build_base_metadata(document_type, document_id, metadata, related_docs)
 
             # Extraer y procesar contenido
             md_content = self.extract_MD(source)
             if not md_content:
                 raise ValueError("No Markdown content was extracted")
 
-            # Dividir en chunks con la metadata enriquecida
+            # Dividir en chunks con la metadata enriquecida. Los chunks se consumen en lotes de tamaño fijo
+            # (embeddings + inserción) para que el pico de memoria no dependa del tamaño de la norma
             chunks = self.split_markdown_BOE(md_content, base_metadata)
-            if not chunks:
-                raise ValueError("No chunks were generated from the document")
+            blocks = self.block_index.builder()
+            num_chunks = 0
+            num_stored = 0
+            for batch in batched(chunks, self.insert_batch_size):
+                ids = [self.chunk_id(document_id, num_chunks + i) for i in range(len(batch))]
+                num_chunks += len(batch)
 
-            # Preparar datos para ChromaDB
-            texts = [chunk["content"] for chunk in chunks]
-            metadatas = [chunk["metadata"] for chunk in chunks]
-            ids = [f"{document_id}-chunk-{i}" for i in range(len(chunks))]
+                # Descartar los casi duplicados de chunks ya almacenados antes de codificarlos
+                kept = self.filter_duplicates(ids, batch)
+                if not kept:
+                    continue
+                ids = [ids[i] for i in kept]
+                batch = [batch[i] for i in kept]
 
-            # Generar embeddings
-            embeddings = self.get_embeddings(texts)
+                # Generar embeddings y pesos léxicos
+                embeddings, sparse_weights = self.encode_chunks([chunk["content"] for chunk in batch])
 
-            # Añadir a la colección
-            self.collection.add(
-                embeddings=embeddings,
-                documents=texts,
-                metadatas=metadatas,
-                ids=ids
-            )
+                # Añadir a la colección y al índice de bloques
+                self.store_chunks(ids, batch, embeddings, sparse_weights)
+                blocks.add(ids, batch, embeddings)
+                num_stored += len(batch)
+            blocks.flush()
+            self.citations.save()
 
-            print(f"Successfully processed document {document_id} with {len(chunks)} chunks")
+            if num_chunks == 0:
+                raise ValueError("No chunks were generated from the document")
+
+            print(f"Successfully processed document {document_id} with {num_chunks} chunks "
+                  f"({num_chunks - num_stored} linked as near-duplicates)")
             return document_id
 
         except Exception as e:
             print(f"Error processing document: {str(e)}")
             raise
 
+    def build_base_metadata(self,
+                            document_type: DocumentType,
+                            document_id: str,
+                            metadata: Dict = None,
+                            related_docs: List[str] = None) -> Dict:
+        """Construye la metadata común a todos los chunks de un documento."""
+        base_metadata = {
+            "document_id": document_id,
+            "document_type": document_type.value,
+            "processing_date": datetime.now().isoformat(),
+            "related_documents": ",".join(related_docs) if related_docs else ""
+        }
+
+        # Combinar con metadata adicional si existe
+        if metadata:
+            base_metadata.update(metadata)
+        return base_metadata
+
+    @staticmethod
+    def chunk_id(document_id: str, index: int) -> str:
+        return f"{document_id}-chunk-{index}"
+
+    @traced("store_chunks")
+    def store_chunks(self, ids: List[str], chunks: List[Dict], embeddings: List[List[float]],
+                     sparse_weights: List[Dict[int, float]] = None) -> None:
+        """
+        Añade a la colección un lote de chunks ya codificados. El índice de citas se actualiza en memoria;
+        quien llama lo guarda con citations.save() al terminar el documento.
+
+        Args:
+            ids: IDs de los chunks
+            chunks: Chunks con su contenido y metadata, tal y como los genera split_markdown_BOE
+            embeddings: Embedding de cada chunk
+            sparse_weights: Pesos léxicos de cada chunk (ver encode_chunks) para el índice invertido; sin
+                ellos los chunks no se añaden a la búsqueda léxica
+        """
+        self.collection.add(
+            embeddings=embeddings,
+            documents=[chunk["content"] for chunk in chunks],
+            metadatas=[chunk["metadata"] for chunk in chunks],
+            ids=ids
+        )
+        self.citations.add_chunks(ids, [chunk["metadata"] for chunk in chunks], save=False)
+        if self.sparse_index is not None and sparse_weights is not None:
+            self.sparse_index.add(ids, [chunk["metadata"] for chunk in chunks], sparse_weights)
+        self._bump_corpus_version()
+
+    def filter_duplicates(self, ids: List[str], chunks: List[Dict]) -> List[int]:
+        """
+        Enlaza los chunks casi duplicados de otros ya almacenados y devuelve las posiciones de los que
+        se deben almacenar. Las citas de los artículos enlazados se resuelven con su chunk canónico
+        (como en store_chunks, el índice de citas lo guarda quien llama).
+        """
+        if self.dedup is None:
+            return list(range(len(ids)))
+        kept, links = self.dedup.deduplicate(ids, chunks)
+        if links:
+            self.citations.add_chunks([canonical_id for _, canonical_id in links],
+                                      [chunks[position]["metadata"] for position, _ in links], save=False)
+        return kept
+
+    def delete_document(self, document_id: str) -> None:
+        """
+        Elimina de la colección todos los chunks de un documento.
+
+        Los chunks de otros documentos que estaban enlazados como duplicados de chunks de este documento
+        se almacenan de nuevo (sus embeddings suelen estar en la caché).
+        """
+        self.collection.delete(where={"document_id": document_id})
+        self.block_index.delete_document(document_id)
+        self.citations.remove_document(document_id)
+        if self.sparse_index is not None:
+            self.sparse_index.remove_document(document_id)
+        self._bump_corpus_version()
+        if self.dedup is None:
+            return
+        orphans = self.dedup.remove_document(document_id)
+        if orphans:
+            ids = [orphan["id"] for orphan in orphans]
+            chunks = [{"content": orphan["content"], "metadata": orphan["metadata"]} for orphan in orphans]
+            kept = self.filter_duplicates(ids, chunks)
+            ids = [ids[i] for i in kept]
+            chunks = [chunks[i] for i in kept]
+            if ids:
+                embeddings, sparse_weights = self.encode_chunks([chunk["content"] for chunk in chunks])
+                self.store_chunks(ids, chunks, embeddings, sparse_weights)
+                blocks = self.block_index.builder()
+                blocks.add(ids, chunks, embeddings)
+                blocks.flush()
+            self.citations.save()
+            print(f"Restored {len(ids)} chunks of other documents that were linked to {document_id}")
+
+    def export_artifact(self, path: str) -> Dict:
+        """
+        Empaqueta la colección en un artefacto versionado y con sumas de verificación (ver src/artifact.py),
+        incluidos los chunks enlazados como casi duplicados, que no están en la colección.
+        """
+        chunk_params = {"chunk_size": self.chunk_size, "chunk_overlap": self.chunk_overlap}
+        links = self.dedup.iter_links() if self.dedup is not None else None
+        return write_artifact(path, self.collection, self.name, self.model_id, chunk_params, links=links)
+
+    def import_artifact(self, path: str, replace: bool = False, verify: bool = True) -> Dict:
+        """
+        Carga en la colección un artefacto generado con export_artifact, sin volver a codificar nada.
+
+        Args:
+            path: Directorio del artefacto
+            replace: Si la colección ya tiene chunks, el artefacto se importa en una versión nueva que, una vez
+                comprobada, sustituye a la abierta (se promociona si es la versión en uso); si es False se rechaza
+            verify: Comprobar las sumas de verificación de los ficheros
+
+        Returns:
+            El manifiesto del artefacto importado
+        """
+        start = time.perf_counter()
+        manifest = read_artifact(path, verify=verify)
+        if manifest["model_id"] != self.model_id:
+            raise ValueError(f"El artefacto se generó con el modelo {manifest['model_id']} y esta instancia usa {self.model_id}")
+        chunk_params = {"chunk_size": self.chunk_size, "chunk_overlap": self.chunk_overlap}
+        if manifest["chunk_params"] != chunk_params:
+            print(f"Warning: artifact chunk parameters {manifest['chunk_params']} differ from {chunk_params}; "
+                  f"documents ingested later will be chunked differently")
+
+        source = None
+        if self.collection.count():
+            if not replace:
+                raise ValueError(f"La colección {self.name} no está vacía; usa replace=True para sustituirla")
+            # Se importa en una versión nueva y se promociona al terminar: los procesos que sirven consultas
+            # siguen leyendo la versión actual hasta entonces
+            source = self.name
+            hnsw_params = {key.split(":", 1)[1]: value for key, value in (getattr(self.collection, "metadata", None) or {}).items()
+                           if key.startswith("hnsw:") and key != "hnsw:space"}
+            self.follow_alias = False
+            self._swap(self._stores(version_name(self.alias.alias), hnsw_params))
+
+        blocks = self.block_index.builder()
+        for ids, embeddings, documents, metadatas in iter_artifact(path, batch_size=self.insert_batch_size):
+            chunks = [{"content": document, "metadata": metadata} for document, metadata in zip(documents, metadatas)]
+            # El artefacto no incluye los pesos léxicos: calcularlos supondría volver a pasar el modelo
+            self.store_chunks(ids, chunks, embeddings)
+            blocks.add(ids, chunks, embeddings)
+            if self.dedup is not None:
+                self.dedup.register(ids, chunks)
+        blocks.flush()
+        # Los duplicados enlazados: su texto y metadata para citar ambas normas, y sus artículos resueltos con el canónico
+        for links in iter_artifact_links(path, batch_size=self.insert_batch_size):
+            if self.dedup is not None:
+                self.dedup.add_links(links)
+            self.citations.add_chunks([link["canonical_id"] for link in links], [link["metadata"] for link in links], save=False)
+        self.citations.save()
+        print(f"Imported {manifest['count']} chunks and {manifest.get('links', 0)} near-duplicate links into {self.name} "
+              f"in {time.perf_counter() - start:.1f}s")
+        if source is not None:
+            count = self.collection.count()
+            if count != manifest["count"]:
+                raise RuntimeError(f"La versión {self.name} tiene {count} chunks y el artefacto {manifest['count']}; no se promociona")
+            if source == self.alias.current():
+                self.promote_version()
+                self.follow_alias = True
+                self.alias_mtime = self.alias.mtime()
+            elif source == self.alias.building():
+                self.alias.start_build(self.name)
+            else:
+                print(f"Imported version {self.name} is not promoted; use promote_version to serve it")
+        if self.sparse_index is not None:
+            print(f"Run python -m src.sparse build --collection {self.name} to enable hybrid search")
+        return manifest
+
+    @traced("get_chunks")
+    def get_chunks(self, ids: List[str], stores: CollectionStores = None) -> List[Dict]:
+        """
+        Recupera chunks por id, en el orden pedido, con el mismo formato que query_similar.
+        Los ids que ya no existen en la colección (p.ej. documentos eliminados) se omiten.
+        """
+        if not ids:
+            return []
+        if stores is None:
+            with self.snapshot() as stores:
+                return self.get_chunks(ids, stores)
+        results = stores.collection.get(ids=list(ids), include=["documents", "metadatas"])
+        found = {id_: {'id': id_, 'document': document, 'metadata': metadata}
+                 for id_, document, metadata in zip(results['ids'], results['documents'], results['metadatas'])}
+        return [found[id_] for id_ in ids if id_ in found]
+
     def query_similar(self, 
-                     query_text: str, 
+                     query_text: Union[str, List[str]], 
                      score: float = 0.6,
                      document_types: List[DocumentType] = None,
                      document_ids: List[str] = None,
-                     include_related: bool = False) -> List[Dict]:
+                     include_related: bool = False,
+                     n_results: int = 50,
+                     hierarchical: bool = False,
+                     n_blocks: int = 20,
+                     hybrid: bool = False) -> List[Dict]:
         """
         Búsqueda avanzada de documentos similares.
 
+        Las citas concretas ("artículo 20 de la Ley 29/1987") se resuelven con el índice de citas: hasta
+        n_results chunks citados se añaden a los candidatos sin aplicar el filtro por tipo de documento y se
+        re-rankean con ellos, con el mismo umbral score. La búsqueda vectorial solo se lanza para las consultas
+        que, además de la cita, piden algo más.
+
+        Con varias consultas (p.ej. la consulta principal y subconsultas por impuesto o Comunidad Autónoma)
+        se codifican en un único batch, se lanzan en una sola consulta multi-embedding, se eliminan los
+        candidatos repetidos y se re-rankea la unión en una única pasada del CrossEncoder. Cada candidato
+        se puntúa con la consulta que lo recuperó a menor distancia.
+
         Args:
-            query_text: Texto de la consulta
+            query_text: Texto de la consulta o lista de consultas
             score: Mínimo de similitud del rerank score para que lo incluya en el contexto
             document_types: Tipos de documentos a incluir en la búsqueda
             document_ids: IDs específicos de documentos
             include_related: Si se incluyen documentos relacionados
+            n_results: Candidatos que se recuperan del índice por consulta antes de re-rankear
+            hierarchical: Buscar primero los n_blocks bloques más cercanos y solo después sus chunks
+                (ver src/block_index.py). Si la colección no tiene índice de bloques se usa la búsqueda plana
+            n_blocks: Bloques que se eligen por consulta en la búsqueda jerárquica
+            hybrid: Fusionar (RRF) los candidatos densos con los del índice léxico de pesos de bge-m3
+                (ver src/sparse.py). Con mejor precisión en la primera etapa basta con un n_results menor
         """
         try:
-            # 1. Generar embeddings a partir de la consulta para la búsqueda vectorial
-            query_embedding = self.model.encode(query_text).tolist()
+            with self.snapshot() as stores:
+                return self._query_similar(stores, query_text, score, document_types, document_ids, include_related,
+                                           n_results, hierarchical, n_blocks, hybrid)
+        except Exception as e:
+            print(f"Error querying similar documents: {str(e)}")
+            return []
+
+    def _query_similar(self, stores: CollectionStores, query_text: Union[str, List[str]], score: float,
+                       document_types: List[DocumentType], document_ids: List[str], include_related: bool,
+                       n_results: int, hierarchical: bool, n_blocks: int, hybrid: bool) -> List[Dict]:
+        """Cuerpo de query_similar sobre los almacenes de una misma versión."""
+        queries = [query_text] if isinstance(query_text, str) else list(query_text)
+
+        # 0. Citas de artículos concretos: se recuperan directamente del índice de citas
+        candidates, search_queries = self._lookup_citations(stores, queries, n_results)
+        if search_queries:
+            # 1. Generar embeddings a partir de las consultas para la búsqueda vectorial
+            query_embeddings, query_sparse = self._encode_queries(stores, [queries[q] for q in search_queries], hybrid)
 
             # 2.Construir filtro
-            conditions = []
-            
-            if document_types:
-                conditions.append({"document_type": {"$in": [dt.value for dt in document_types]}})
-            
-            if document_ids:
-                if include_related:
-                    related_docs = self.get_related_documents(document_ids)
-                    document_ids.extend(related_docs)
-                conditions.append({"document_id": {"$in": document_ids}})
-            
-            where = None
-            if conditions:
-                if len(conditions) == 1:
-                    where = conditions[0]
-                else:
-                    where = {"$and": conditions}
+            where = self._build_where(document_types, document_ids, include_related, stores)
 
             #3. Consulta inicial en Chroma
-            results = self.collection.query(
-                query_embeddings=[query_embedding],
-                n_results=50,
-                where=where,
-                include=["documents", "metadatas", "distances"]
-            )
+            results = self._search(stores, query_embeddings, n_results, where, hierarchical, n_blocks, query_sparse)
 
-            # 4. Formatear los resultados
-            formatted_results = self._format_results(results)
-            
-            # 5. Re-rankear los resultados utilizando el modelo CrossEncoder
-            reranked_results = self._rerank_results(query_text, formatted_results, score)
-            
-            return reranked_results
+            # 4. Formatear los resultados, quedándose con cada chunk una sola vez (los citados tienen distancia 0)
+            for pos, q in enumerate(search_queries):
+                for result in self._format_results(results, query_index=pos):
+                    best = candidates.get(result['id'])
+                    if best is None or result['distance'] < best[1]['distance']:
+                        candidates[result['id']] = (q, result)
+        # y agrupando los casi duplicados almacenados para no gastar pares del rerank en ellos
+        formatted_results = [result for _, result in candidates.values()]
+        if stores.dedup is not None:
+            formatted_results = stores.dedup.collapse(formatted_results)
 
-        except Exception as e:
-            print(f"Error querying similar documents: {str(e)}")
-            return reranked_results
+        # 5. Re-rankear los resultados utilizando el modelo CrossEncoder
+        reranked_results = self._rerank_results([queries[candidates[r['id']][0]] for r in formatted_results], formatted_results, score)
+
+        return self._attach_duplicates(stores, reranked_results)
+
+    def _lookup_citations(self, stores: CollectionStores, queries: List[str], n_results: int) -> Tuple[Dict[str, Tuple[int, Dict]], List[int]]:
+        """
+        Resuelve con el índice de citas los artículos citados en las consultas.
+
+        Returns:
+            Los chunks citados (como mucho n_results) por id, con la posición de la consulta que los cita
+            y distancia 0, y las posiciones de las consultas que además necesitan búsqueda vectorial
+        """
+        cited_ids: Dict[str, int] = {}
+        search_queries = []
+        for q, query in enumerate(queries):
+            ids, needs_search = stores.citations.lookup(query)
+            for id_ in ids:
+                cited_ids.setdefault(id_, q)
+            if needs_search:
+                search_queries.append(q)
+        cited = {}
+        for result in self.get_chunks(list(cited_ids)[:n_results], stores):
+            result['distance'] = 0.0
+            cited[result['id']] = (cited_ids[result['id']], result)
+        if cited:
+            print(f"Citation index: {len(cited)} cited chunks, vector search for {len(search_queries)} of {len(queries)} queries")
+        return cited, search_queries
+
+    @traced("embed_query")
+    def _encode_queries(self, stores: CollectionStores, queries: List[str], hybrid: bool = False):
+        """Embeddings densos de las consultas y, para la búsqueda híbrida, sus pesos léxicos (una sola pasada)."""
+        if hybrid and stores.sparse_index is not None and stores.sparse_index.count():
+            query_sparse, dense = self.sparse_encoder.encode(queries, with_dense=True)
+            return dense.tolist(), query_sparse
+        return self.model.encode(queries).tolist(), None
+
+    @traced("search")
+    def _search(self, stores: CollectionStores, query_embeddings: List[List[float]], n_results: int, where: Union[Dict, None],
+                hierarchical: bool = False, n_blocks: int = 20, query_sparse: List[Dict[int, float]] = None) -> Dict:
+        """
+        Consulta plana en la colección o, si se pide y hay índice de bloques, jerárquica. Si se pasan los
+        pesos léxicos de las consultas, los candidatos densos se fusionan con los léxicos.
+        """
+        if hierarchical and stores.block_index.count():
+            with span("block_index"):
+                results = stores.block_index.query(query_embeddings, n_results=n_results, where=where, n_blocks=n_blocks)
+        else:
+            with span("chroma"):
+                results = stores.collection.query(
+                    query_embeddings=query_embeddings,
+                    n_results=n_results,
+                    where=where,
+                    include=["documents", "metadatas", "distances"]
+                )
+        if query_sparse is None:
+            return results
+        return self._fuse(stores, results, query_embeddings, query_sparse, n_results, where)
+
+    @staticmethod
+    def _where_values(where: Union[Dict, None], key: str) -> Union[List[str], None]:
+        """Valores permitidos para key en un filtro construido por _build_where."""
+        for condition in (where.get("$and", [where]) if where else []):
+            if key in condition:
+                return condition[key]["$in"]
+        return None
+
+    @traced("fuse")
+    def _fuse(self, stores: CollectionStores, results: Dict, query_embeddings: List[List[float]], query_sparse: List[Dict[int, float]],
+              n_results: int, where: Union[Dict, None]) -> Dict:
+        """
+        Reciprocal rank fusion de los candidatos densos con los del índice léxico, con el formato de
+        collection.query. Los candidatos que solo aparecen en la búsqueda léxica se recuperan de la
+        colección y su distancia coseno se calcula con su embedding.
+        """
+        document_types = self._where_values(where, "document_type")
+        document_ids = self._where_values(where, "document_id")
+        use_idf = not self.sparse_encoder.learned
+        rankings = []
+        for q, weights in enumerate(query_sparse):
+            lexical = [id_ for id_, _ in stores.sparse_index.search(weights, n_results, document_types, document_ids, use_idf)]
+            rankings.append(reciprocal_rank_fusion([results["ids"][q], lexical])[:n_results])
+
+        known = {}
+        for q in range(len(rankings)):
+            for i, id_ in enumerate(results["ids"][q]):
+                known[(q, id_)] = (results["documents"][q][i], results["metadatas"][q][i], results["distances"][q][i])
+        missing = list(dict.fromkeys(id_ for q, ranking in enumerate(rankings) for id_ in ranking if (q, id_) not in known))
+        if missing:
+            found = stores.collection.get(ids=missing, include=["embeddings", "documents", "metadatas"])
+            embeddings = np.asarray(found["embeddings"], dtype=np.float32).reshape(len(found["ids"]), -1)
+            embeddings = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+            queries = np.asarray(query_embeddings, dtype=np.float32)
+            queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+            distances = 1.0 - queries @ embeddings.T
+            for row, id_ in enumerate(found["ids"]):
+                for q in range(len(rankings)):
+                    known.setdefault((q, id_), (found["documents"][row], found["metadatas"][row], float(distances[q, row])))
+
+        fused = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+        for q, ranking in enumerate(rankings):
+            ranking = [id_ for id_ in ranking if (q, id_) in known]
+            fused["ids"].append(ranking)
+            fused["documents"].append([known[(q, id_)][0] for id_ in ranking])
+            fused["metadatas"].append([known[(q, id_)][1] for id_ in ranking])
+            fused["distances"].append([known[(q, id_)][2] for id_ in ranking])
+        return fused
+
+    def _attach_duplicates(self, stores: CollectionStores, results: List[Dict]) -> List[Dict]:
+        """Añade a cada resultado, en 'duplicates', los chunks de otras normas enlazados a él como duplicados."""
+        if stores.dedup is None or not results:
+            return results
+        linked = stores.dedup.duplicates_of([result['id'] for result in results])
+        for result in results:
+            if result['id'] in linked:
+                result.setdefault('duplicates', []).extend(linked[result['id']])
+        return results
+
+    def query_similar_batch(self,
+                            query_texts: List[Union[str, List[str]]],
+                            score: float = 0.6,
+                            document_types: List[List[DocumentType]] = None,
+                            n_results: int = 50,
+                            hierarchical: bool = False,
+                            n_blocks: int = 20,
+                            hybrid: bool = False) -> List[List[Dict]]:
+        """
+        Búsqueda de varias preguntas a la vez compartiendo la codificación, la consulta a Chroma y el rerank.
+        Las citas concretas se resuelven con el índice de citas como en query_similar.
+
+        Todas las consultas se codifican en un único batch, las que comparten filtro de tipos de documento
+        se resuelven con una sola llamada a Chroma y todos los pares (consulta - documento) se puntúan
+        con el CrossEncoder en una única llamada. Cada pregunta puede tener varias consultas (la principal
+        y sus subconsultas): como en query_similar, sus candidatos se unen sin repetidos y cada uno se
+        puntúa con la consulta que lo recuperó a menor distancia.
 
-    def get_related_documents(self, document_ids: List[str]) -> List[str]:
+        Args:
+            query_texts: Para cada pregunta, el texto de la consulta o la lista de sus consultas
+            score: Mínimo de similitud del rerank score para que lo incluya en el contexto
+            document_types: Para cada pregunta, tipos de documentos a incluir en la búsqueda
+            n_results: Número de candidatos que se recuperan de Chroma por consulta
+            hierarchical: Búsqueda jerárquica por bloques, como en query_similar
+            n_blocks: Bloques que se eligen por consulta en la búsqueda jerárquica
+            hybrid: Búsqueda híbrida densa + léxica, como en query_similar
+
+        Returns:
+            Una lista de resultados rerankeados por cada pregunta, en el mismo orden que query_texts
+        """
+        if not query_texts:
+            return []
+        with self.snapshot() as stores:
+            return self._query_similar_batch(stores, query_texts, score, document_types, n_results, hierarchical, n_blocks, hybrid)
+
+    def _query_similar_batch(self, stores: CollectionStores, query_texts: List[Union[str, List[str]]], score: float,
+                             document_types: List[List[DocumentType]], n_results: int, hierarchical: bool,
+                             n_blocks: int, hybrid: bool) -> List[List[Dict]]:
+        """Cuerpo de query_similar_batch sobre los almacenes de una misma versión."""
+        if document_types is None:
+            document_types = [None] * len(query_texts)
+        item_queries = [[query] if isinstance(query, str) else list(query) for query in query_texts]
+        queries = [query for item in item_queries for query in item]
+        owners = [item for item, item_query in enumerate(item_queries) for _ in item_query]
+
+        # 0. Citas de artículos concretos de cada pregunta, como en query_similar
+        candidates: List[Dict[str, Tuple[int, Dict]]] = []
+        search_queries: List[int] = []
+        offset = 0
+        for item in item_queries:
+            cited, search = self._lookup_citations(stores, item, n_results)
+            candidates.append({id_: (offset + q, result) for id_, (q, result) in cited.items()})
+            search_queries.extend(offset + q for q in search)
+            offset += len(item)
+
+        # 1. Codificar en un único batch todas las consultas que necesitan búsqueda vectorial
+        if search_queries:
+            query_embeddings, query_sparse = self._encode_queries(stores, [queries[q] for q in search_queries], hybrid)
+            position = {q: pos for pos, q in enumerate(search_queries)}
+
+        # 2. Agrupar las consultas que comparten filtro para lanzar una sola consulta por grupo y unir
+        # los candidatos de cada pregunta, quedándose con la consulta que recuperó cada chunk a menor distancia
+        groups: Dict[tuple, List[int]] = {}
+        for q in search_queries:
+            types = document_types[owners[q]]
+            key = tuple(sorted(dt.value for dt in types)) if types else ()
+            groups.setdefault(key, []).append(q)
+
+        for qs in groups.values():
+            where = self._build_where(document_types[owners[qs[0]]])
+            results = self._search(stores, [query_embeddings[position[q]] for q in qs], n_results, where, hierarchical, n_blocks,
+                                   [query_sparse[position[q]] for q in qs] if query_sparse else None)
+            for pos, q in enumerate(qs):
+                item_candidates = candidates[owners[q]]
+                for result in self._format_results(results, query_index=pos):
+                    best = item_candidates.get(result['id'])
+                    if best is None or result['distance'] < best[1]['distance']:
+                        item_candidates[result['id']] = (q, result)
+        formatted_results: List[List[Dict]] = []
+        for item_candidates in candidates:
+            results = [result for _, result in item_candidates.values()]
+            if stores.dedup is not None:
+                results = stores.dedup.collapse(results)
+            formatted_results.append(results)
+
+        # 3. Rerank conjunto de todos los pares, cada candidato con la consulta que lo recuperó
+        pairs = []
+        for item_candidates, results in zip(candidates, formatted_results):
+            pairs.extend((queries[item_candidates[r['id']][0]], r['document']) for r in results)
+        scores = self.rerank_engine.score(pairs)
+
+        reranked_results = []
+        offset = 0
+        for results in formatted_results:
+            query_scores = scores[offset:offset + len(results)]
+            offset += len(results)
+            reranked_results.append(self._attach_duplicates(stores, self.rerank_engine.select(results, query_scores, score)))
+        return reranked_results
+
+    def _build_where(self,
+                     document_types: List[DocumentType] = None,
+                     document_ids: List[str] = None,
+                     include_related: bool = False,
+                     stores: CollectionStores = None) -> Union[Dict, None]:
+        """Construye el filtro de metadatos de Chroma a partir de los tipos e IDs de documentos."""
+        conditions = []
+
+        if document_types:
+            conditions.append({"document_type": {"$in": [dt.value for dt in document_types]}})
+
+        if document_ids:
+            if include_related:
+                related_docs = self.get_related_documents(document_ids, stores)
+                document_ids.extend(related_docs)
+            conditions.append({"document_id": {"$in": document_ids}})
+
+        where = None
+        if conditions:
+            if len(conditions) == 1:
+                where = conditions[0]
+            else:
+                where = {"$and": conditions}
+        return where
+
+    def get_related_documents(self, document_ids: List[str], stores: CollectionStores = None) -> List[str]:
         """Obtiene todos los documentos relacionados con los IDs proporcionados."""
         related_docs = set()
         try:
             # Obtener metadata de los documentos especificados
             where = {"document_id": {"$in": document_ids}}
-            results = self.collection.get(where=where)
+            results = (stores or self.stores).collection.get(where=where)
 
             # Extraer IDs de documentos relacionados
             for metadata in results['metadatas']:
@@ -297,27 +1221,31 @@ class VectorEmbeddings:
             print(f"Error getting related documents: {str(e)}")
             raise
 
-    def _format_results(self, results: Dict) -> List[Dict]:
-        """Formatea los resultados de la búsqueda."""
+    def _format_results(self, results: Dict, query_index: int = 0) -> List[Dict]:
+        """Formatea los resultados de la búsqueda para la consulta en la posición query_index."""
         formatted_results = []
-        for i in range(len(results['documents'][0])):
-            doc_content = results['documents'][0][i]
+        for i in range(len(results['documents'][query_index])):
+            doc_content = results['documents'][query_index][i]
             
             #Si el contenido es una lista, lo convertimos a string
             if isinstance(doc_content, list):
                 doc_content = ' '.join(doc_content)
             formatted_results.append({
+                'id': results['ids'][query_index][i],
                 'document': doc_content,
-                'metadata': results['metadatas'][0][i],
-                'distance': results['distances'][0][i]
+                'metadata': results['metadatas'][query_index][i],
+                'distance': results['distances'][query_index][i]
             })
         return formatted_results
     
-    def _rerank_results(self, query_text: str, results: List[Dict], score: float=0.6) -> List[Dict]:
+    @traced("rerank")
+    def _rerank_results(self, query_text: Union[str, List[str]], results: List[Dict], score: float=0.6) -> List[Dict]:
         """
         Reordena los resultados usando un modelo CrossEncoder (self.reranker).
+        query_text es la consulta o, si es una lista, la consulta con la que se puntúa cada resultado.
         Cada resultado es un diccionario con 
         {
+            'id': ...,
             'document': ...,
             'metadata': ...,
             'distance': ...
@@ -327,20 +1255,11 @@ class VectorEmbeddings:
             return results
         
         #Crear los pares (texto consulta - documento) para el modelo CrossEncoder
-        pairs = [(query_text, r['document']) for r in results]
-        
-        #Obtener las puntuaciones de proximidad
-        scores = self.reranker.predict(pairs)
-        
-        # Asociar las puntuaciones a los resultados y reordenarlos
-        for i,r in enumerate(results):
-            r["rerank_score"]=float(scores[i])
+        query_texts = [query_text] * len(results) if isinstance(query_text, str) else query_text
+        pairs = [(q, r['document']) for q, r in zip(query_texts, results)]
         
-        #Ordenar los resultados por relevancia descendente
-        results.sort(key=lambda x: x["rerank_score"], reverse=True)
-        
-        #Se queda con los resultados que hayan obtenido un rerank_score superior a la variable "score" que se introduce cuando se invoca al método
-        selected_results = [r for r in results if r["rerank_score"] > score]
+        #Obtener las puntuaciones de proximidad, agrupando los pares por longitud en tokens
+        scores = self.rerank_engine.score(pairs)
 
-        return selected_results
-    
+        #Ordenar por relevancia descendente y quedarse con los que superan el umbral "score" que se introduce cuando se invoca al método
+        return self.rerank_engine.select(results, scores, score)
@@ -0,0 +1,188 @@
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Dict
+
+# Prioridades de la cola: los hilos que ya están en curso pasan antes que las conversaciones nuevas
+PRIORITY_CONTINUING = 0
+PRIORITY_NEW = 1
+
+
+class AdmissionRejected(Exception):
+    """Petición rechazada por la capa de admisión (429 por límite de cliente, 503 por saturación)."""
+
+    def __init__(self, status_code: int, detail: str, retry_after: int):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Límite de peticiones por cliente: rate peticiones por segundo con ráfagas de hasta burst."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def idle_since(self, now: float) -> bool:
+        """True si lleva sin usarse lo suficiente para haberse rellenado: descartarlo no cambia nada."""
+        return now - self.updated >= self.capacity / self.rate
+
+    def take(self) -> float:
+        """Consume un token. Devuelve 0 si había token o los segundos hasta que haya uno."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class AdmissionController:
+    """
+    Capa de admisión para /generate-response.
+
+    Limita el número de conversaciones que se ejecutan a la vez y encola el resto en una cola acotada
+    con prioridad (hilos en curso antes que hilos nuevos). Rechaza de inmediato con 429 a los clientes
+    que superan su límite y con 503 cuando la cola está llena o la espera estimada superaría el SLO,
+    indicando en ambos casos cuándo reintentar. Todas las operaciones se hacen en el bucle de eventos,
+    por lo que no necesita locks.
+    """
+
+    def __init__(self,
+                 max_concurrency: int = 4,
+                 max_queue: int = 64,
+                 slo_wait_s: float = 20.0,
+                 rate_per_minute: float = 30.0,
+                 burst: int = 10,
+                 initial_service_time_s: float = 8.0,
+                 max_clients: int = 10000):
+        """
+        Args:
+            max_concurrency: Conversaciones ejecutándose a la vez
+            max_queue: Peticiones que pueden esperar en cola
+            slo_wait_s: Espera máxima en cola admitida; por encima se responde 503
+            rate_per_minute: Peticiones por minuto permitidas a cada cliente
+            burst: Ráfaga máxima de peticiones de un cliente
+            initial_service_time_s: Duración estimada de una conversación hasta tener mediciones
+            max_clients: Clientes con límite propio en memoria; por encima se descartan los usados hace más tiempo
+        """
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.slo_wait_s = slo_wait_s
+        self.rate = rate_per_minute / 60.0
+        self.burst = burst
+        self.service_time_s = initial_service_time_s
+        self.in_flight = 0
+        self.queue = []
+        self.sequence = itertools.count()
+        self.max_clients = max_clients
+        # Ordenados por último uso: los primeros son los candidatos a descartar
+        self.buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        self.wait_times = deque(maxlen=500)
+        self.counters = {"admitted": 0, "rejected_rate_limit": 0, "rejected_overload": 0, "expired_in_queue": 0}
+
+    def estimated_wait(self) -> float:
+        """Espera estimada para una petición que llegue ahora, según la cola y la duración media."""
+        ahead = len(self.queue) + max(0, self.in_flight - self.max_concurrency + 1)
+        return math.ceil(ahead / self.max_concurrency) * self.service_time_s if ahead else 0.0
+
+    def _reject(self, status_code: int, detail: str, retry_after: float, counter: str):
+        self.counters[counter] += 1
+        raise AdmissionRejected(status_code, detail, max(1, math.ceil(retry_after)))
+
+    def _evict_buckets(self, now: float):
+        # Los límites que ya se han rellenado son equivalentes a uno nuevo y se pueden descartar
+        while self.buckets:
+            bucket = next(iter(self.buckets.values()))
+            if len(self.buckets) <= self.max_clients and not bucket.idle_since(now):
+                return
+            self.buckets.popitem(last=False)
+
+    def check_rate_limit(self, client_id: str):
+        """Consume una petición del límite del cliente o lanza AdmissionRejected (429), sin reservar plaza."""
+        bucket = self.buckets.get(client_id)
+        if bucket is None:
+            bucket = self.buckets[client_id] = TokenBucket(self.rate, self.burst)
+        else:
+            self.buckets.move_to_end(client_id)
+        wait = bucket.take()
+        self._evict_buckets(time.monotonic())
+        if wait > 0:
+            self._reject(429, "Demasiadas peticiones, inténtelo de nuevo más tarde", wait, "rejected_rate_limit")
+
+    async def _acquire(self, client_id: str, priority: int):
+        self.check_rate_limit(client_id)
+
+        if self.in_flight < self.max_concurrency and not self.queue:
+            self.in_flight += 1
+            self.wait_times.append(0.0)
+            return
+
+        estimated = self.estimated_wait()
+        if len(self.queue) >= self.max_queue or estimated > self.slo_wait_s:
+            self._reject(503, "Servicio saturado, inténtelo de nuevo más tarde", estimated, "rejected_overload")
+
+        future = asyncio.get_running_loop().create_future()
+        entry = [priority, next(self.sequence), future]
+        heapq.heappush(self.queue, entry)
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=self.slo_wait_s)
+        except asyncio.TimeoutError:
+            if not future.done():
+                self.queue.remove(entry)
+                heapq.heapify(self.queue)
+                self._reject(503, "Tiempo de espera en cola agotado", self.estimated_wait(), "expired_in_queue")
+        except asyncio.CancelledError:
+            # El cliente se ha desconectado: si ya se le había asignado la plaza hay que liberarla
+            if future.done():
+                self._release()
+            else:
+                self.queue.remove(entry)
+                heapq.heapify(self.queue)
+            raise
+        self.wait_times.append(time.monotonic() - start)
+
+    def _release(self):
+        # La plaza pasa directamente a la siguiente petición de la cola, si la hay
+        while self.queue:
+            _, _, future = heapq.heappop(self.queue)
+            if not future.done():
+                future.set_result(True)
+                return
+        self.in_flight -= 1
+
+    @asynccontextmanager
+    async def slot(self, client_id: str, priority: int = PRIORITY_NEW):
+        """Reserva una plaza de ejecución para la petición o lanza AdmissionRejected."""
+        await self._acquire(client_id, priority)
+        self.counters["admitted"] += 1
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            self.service_time_s = 0.8 * self.service_time_s + 0.2 * elapsed
+            self._release()
+
+    def metrics(self) -> Dict:
+        waits = sorted(self.wait_times)
+        return {
+            "queue_depth": len(self.queue),
+            "in_flight": min(self.in_flight, self.max_concurrency),
+            "estimated_wait_s": self.estimated_wait(),
+            "service_time_s": self.service_time_s,
+            "wait_p50_s": waits[len(waits) // 2] if waits else 0.0,
+            "rate_limited_clients": len(self.buckets),
+            "wait_p95_s": waits[min(len(waits) - 1, int(0.95 * len(waits)))] if waits else 0.0,
+            **self.counters,
+        }
@@ -2,23 +2,112 @@ import sqlite3
 import json
 import datetime
 import os
+import re
+import threading
+import zlib
 from typing import List, Dict, Any, Optional
 from pathlib import Path
 
+from src.profiling import traced
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Columnas de texto grandes que se pueden guardar comprimidas. pregunta y revision se guardan siempre en
+# claro porque las leen directamente los endpoints de main.py
+COMPRESSED_COLUMNS = ("contexto", "respuesta")
+# Prefijo de los valores comprimidos (BLOB) según el códec
+CODEC_PREFIXES = {"zlib": b"z:", "zstd": b"s:"}
+
+# Palabras vacías que se descartan al convertir una búsqueda en lenguaje natural en una consulta FTS5
+SEARCH_STOPWORDS = {
+    "a", "al", "ante", "con", "cual", "cuál", "de", "del", "el", "en", "es", "la", "las", "lo", "los",
+    "para", "por", "que", "qué", "quien", "quién", "se", "sobre", "su", "un", "una", "y", "o",
+}
+
+
+def fts_query(text: str, match_all: bool = False) -> str:
+    """
+    Convierte un texto libre en una consulta FTS5 segura: cada palabra se cita (así los signos como ¿?
+    o los operadores de FTS5 no provocan errores de sintaxis) y se combinan con OR (o AND si match_all).
+    """
+    words = [w for w in re.findall(r"\w+", text.lower()) if w not in SEARCH_STOPWORDS]
+    return (" AND " if match_all else " OR ").join(f'"{w}"' for w in words)
+
+
+def search_conversations(conn: sqlite3.Connection, query: str, limit: int = 20, offset: int = 0,
+                         thread_id: str = None, match_all: bool = False) -> Dict[str, Any]:
+    """
+    Búsqueda de texto completo en pregunta, consulta_RAG y revision, ordenada por relevancia (bm25).
+
+    Args:
+        conn: Conexión a la base de datos del historial
+        query: Texto a buscar
+        limit: Resultados por página
+        offset: Resultados que se saltan (paginación)
+        thread_id: Limitar la búsqueda a un hilo
+        match_all: Exigir todas las palabras en lugar de cualquiera
+
+    Returns:
+        Diccionario con los resultados de la página y si hay más resultados
+    """
+    match = fts_query(query, match_all)
+    if not match:
+        return {"results": [], "has_more": False}
+    sql = '''
+        SELECT c.id, c.thread_id, c.pregunta, c.timestamp,
+               snippet(conversation_fts, 0, '<b>', '</b>', '…', 16) AS pregunta_resaltada,
+               snippet(conversation_fts, 2, '<b>', '</b>', '…', 32) AS fragmento_respuesta,
+               bm25(conversation_fts, 3.0, 1.0, 1.0) AS rank
+        FROM conversation_fts
+        JOIN conversation_history c ON c.id = conversation_fts.rowid
+        WHERE conversation_fts MATCH ?
+    '''
+    params: List[Any] = [match]
+    if thread_id:
+        sql += " AND c.thread_id = ?"
+        params.append(thread_id)
+    # Se pide un resultado de más para saber si hay otra página sin contar todas las coincidencias
+    sql += " ORDER BY rank LIMIT ? OFFSET ?"
+    params += [limit + 1, offset]
+    rows = conn.execute(sql, params).fetchall()
+    columns = ["id", "thread_id", "pregunta", "timestamp", "pregunta_resaltada", "fragmento_respuesta", "rank"]
+    results = [dict(zip(columns, row)) for row in rows[:limit]]
+    return {"results": results, "has_more": len(rows) > limit}
+
+
 class ConversationHistoryManager:
     """Permite registrar y recuperar la historia de conversaciones de los usuarios."""
 
-    def __init__(self, db_name="conversation_history.db"):
+    def __init__(self, db_name="conversation_history.db", compression: str = "zlib", compress_min_bytes: int = 512):
+        """
+        Args:
+            db_name: Fichero de la base de datos dentro de data/sqlite
+            compression: Compresión de contexto y respuesta: "none", "zlib" o "zstd" (si está instalado zstandard)
+            compress_min_bytes: Tamaño mínimo de un texto para guardarlo comprimido
+        """
+        if compression not in ("none", "zlib", "zstd"):
+            raise ValueError(f"Compresión no soportada: {compression}. Opciones: none, zlib, zstd")
+        if compression == "zstd" and zstandard is None:
+            print("zstandard not installed, falling back to zlib compression")
+            compression = "zlib"
+        self.compression = compression
+        self.compress_min_bytes = compress_min_bytes
         # Crear la carpeta data/sqlite si no existe
         data_dir = Path(__file__).resolve().parent.parent / "data" / "sqlite"
         data_dir.mkdir(parents=True, exist_ok=True)
         
         # Ruta completa a la base de datos
         db_path = data_dir / db_name
+        self.db_path = db_path
         
-        # Crear/conectar a la base de datos
-        self.conn = sqlite3.connect(str(db_path))
+        # Crear/conectar a la base de datos. La conexión se comparte entre hilos (p.ej. en las
+        # consultas en lote), por lo que todos los accesos se serializan con un lock
+        self.conn = sqlite3.connect(str(db_path), check_same_thread=False)
         self.cursor = self.conn.cursor()
+        self.lock = threading.RLock()
         
         # Configurar la base de datos
         self._setup_db()
@@ -47,52 +136,149 @@ class ConversationHistoryManager:
         self.cursor.execute('''
         CREATE INDEX IF NOT EXISTS idx_thread_id ON conversation_history(thread_id)
         ''')
+
+        # Bases de datos anteriores: los fragmentos recuperados (ids de chunk y rerank score) se guardan
+        # en lugar del contexto completo
+        columns = [row[1] for row in self.cursor.execute("PRAGMA table_info(conversation_history)")]
+        if "fragmentos" not in columns:
+            self.cursor.execute("ALTER TABLE conversation_history ADD COLUMN fragmentos TEXT")
+
+        self._setup_fts()
         
         self.conn.commit()
 
-    def log_interaction(self, thread_id: str, pregunta: str, tipo: str, contenido: str, consulta_RAG: str, plan: str, contexto: str, respuesta: str, revision: str) -> None:
+    def _setup_fts(self):
+        """
+        Índice FTS5 de contenido externo sobre pregunta, consulta_RAG y revision, sincronizado con triggers.
+        El índice no duplica los textos: los lee de conversation_history cuando hace falta.
+
+        Si se crea sobre un historial con filas, se llena en la misma transacción: un índice de contenido
+        externo vacío no tiene las entradas que borran los triggers y SQLite lo da por corrupto.
+        """
+        exists = self.cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'conversation_fts'"
+        ).fetchone()
+        backfill = not exists and self.cursor.execute("SELECT 1 FROM conversation_history LIMIT 1").fetchone()
+        self.cursor.executescript('''
+        BEGIN;
+        CREATE VIRTUAL TABLE IF NOT EXISTS conversation_fts USING fts5(
+            pregunta, consulta_RAG, revision,
+            content='conversation_history', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        );
+        CREATE TRIGGER IF NOT EXISTS conversation_fts_insert AFTER INSERT ON conversation_history BEGIN
+            INSERT INTO conversation_fts(rowid, pregunta, consulta_RAG, revision)
+            VALUES (new.id, new.pregunta, new.consulta_RAG, new.revision);
+        END;
+        CREATE TRIGGER IF NOT EXISTS conversation_fts_delete AFTER DELETE ON conversation_history BEGIN
+            INSERT INTO conversation_fts(conversation_fts, rowid, pregunta, consulta_RAG, revision)
+            VALUES ('delete', old.id, old.pregunta, old.consulta_RAG, old.revision);
+        END;
+        CREATE TRIGGER IF NOT EXISTS conversation_fts_update AFTER UPDATE OF pregunta, consulta_RAG, revision ON conversation_history BEGIN
+            INSERT INTO conversation_fts(conversation_fts, rowid, pregunta, consulta_RAG, revision)
+            VALUES ('delete', old.id, old.pregunta, old.consulta_RAG, old.revision);
+            INSERT INTO conversation_fts(rowid, pregunta, consulta_RAG, revision)
+            VALUES (new.id, new.pregunta, new.consulta_RAG, new.revision);
+        END;
+        ''' + ("INSERT INTO conversation_fts(conversation_fts) VALUES ('rebuild');" if backfill else "") + "COMMIT;")
+        if backfill:
+            print("Full-text index created and filled from the existing history")
+
+    def rebuild_fts(self) -> None:
+        """Reconstruye el índice de texto completo a partir de todas las filas del historial."""
+        with self.lock:
+            self.cursor.execute("INSERT INTO conversation_fts(conversation_fts) VALUES ('rebuild')")
+            self.cursor.execute("INSERT INTO conversation_fts(conversation_fts) VALUES ('optimize')")
+            self.conn.commit()
+        print("Full-text index rebuilt")
+
+    def search(self, query: str, limit: int = 20, offset: int = 0, thread_id: str = None, match_all: bool = False) -> Dict[str, Any]:
+        """Búsqueda de texto completo en el historial (ver search_conversations)."""
+        with self.lock:
+            return search_conversations(self.conn, query, limit, offset, thread_id, match_all)
+
+    # ------------------------------------------------------------------
+    # Compresión de columnas grandes
+    # ------------------------------------------------------------------
+    def _compress(self, text: Optional[str]):
+        """Comprime el texto con el códec configurado si supera el tamaño mínimo."""
+        if not text or self.compression == "none":
+            return text
+        data = text.encode("utf-8")
+        if len(data) < self.compress_min_bytes:
+            return text
+        if self.compression == "zstd":
+            return CODEC_PREFIXES["zstd"] + zstandard.ZstdCompressor(level=10).compress(data)
+        return CODEC_PREFIXES["zlib"] + zlib.compress(data, 6)
+
+    @staticmethod
+    def _decompress(value) -> Optional[str]:
+        """Devuelve el texto de una columna, esté guardada en claro o comprimida."""
+        if not isinstance(value, bytes):
+            return value
+        prefix, data = value[:2], value[2:]
+        if prefix == CODEC_PREFIXES["zlib"]:
+            return zlib.decompress(data).decode("utf-8")
+        if prefix == CODEC_PREFIXES["zstd"]:
+            if zstandard is None:
+                raise RuntimeError("El historial contiene textos comprimidos con zstd y zstandard no está instalado")
+            return zstandard.ZstdDecompressor().decompress(data).decode("utf-8")
+        return value.decode("utf-8")
+
+    @traced("sqlite:history.log")
+    def log_interaction(self, thread_id: str, pregunta: str, tipo: str, contenido: str, consulta_RAG: str, plan: str, contexto: str, respuesta: str, revision: str, fragmentos: List[Dict] = None) -> None:
         """
         Realiza un log de cada interacción del usuario con el sistema de agentes.
+
+        Si se indican los fragmentos recuperados (id del chunk y rerank score) se guardan en lugar del
+        contexto, que se puede reconstruir después desde el almacén vectorial.
         """
         timestamp = datetime.datetime.now().isoformat()
+        if fragmentos is not None:
+            fragmentos = json.dumps(fragmentos)
+            contexto = None
         
-        self.cursor.execute(
-            "INSERT INTO conversation_history (thread_id, pregunta, tipo, contenido, consulta_RAG, plan, contexto, respuesta, revision, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-            (thread_id, pregunta, tipo, contenido, consulta_RAG, plan, contexto, respuesta, revision, timestamp)
-        )
-        
-        self.conn.commit()
+        with self.lock:
+            self.cursor.execute(
+                "INSERT INTO conversation_history (thread_id, pregunta, tipo, contenido, consulta_RAG, plan, contexto, respuesta, revision, timestamp, fragmentos) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (thread_id, pregunta, tipo, contenido, consulta_RAG, plan, self._compress(contexto), self._compress(respuesta), revision, timestamp, fragmentos)
+            )
+            
+            self.conn.commit()
         
         print(f"Logged interaction for thread: {thread_id}")
 
-    def get_conversation_history(self, thread_id: str) -> List[Dict[str, str]]:
+    @traced("sqlite:history.get")
+    def get_conversation_history(self, thread_id: str, include_payload: bool = True) -> List[Dict[str, str]]:
         """
         Recupera registros a partir del id del hilo.
         
         Args:
             thread_id: Identificador único del hilo.
+            include_payload: Si se leen también contexto, respuesta y fragmentos. Sin ellos la consulta
+                no tiene que recorrer (ni descomprimir) las columnas grandes
             
         Returns:
             Los registros de conversaciones anteriores.
         """
-        self.cursor.execute(
-            "SELECT * FROM conversation_history WHERE thread_id = ? ORDER BY timestamp",
-            (thread_id,)
-        )
+        columns = ["pregunta", "tipo", "contenido", "consulta_RAG", "plan", "revision", "timestamp"]
+        if include_payload:
+            columns += ["contexto", "respuesta", "fragmentos"]
+        with self.lock:
+            self.cursor.execute(
+                f"SELECT {', '.join(columns)} FROM conversation_history WHERE thread_id = ? ORDER BY timestamp",
+                (thread_id,)
+            )
+            rows = self.cursor.fetchall()
         
         history = []
-        for row in self.cursor.fetchall():
-            history.append({
-                "pregunta": row[1],
-                "tipo": row[2],
-                "contenido": row[3],
-                "consulta_RAG": row[4],
-                "plan": row[5],
-                "contexto": row[6],
-                "respuesta": row[7],
-                "revision": row[8],
-                "timestamp": row[9]
-            })
+        for row in rows:
+            interaction = dict(zip(columns, row))
+            if include_payload:
+                interaction["contexto"] = self._decompress(interaction["contexto"])
+                interaction["respuesta"] = self._decompress(interaction["respuesta"])
+                interaction["fragmentos"] = json.loads(interaction["fragmentos"]) if interaction["fragmentos"] else []
+            history.append(interaction)
 
         print(f"Retrieved {len(history)} interactions for thread: {thread_id}")
         return history
@@ -107,13 +293,14 @@ class ConversationHistoryManager:
         Returns:
             Número de registros eliminados.
         """
-        self.cursor.execute(
-            "DELETE FROM conversation_history WHERE thread_id = ?",
-            (thread_id,)
-        )
-        
-        deleted_count = self.cursor.rowcount
-        self.conn.commit()
+        with self.lock:
+            self.cursor.execute(
+                "DELETE FROM conversation_history WHERE thread_id = ?",
+                (thread_id,)
+            )
+            
+            deleted_count = self.cursor.rowcount
+            self.conn.commit()
         
         print(f"Deleted {deleted_count} interactions for thread: {thread_id}")
         return deleted_count
@@ -125,13 +312,104 @@ class ConversationHistoryManager:
         Returns:
             List of thread IDs
         """
-        self.cursor.execute(
-            "SELECT DISTINCT thread_id FROM conversation_history"
-        )
-        
-        thread_ids = [row[0] for row in self.cursor.fetchall()]
+        with self.lock:
+            self.cursor.execute(
+                "SELECT DISTINCT thread_id FROM conversation_history"
+            )
+            
+            thread_ids = [row[0] for row in self.cursor.fetchall()]
         return thread_ids
 
+    # ------------------------------------------------------------------
+    # Migración, retención y compactación
+    # ------------------------------------------------------------------
+    def compress_existing(self, batch_size: int = 500) -> int:
+        """
+        Migra los registros antiguos: comprime contexto y respuesta de las filas guardadas en claro.
+
+        Returns:
+            Número de filas reescritas
+        """
+        if self.compression == "none":
+            return 0
+        updated = 0
+        last_id = 0
+        while True:
+            with self.lock:
+                rows = self.cursor.execute(
+                    "SELECT id, contexto, respuesta FROM conversation_history WHERE id > ? ORDER BY id LIMIT ?",
+                    (last_id, batch_size)
+                ).fetchall()
+                if not rows:
+                    break
+                changes = []
+                for id_, contexto, respuesta in rows:
+                    new_contexto = contexto if isinstance(contexto, bytes) else self._compress(contexto)
+                    new_respuesta = respuesta if isinstance(respuesta, bytes) else self._compress(respuesta)
+                    if new_contexto is not contexto or new_respuesta is not respuesta:
+                        changes.append((new_contexto, new_respuesta, id_))
+                self.cursor.executemany("UPDATE conversation_history SET contexto = ?, respuesta = ? WHERE id = ?", changes)
+                self.conn.commit()
+            updated += len(changes)
+            last_id = rows[-1][0]
+        print(f"Compressed {updated} interactions")
+        return updated
+
+    def _threads_inactive_since(self, days: int) -> List[str]:
+        """Hilos cuya última interacción es anterior a hace days días."""
+        cutoff = (datetime.datetime.now() - datetime.timedelta(days=days)).isoformat()
+        with self.lock:
+            self.cursor.execute(
+                "SELECT thread_id FROM conversation_history GROUP BY thread_id HAVING MAX(timestamp) < ?",
+                (cutoff,)
+            )
+            return [row[0] for row in self.cursor.fetchall()]
+
+    def compact_threads(self, older_than_days: int) -> int:
+        """
+        Compacta los hilos inactivos: elimina contexto y respuesta intermedia y conserva la pregunta, la
+        respuesta final (revision) y los ids de los fragmentos, que son lo que se muestra y se usa como historial.
+
+        Returns:
+            Número de interacciones compactadas
+        """
+        thread_ids = self._threads_inactive_since(older_than_days)
+        compacted = 0
+        with self.lock:
+            for batch_start in range(0, len(thread_ids), 500):
+                batch = thread_ids[batch_start:batch_start + 500]
+                placeholders = ",".join("?" * len(batch))
+                self.cursor.execute(
+                    f"UPDATE conversation_history SET contexto = NULL, respuesta = NULL, plan = NULL "
+                    f"WHERE thread_id IN ({placeholders}) AND (contexto IS NOT NULL OR respuesta IS NOT NULL OR plan IS NOT NULL)",
+                    batch
+                )
+                compacted += self.cursor.rowcount
+            self.conn.commit()
+        print(f"Compacted {compacted} interactions from {len(thread_ids)} threads inactive for {older_than_days} days")
+        return compacted
+
+    def purge_threads(self, older_than_days: int) -> int:
+        """
+        Elimina por completo los hilos sin actividad en los últimos older_than_days días.
+
+        Returns:
+            Número de interacciones eliminadas
+        """
+        deleted = 0
+        for thread_id in self._threads_inactive_since(older_than_days):
+            deleted += self.delete_thread_history(thread_id)
+        return deleted
+
+    def vacuum(self) -> None:
+        """Devuelve al sistema el espacio liberado y actualiza las estadísticas del planificador."""
+        with self.lock:
+            size_before = os.path.getsize(self.db_path)
+            self.conn.execute("VACUUM")
+            self.conn.execute("ANALYZE")
+            size_after = os.path.getsize(self.db_path)
+        print(f"Vacuumed {self.db_path}: {size_before / 1e6:.1f} MB -> {size_after / 1e6:.1f} MB")
+
     def close(self):
         """Close the database connection properly"""
         if self.conn:
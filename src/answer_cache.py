@@ -0,0 +1,205 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from src.profiling import traced
+
+
+class AnswerCache:
+    """
+    Caché persistente de respuestas completas del grafo para preguntas sin historial previo.
+
+    Cada entrada guarda la pregunta, su embedding, la clasificación del triaje, la consulta reformulada,
+    los fragmentos recuperados con su puntuación del rerank y la respuesta final, junto con la versión
+    del corpus con la que se generó: al cambiar el corpus las entradas dejan de servirse. Se busca primero
+    por la pregunta normalizada y, una vez hecho el triaje, por similitud coseno con las preguntas guardadas.
+    Dos preguntas casi idénticas pueden pedir cosas distintas ("... en Madrid" / "... en Andalucía", otro
+    año u otro importe), así que un acierto por similitud exige además los mismos temas del triaje y las
+    mismas cifras en la pregunta.
+
+    Args:
+        db_path: Base de datos SQLite de la caché
+        similarity_threshold: Similitud coseno mínima entre preguntas para servir una respuesta guardada
+    """
+
+    def __init__(self, db_path: str = "./data/sqlite/answer_cache.db", similarity_threshold: float = 0.97):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.similarity_threshold = similarity_threshold
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        # Embeddings de las preguntas de la versión del corpus en uso, para la búsqueda por similitud
+        self._version = None
+        self._keys: List[str] = []
+        self._matrix = np.zeros((0, 0), dtype=np.float32)
+        self.stats = {"hits": 0, "misses": 0, "semantic_hits": 0, "semantic_misses": 0}
+        with self.lock:
+            self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS answers (
+                corpus_version TEXT NOT NULL,
+                question_key TEXT NOT NULL,
+                pregunta TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                tipo TEXT,
+                contenido TEXT,
+                consulta_RAG TEXT,
+                fragmentos TEXT,
+                respuesta TEXT,
+                revision TEXT NOT NULL,
+                source TEXT NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0,
+                created_at TEXT NOT NULL,
+                PRIMARY KEY (corpus_version, question_key)
+            )
+            ''')
+            self.conn.commit()
+
+    @staticmethod
+    def question_key(question: str) -> str:
+        """Hash de la pregunta sin mayúsculas, tildes, signos de puntuación ni espacios repetidos."""
+        text = unicodedata.normalize("NFKD", question.lower())
+        text = "".join(c for c in text if not unicodedata.combining(c))
+        text = " ".join(re.findall(r"\w+", text))
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def topics(contenido: Optional[str]) -> List[str]:
+        """Temas de la clasificación del triaje ("GENERAL; ITPAJD; CANTABRIA"), sin orden ni mayúsculas."""
+        return sorted({topic.strip().upper() for topic in (contenido or "").split(";") if topic.strip()})
+
+    @staticmethod
+    def numbers(question: str) -> List[str]:
+        """Cifras de la pregunta (años, importes, porcentajes), sin separadores de miles."""
+        text = re.sub(r"(?<=\d)\.(?=\d{3}\b)", "", question)
+        return sorted(number.replace(",", ".") for number in re.findall(r"\d+(?:[.,]\d+)?", text))
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def _load(self, corpus_version: str) -> None:
+        """Carga en memoria los embeddings de las preguntas de una versión del corpus (con el lock tomado)."""
+        rows = self.conn.execute(
+            "SELECT question_key, embedding FROM answers WHERE corpus_version = ?", (corpus_version,)
+        ).fetchall()
+        self._version = corpus_version
+        self._keys = [row["question_key"] for row in rows]
+        self._matrix = (np.stack([np.frombuffer(row["embedding"], dtype=np.float32) for row in rows])
+                        if rows else np.zeros((0, 0), dtype=np.float32))
+
+    @traced("sqlite:answer_cache.get")
+    def get(self, question: str, embedding, corpus_version: str, contenido: Optional[str] = None) -> Optional[Dict]:
+        """
+        Busca una respuesta guardada para la pregunta con la versión del corpus indicada.
+
+        Sin contenido solo se sirve la misma pregunta normalizada. Con la clasificación del triaje en
+        contenido se busca la pregunta guardada más parecida por encima del umbral que tenga los mismos
+        temas y las mismas cifras.
+
+        Returns:
+            La entrada con sus campos (fragmentos como lista de {id, score}) y 'similarity', o None
+        """
+        key = self.question_key(question)
+        semantic = contenido is not None
+        hit, miss = ("semantic_hits", "semantic_misses") if semantic else ("hits", "misses")
+        with self.lock:
+            # Las entradas que añade el precalentamiento desde otro proceso se detectan por el número de filas
+            count = self.conn.execute("SELECT COUNT(*) FROM answers WHERE corpus_version = ?", (corpus_version,)).fetchone()[0]
+            if self._version != corpus_version or count != len(self._keys):
+                self._load(corpus_version)
+            row, similarity = None, 1.0
+            if key in self._keys:
+                row = self.conn.execute(
+                    "SELECT * FROM answers WHERE corpus_version = ? AND question_key = ?", (corpus_version, key)
+                ).fetchone()
+            elif semantic and self._keys:
+                row, similarity = self._similar(question, embedding, corpus_version, contenido)
+            if row is None:
+                self.stats[miss] += 1
+                return None
+            self.conn.execute("UPDATE answers SET hits = hits + 1 WHERE corpus_version = ? AND question_key = ?",
+                              (corpus_version, row["question_key"]))
+            self.conn.commit()
+            self.stats[hit] += 1
+        entry = dict(row)
+        entry.pop("embedding")
+        entry["fragmentos"] = json.loads(entry["fragmentos"] or "[]")
+        entry["similarity"] = similarity
+        return entry
+
+    def _similar(self, question: str, embedding, corpus_version: str, contenido: str):
+        """Entrada más parecida por encima del umbral con los mismos temas y cifras (con el lock tomado)."""
+        topics, numbers = self.topics(contenido), self.numbers(question)
+        similarities = self._matrix @ self._normalize(embedding)
+        for index in np.argsort(-similarities):
+            similarity = float(similarities[index])
+            if similarity < self.similarity_threshold:
+                break
+            row = self.conn.execute(
+                "SELECT * FROM answers WHERE corpus_version = ? AND question_key = ?", (corpus_version, self._keys[index])
+            ).fetchone()
+            if row is not None and self.topics(row["contenido"]) == topics and self.numbers(row["pregunta"]) == numbers:
+                return row, similarity
+        return None, 0.0
+
+    @traced("sqlite:answer_cache.put")
+    def put(self, question: str, embedding, corpus_version: str, result: Dict, source: str = "live") -> None:
+        """Guarda el resultado del grafo para una pregunta (solo los campos necesarios para servirlo)."""
+        key = self.question_key(question)
+        vector = self._normalize(embedding)
+        fragmentos = [{"id": f["id"], "score": f.get("rerank_score")} for f in result.get("fragmentos") or []]
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO answers (corpus_version, question_key, pregunta, embedding, tipo, contenido, consulta_RAG, "
+                "fragmentos, respuesta, revision, source, hits, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0, ?)",
+                (corpus_version, key, question, vector.tobytes(), result.get("tipo"), result.get("contenido"),
+                 result.get("consulta_RAG"), json.dumps(fragmentos, ensure_ascii=False), result.get("respuesta"),
+                 result["revision"], source, datetime.now().isoformat())
+            )
+            self.conn.commit()
+            if self._version == corpus_version and key not in self._keys:
+                self._keys.append(key)
+                self._matrix = vector[None, :] if not self._matrix.size else np.vstack([self._matrix, vector])
+
+    def has(self, question: str, corpus_version: str) -> bool:
+        """Indica si ya hay una respuesta guardada para esta misma pregunta y versión del corpus."""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT 1 FROM answers WHERE corpus_version = ? AND question_key = ?",
+                (corpus_version, self.question_key(question))
+            ).fetchone() is not None
+
+    def purge_stale(self, corpus_version: str) -> int:
+        """Elimina las entradas generadas con versiones anteriores del corpus."""
+        with self.lock:
+            deleted = self.conn.execute("DELETE FROM answers WHERE corpus_version != ?", (corpus_version,)).rowcount
+            self.conn.commit()
+        print(f"Answer cache: deleted {deleted} entries from previous corpus versions")
+        return deleted
+
+    def summary(self, corpus_version: str = None) -> Dict:
+        with self.lock:
+            summary = dict(self.stats)
+            if corpus_version:
+                summary["entries"] = self.conn.execute(
+                    "SELECT COUNT(*) FROM answers WHERE corpus_version = ?", (corpus_version,)
+                ).fetchone()[0]
+                summary["corpus_version"] = corpus_version
+        # Cada pregunta pasa por la búsqueda exacta; las que fallan y son consultas, también por la semántica
+        lookups = summary["hits"] + summary["misses"]
+        summary["hit_rate"] = (summary["hits"] + summary["semantic_hits"]) / lookups if lookups else 0.0
+        return summary
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
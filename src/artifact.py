@@ -0,0 +1,185 @@
+"""
+Artefactos precompilados de la colección vectorial para desplegar nodos sin repetir la ingesta.
+
+Un artefacto es un directorio con:
+    manifest.json   versión del formato, colección, modelo de embeddings, parámetros de chunking,
+                    número de chunks, dimensión y sha256 de cada fichero
+    vectors.npy     embeddings en float32 (se leen con memory mapping al importar)
+    records.jsonl   id, texto y metadata de cada chunk, en el mismo orden que los vectores
+    links.jsonl     chunks casi duplicados enlazados a un chunk canónico (ver src/dedup.py), con su texto
+                    y metadata; no está en los artefactos de la versión 1
+
+La importación comprueba las sumas de verificación y rechaza artefactos generados con otro modelo.
+
+Uso:
+    python -m src.artifact export --collection normativa_tributaria-RAG --output ./data/artifacts/normativa
+    python -m src.artifact import --artifact ./data/artifacts/normativa --backend memmap --replace
+"""
+import argparse
+import hashlib
+import json
+import os
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+import numpy as np
+
+ARTIFACT_VERSION = 2
+# Versiones que se pueden importar: la 1 no incluye los enlaces de duplicados
+SUPPORTED_VERSIONS = (1, 2)
+MANIFEST_FILE = "manifest.json"
+VECTORS_FILE = "vectors.npy"
+RECORDS_FILE = "records.jsonl"
+LINKS_FILE = "links.jsonl"
+
+
+def file_sha256(path: str, block_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def write_artifact(path: str, collection, collection_name: str, model_id: str, chunk_params: Dict, page_size: int = 1000,
+                   links: Iterable[Dict] = None) -> Dict:
+    """
+    Vuelca una colección (Chroma o MemmapCollection) a un artefacto en el directorio indicado.
+
+    Args:
+        path: Directorio de salida (se crea si no existe)
+        collection: Colección de origen
+        collection_name: Nombre de la colección, se guarda en el manifiesto
+        model_id: Modelo con el que se calcularon los embeddings
+        chunk_params: Parámetros de chunking con los que se generaron los chunks
+        page_size: Registros que se leen de la colección en cada lote
+        links: Enlaces de duplicados de la colección, con el formato de NearDuplicateIndex.iter_links
+
+    Returns:
+        El manifiesto del artefacto
+    """
+    os.makedirs(path, exist_ok=True)
+    count = collection.count()
+    if not count:
+        raise ValueError(f"La colección {collection_name} está vacía")
+
+    vectors = None
+    written = 0
+    with open(os.path.join(path, RECORDS_FILE), "w", encoding="utf-8") as records:
+        while written < count:
+            page = collection.get(include=["embeddings", "documents", "metadatas"], limit=page_size, offset=written)
+            if not page["ids"]:
+                break
+            embeddings = np.asarray(page["embeddings"], dtype=np.float32)
+            if vectors is None:
+                vectors = np.lib.format.open_memmap(os.path.join(path, VECTORS_FILE), mode="w+",
+                                                    dtype=np.float32, shape=(count, embeddings.shape[1]))
+            vectors[written:written + len(embeddings)] = embeddings
+            for id_, document, metadata in zip(page["ids"], page["documents"], page["metadatas"]):
+                records.write(json.dumps({"id": id_, "document": document, "metadata": metadata}, ensure_ascii=False) + "\n")
+            written += len(page["ids"])
+    if written != count:
+        raise RuntimeError(f"Se esperaban {count} chunks y se leyeron {written}; la colección cambió durante la exportación")
+    dim = int(vectors.shape[1])
+    vectors.flush()
+    del vectors
+    num_links = 0
+    with open(os.path.join(path, LINKS_FILE), "w", encoding="utf-8") as f:
+        for link in links or []:
+            f.write(json.dumps(link, ensure_ascii=False) + "\n")
+            num_links += 1
+
+    manifest = {
+        "format_version": ARTIFACT_VERSION,
+        "collection": collection_name,
+        "model_id": model_id,
+        "chunk_params": chunk_params,
+        "count": count,
+        "links": num_links,
+        "dim": dim,
+        "created": datetime.now().isoformat(),
+        "files": {name: file_sha256(os.path.join(path, name)) for name in (VECTORS_FILE, RECORDS_FILE, LINKS_FILE)},
+    }
+    with open(os.path.join(path, MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    print(f"Exported {count} chunks and {num_links} near-duplicate links of {collection_name} to {path}")
+    return manifest
+
+
+def read_artifact(path: str, verify: bool = True) -> Dict:
+    """Lee el manifiesto de un artefacto y, si verify, comprueba versión, tamaño y sumas de verificación."""
+    with open(os.path.join(path, MANIFEST_FILE), "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("format_version") not in SUPPORTED_VERSIONS:
+        raise ValueError(f"Versión de artefacto no soportada: {manifest.get('format_version')} (se esperan {SUPPORTED_VERSIONS})")
+    if verify:
+        for name, expected in manifest["files"].items():
+            if file_sha256(os.path.join(path, name)) != expected:
+                raise ValueError(f"Suma de verificación incorrecta en {name}: el artefacto está corrupto o incompleto")
+    vectors = np.load(os.path.join(path, VECTORS_FILE), mmap_mode="r")
+    if vectors.shape != (manifest["count"], manifest["dim"]):
+        raise ValueError(f"vectors.npy tiene forma {vectors.shape}, el manifiesto indica ({manifest['count']}, {manifest['dim']})")
+    return manifest
+
+
+def iter_artifact(path: str, batch_size: int = 1000) -> Iterator[Tuple[List[str], np.ndarray, List[str], List[Dict]]]:
+    """Recorre el artefacto en lotes de (ids, embeddings, documentos, metadatas) sin cargarlo entero en memoria."""
+    vectors = np.load(os.path.join(path, VECTORS_FILE), mmap_mode="r")
+    ids, documents, metadatas = [], [], []
+    start = 0
+    with open(os.path.join(path, RECORDS_FILE), "r", encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            ids.append(record["id"])
+            documents.append(record["document"])
+            metadatas.append(record["metadata"])
+            if len(ids) == batch_size:
+                yield ids, np.asarray(vectors[start:start + len(ids)]), documents, metadatas
+                start += len(ids)
+                ids, documents, metadatas = [], [], []
+    if ids:
+        yield ids, np.asarray(vectors[start:start + len(ids)]), documents, metadatas
+
+
+def iter_artifact_links(path: str, batch_size: int = 1000) -> Iterator[List[Dict]]:
+    """Recorre en lotes los enlaces de duplicados del artefacto (ninguno en los de la versión 1)."""
+    links_path = os.path.join(path, LINKS_FILE)
+    if not os.path.exists(links_path):
+        return
+    batch = []
+    with open(links_path, "r", encoding="utf-8") as f:
+        for line in f:
+            batch.append(json.loads(line))
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def main():
+    from src.RAG import VectorEmbeddings
+
+    parser = argparse.ArgumentParser(description="Exporta o importa artefactos precompilados de la colección vectorial")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser("export", help="Empaqueta la colección en un artefacto")
+    export_parser.add_argument("--collection", default="normativa_tributaria-RAG")
+    export_parser.add_argument("--backend", default="chroma", choices=["chroma", "memmap"])
+    export_parser.add_argument("--output", required=True)
+    import_parser = subparsers.add_parser("import", help="Carga un artefacto en la colección")
+    import_parser.add_argument("--artifact", required=True)
+    import_parser.add_argument("--collection", default=None, help="Colección destino (por defecto la del artefacto)")
+    import_parser.add_argument("--backend", default="chroma", choices=["chroma", "memmap"])
+    import_parser.add_argument("--replace", action="store_true", help="Sustituir el contenido actual de la colección")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        VectorEmbeddings(args.collection, backend=args.backend).export_artifact(args.output)
+    else:
+        manifest = read_artifact(args.artifact, verify=False)
+        legal_db = VectorEmbeddings(args.collection or manifest["collection"], backend=args.backend)
+        legal_db.import_artifact(args.artifact, replace=args.replace)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Compara el backend "memmap" (src/vector_store.py) con la colección de Chroma.
+
+Copia los vectores de la colección persistida en ./data/chroma/vec a colecciones memmap temporales
+(float16 e int8) y lanza las mismas consultas contra todos los backends, con y sin filtro por
+document_type, midiendo latencia, recall@k frente a la búsqueda exacta en float32 y tamaño en disco.
+Como consultas se usan vectores del propio corpus, por lo que no es necesario cargar los modelos.
+
+Uso:
+    python -m src.benchmark_vector_store --collection normativa_tributaria-RAG --queries 200
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from typing import Dict, List
+
+import chromadb
+import numpy as np
+
+from src.vector_store import MemmapCollection
+
+
+def directory_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def measure(collection, queries: np.ndarray, k: int, where: Dict = None) -> Dict:
+    """Lanza las consultas una a una y devuelve latencias (ms) e ids recuperados."""
+    latencies, retrieved = [], []
+    for query in queries:
+        start = time.perf_counter()
+        result = collection.query(query_embeddings=[query.tolist()], n_results=k, where=where, include=["distances"])
+        latencies.append((time.perf_counter() - start) * 1000)
+        retrieved.append(result["ids"][0])
+    return {"latencies": np.array(latencies), "ids": retrieved}
+
+
+def exact_search(embeddings: np.ndarray, ids: List[str], mask: np.ndarray, queries: np.ndarray, k: int) -> List[List[str]]:
+    """Búsqueda exacta en float32 que sirve de referencia para calcular el recall."""
+    matrix = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+    rows = np.flatnonzero(mask)
+    normalized = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    similarities = normalized @ matrix[rows].T
+    top = np.argsort(-similarities, axis=1)[:, :k]
+    return [[ids[rows[i]] for i in row] for row in top]
+
+
+def recall(retrieved: List[List[str]], truth: List[List[str]]) -> float:
+    hits = [len(set(r) & set(t)) / max(len(t), 1) for r, t in zip(retrieved, truth)]
+    return float(np.mean(hits))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del backend memmap frente a Chroma")
+    parser.add_argument("--collection", default="normativa_tributaria-RAG")
+    parser.add_argument("--chroma-path", default="./data/chroma/vec")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=50)
+    args = parser.parse_args()
+
+    client = chromadb.PersistentClient(path=args.chroma_path)
+    collection = client.get_collection(args.collection)
+    data = collection.get(include=["embeddings", "documents", "metadatas"])
+    embeddings = np.asarray(data["embeddings"], dtype=np.float32)
+    ids = data["ids"]
+    print(f"Colección {args.collection}: {len(ids)} chunks de dimensión {embeddings.shape[1]}")
+
+    rng = np.random.default_rng(0)
+    sample = rng.choice(len(ids), size=min(args.queries, len(ids)), replace=False)
+    # Se perturban los vectores para que las consultas no coincidan exactamente con un chunk
+    queries = embeddings[sample] + rng.normal(scale=0.01, size=(len(sample), embeddings.shape[1])).astype(np.float32)
+
+    document_types = [m.get("document_type") for m in data["metadatas"]]
+    most_common = max(set(document_types), key=document_types.count)
+    scenarios = {
+        "sin filtro": (None, np.ones(len(ids), dtype=bool)),
+        f"document_type = {most_common}": (
+            {"document_type": {"$in": [most_common]}},
+            np.array([t == most_common for t in document_types])
+        ),
+    }
+
+    tmp_dir = tempfile.mkdtemp(prefix="memmap_bench_")
+    try:
+        backends = {"chroma (HNSW)": (collection, None)}
+        for dtype in MemmapCollection.DTYPES:
+            memmap = MemmapCollection(path=tmp_dir, name=f"bench-{dtype}", dtype=dtype)
+            for start in range(0, len(ids), 1000):
+                memmap.add(
+                    ids=ids[start:start + 1000],
+                    embeddings=embeddings[start:start + 1000],
+                    documents=data["documents"][start:start + 1000],
+                    metadatas=data["metadatas"][start:start + 1000]
+                )
+            backends[f"memmap {dtype}"] = (memmap, directory_size(memmap.dir))
+
+        chroma_size = directory_size(args.chroma_path)
+        print(f"Tamaño en disco chroma (todas las colecciones): {chroma_size / 1e6:.1f} MB")
+        for name, (_, size) in backends.items():
+            if size is not None:
+                print(f"Tamaño en disco {name}: {size / 1e6:.1f} MB")
+
+        for scenario, (where, mask) in scenarios.items():
+            truth = exact_search(embeddings, ids, mask, queries, args.k)
+            print(f"\n== Consultas {scenario} (k={args.k}, {len(queries)} consultas) ==")
+            print(f"{'backend':<18} {'p50 ms':>8} {'p95 ms':>8} {'recall@k':>9}")
+            for name, (backend, _) in backends.items():
+                # Calentamiento para no medir la carga inicial del índice
+                measure(backend, queries[:5], args.k, where)
+                stats = measure(backend, queries, args.k, where)
+                print(f"{name:<18} {np.percentile(stats['latencies'], 50):>8.2f} "
+                      f"{np.percentile(stats['latencies'], 95):>8.2f} {recall(stats['ids'], truth):>9.3f}")
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+"""
+Índice de bloques del BOE para la recuperación jerárquica en dos niveles.
+
+Cada bloque (artículo, disposición, ...) de split_markdown_BOE tiene un único vector, la media de los
+embeddings de sus chunks, en una colección aparte ("<colección>-bloques") mucho más pequeña que la de
+chunks. La búsqueda jerárquica elige primero los bloques más cercanos a la consulta y después ordena
+por similitud exacta solo los chunks de esos bloques, de modo que las normas autonómicas con muchos
+artículos parecidos no desplazan a los candidatos relevantes y el rerank recibe menos pares.
+
+    build      (Re)construye el índice de bloques de una colección ya ingestada
+    benchmark  Compara la búsqueda plana y la jerárquica: latencia, pares re-rankeados y solapamiento
+
+Uso:
+    python -m src.block_index build --collection normativa_tributaria-RAG
+    python -m src.block_index benchmark --collection normativa_tributaria-RAG --n-blocks 20
+"""
+import argparse
+import re
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+
+BLOCK_NUMBER_PATTERN = re.compile(r"Bloque (\d+)")
+
+
+def block_id(document_id: str, block: str) -> str:
+    """Id del bloque en la colección de bloques: "LGT-block-25" para "[Bloque 25: #a20]"."""
+    match = BLOCK_NUMBER_PATTERN.search(block or "")
+    label = match.group(1) if match else re.sub(r"[^0-9A-Za-z]+", "_", block or "").strip("_")
+    return f"{document_id}-block-{label}"
+
+
+class BlockIndexBuilder:
+    """
+    Acumula los embeddings de los chunks de cada bloque conforme se almacenan y escribe cada bloque
+    al terminarlo. Los chunks de un bloque son consecutivos, pero un bloque puede quedar repartido
+    entre dos lotes: el último bloque de cada lote se mantiene abierto hasta el lote siguiente o flush.
+    """
+
+    def __init__(self, index: "BlockIndex"):
+        self.index = index
+        self.current: Optional[Dict] = None
+
+    def add(self, ids: List[str], chunks: List[Dict], embeddings) -> None:
+        completed = []
+        for chunk_id, chunk, embedding in zip(ids, chunks, embeddings):
+            metadata = chunk["metadata"]
+            if not metadata.get("block"):
+                continue
+            key = block_id(metadata.get("document_id", ""), metadata["block"])
+            if self.current is None or self.current["id"] != key:
+                if self.current is not None:
+                    completed.append(self.current)
+                self.current = {"id": key, "metadata": metadata, "sum": np.zeros(len(embedding), dtype=np.float64), "chunk_ids": []}
+            self.current["sum"] += np.asarray(embedding, dtype=np.float64)
+            self.current["chunk_ids"].append(chunk_id)
+        if completed:
+            self.index.write(completed)
+
+    def flush(self) -> None:
+        if self.current is not None:
+            self.index.write([self.current])
+            self.current = None
+
+
+class BlockIndex:
+    """
+    Colección de vectores de bloque asociada a una colección de chunks.
+
+    Args:
+        blocks: Colección (Chroma o MemmapCollection) donde se guarda un vector por bloque
+        chunks: Colección de los chunks
+    """
+
+    def __init__(self, blocks, chunks):
+        self.blocks = blocks
+        self.chunks = chunks
+
+    def builder(self) -> BlockIndexBuilder:
+        return BlockIndexBuilder(self)
+
+    def count(self) -> int:
+        return self.blocks.count()
+
+    def write(self, completed: List[Dict]) -> None:
+        """Guarda los bloques terminados; si un bloque ya existía se combina con él (media ponderada)."""
+        ids = [block["id"] for block in completed]
+        existing = self.blocks.get(ids=ids, include=["embeddings", "metadatas"])
+        if existing["ids"]:
+            previous = {id_: (np.asarray(embedding, dtype=np.float64), metadata)
+                        for id_, embedding, metadata in zip(existing["ids"], existing["embeddings"], existing["metadatas"])}
+            for block in completed:
+                if block["id"] in previous:
+                    embedding, metadata = previous[block["id"]]
+                    block["sum"] = block["sum"] + embedding * metadata["num_chunks"]
+                    block["chunk_ids"] = metadata["chunk_ids"].split(",") + block["chunk_ids"]
+            self.blocks.delete(ids=list(previous))
+        self.blocks.add(
+            ids=ids,
+            embeddings=[(block["sum"] / len(block["chunk_ids"])).astype(np.float32).tolist() for block in completed],
+            documents=[block["metadata"]["block"] for block in completed],
+            metadatas=[{
+                "document_id": block["metadata"].get("document_id", ""),
+                "document_type": block["metadata"].get("document_type", ""),
+                "título": block["metadata"].get("título", ""),
+                "block": block["metadata"]["block"],
+                "chunk_ids": ",".join(block["chunk_ids"]),
+                "num_chunks": len(block["chunk_ids"]),
+            } for block in completed]
+        )
+
+    def delete_document(self, document_id: str) -> None:
+        self.blocks.delete(where={"document_id": document_id})
+
+    def clear(self) -> None:
+        ids = self.blocks.get(include=[])["ids"]
+        if ids:
+            self.blocks.delete(ids=ids)
+
+    def query(self, query_embeddings: List[List[float]], n_results: int, where: Dict = None, n_blocks: int = 20) -> Dict:
+        """
+        Búsqueda en dos niveles con el mismo formato de resultado que collection.query.
+
+        Para cada consulta se eligen los n_blocks bloques más cercanos (con el mismo filtro de metadatos,
+        que los bloques comparten con sus chunks) y se devuelven los n_results chunks de esos bloques más
+        cercanos a la consulta, con distancia coseno exacta.
+        """
+        block_results = self.blocks.query(query_embeddings=query_embeddings, n_results=n_blocks, where=where, include=["metadatas"])
+        chunk_ids_per_query = [[id_ for metadata in metadatas for id_ in metadata["chunk_ids"].split(",")]
+                               for metadatas in block_results["metadatas"]]
+        unique_ids = list(dict.fromkeys(id_ for ids in chunk_ids_per_query for id_ in ids))
+        found = self.chunks.get(ids=unique_ids, include=["embeddings", "documents", "metadatas"]) if unique_ids else \
+            {"ids": [], "embeddings": [], "documents": [], "metadatas": []}
+        rows = {id_: i for i, id_ in enumerate(found["ids"])}
+        embeddings = np.asarray(found["embeddings"], dtype=np.float32).reshape(len(found["ids"]), -1)
+        embeddings = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+
+        result = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+        for query, chunk_ids in zip(np.asarray(query_embeddings, dtype=np.float32), chunk_ids_per_query):
+            candidates = [rows[id_] for id_ in dict.fromkeys(chunk_ids) if id_ in rows]
+            query = query / max(float(np.linalg.norm(query)), 1e-12)
+            distances = 1.0 - embeddings[candidates] @ query if candidates else np.zeros(0, dtype=np.float32)
+            order = np.argsort(distances, kind="stable")[:n_results]
+            result["ids"].append([found["ids"][candidates[i]] for i in order])
+            result["documents"].append([found["documents"][candidates[i]] for i in order])
+            result["metadatas"].append([found["metadatas"][candidates[i]] for i in order])
+            result["distances"].append([float(distances[i]) for i in order])
+        return result
+
+
+def build(rag, page_size: int = 1000) -> int:
+    """Reconstruye el índice de bloques recorriendo los chunks de cada documento en orden."""
+    rag.block_index.clear()
+    ids = rag.collection.get(include=[])["ids"]
+
+    def order(chunk_id: str):
+        document_id, _, index = chunk_id.rpartition("-chunk-")
+        return (document_id, int(index)) if index.isdigit() else (chunk_id, 0)
+
+    builder = rag.block_index.builder()
+    ids = sorted(ids, key=order)
+    for start in range(0, len(ids), page_size):
+        page_ids = ids[start:start + page_size]
+        page = rag.collection.get(ids=page_ids, include=["embeddings", "metadatas"])
+        rows = {id_: i for i, id_ in enumerate(page["ids"])}
+        page_ids = [id_ for id_ in page_ids if id_ in rows]
+        builder.add(page_ids, [{"metadata": page["metadatas"][rows[id_]]} for id_ in page_ids],
+                    [page["embeddings"][rows[id_]] for id_ in page_ids])
+    builder.flush()
+    return rag.block_index.count()
+
+
+def benchmark(rag, questions: List[str], n_blocks: int, n_results: int, top_n: int) -> None:
+    """Compara la recuperación plana y la jerárquica con las mismas preguntas."""
+    flat = {"seconds": 0.0, "pairs": 0}
+    hierarchical = {"seconds": 0.0, "pairs": 0}
+    overlaps = []
+    for question in questions:
+        runs = {}
+        for name, stats, enabled in (("flat", flat, False), ("hierarchical", hierarchical, True)):
+            pairs = rag.rerank_engine.stats["pairs"]
+            start = time.perf_counter()
+            runs[name] = rag.query_similar(question, score=-1e9, n_results=n_results, hierarchical=enabled, n_blocks=n_blocks)
+            stats["seconds"] += time.perf_counter() - start
+            stats["pairs"] += rag.rerank_engine.stats["pairs"] - pairs
+        reference = {r["id"] for r in runs["flat"][:top_n]}
+        if reference:
+            overlaps.append(len(reference & {r["id"] for r in runs["hierarchical"][:top_n]}) / len(reference))
+
+    n = len(questions)
+    print(f"\n{'':<14} {'ms/consulta':>12} {'pares rerank':>13}")
+    for name, stats in (("plana", flat), ("jerárquica", hierarchical)):
+        print(f"{name:<14} {stats['seconds'] / n * 1000:>12.0f} {stats['pairs'] / n:>13.1f}")
+    print(f"\nSolapamiento top-{top_n} tras el rerank (jerárquica frente a plana): {np.mean(overlaps) if overlaps else 0.0:.3f}")
+
+
+def main():
+    from src.RAG import VectorEmbeddings
+    from src.hnsw_sweep import load_questions
+    from src.inference_pool import SAMPLE_QUESTIONS
+
+    parser = argparse.ArgumentParser(description="Índice de bloques para la recuperación jerárquica")
+    parser.add_argument("command", choices=["build", "benchmark"])
+    parser.add_argument("--collection", default="normativa_tributaria-RAG")
+    parser.add_argument("--backend", default="chroma", choices=["chroma", "memmap"])
+    parser.add_argument("--questions", default=None, help="Fichero con una pregunta por línea (por defecto, el historial)")
+    parser.add_argument("--limit", type=int, default=100, help="Preguntas del benchmark")
+    parser.add_argument("--n-blocks", type=int, default=20, help="Bloques que se eligen en el primer nivel")
+    parser.add_argument("--n-results", type=int, default=50, help="Candidatos que se re-rankean")
+    parser.add_argument("--top-n", type=int, default=5, help="Top-n para comparar los resultados tras el rerank")
+    args = parser.parse_args()
+
+    rag = VectorEmbeddings(collection_name=args.collection, backend=args.backend)
+    if args.command == "build":
+        start = time.perf_counter()
+        count = build(rag)
+        print(f"Block index for {args.collection}: {count} blocks for {rag.collection.count()} chunks "
+              f"in {time.perf_counter() - start:.1f}s")
+        return
+    if rag.block_index.count() == 0:
+        parser.error(f"La colección {args.collection} no tiene índice de bloques; lanza antes build")
+    questions = load_questions(args.questions, limit=args.limit) or SAMPLE_QUESTIONS
+    print(f"{len(questions)} preguntas, {rag.block_index.count()} bloques y {rag.collection.count()} chunks")
+    benchmark(rag, questions, args.n_blocks, args.n_results, args.top_n)
+
+
+if __name__ == "__main__":
+    main()
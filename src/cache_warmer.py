@@ -0,0 +1,112 @@
+"""
+Precalentamiento de la caché de respuestas con las preguntas más frecuentes del historial.
+
+Tras un despliegue o una actualización del corpus, las primeras preguntas pagan la latencia completa de
+todas las llamadas a los modelos. Este proceso agrupa las preguntas iniciales de los hilos del historial
+(las siguientes dependen del historial y no se pueden cachear) con el embedder BGE, vuelve a ejecutar
+el pipeline contra el corpus actual para la pregunta más frecuente de los grupos más numerosos y guarda
+el resultado (embedding de la pregunta, fragmentos con su puntuación del rerank y respuesta) en la caché
+de respuestas. Las preguntas se procesan con run_conversations, con concurrencia acotada y sin registrarlas
+en el historial.
+
+Uso:
+    python -m src.cache_warmer --top 50 --max-concurrency 4
+    python -m src.ingestion --manifest data/manifest/corpus.json --warm-cache
+"""
+import argparse
+import sqlite3
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+
+
+def load_history_questions(db_path: str) -> Counter:
+    """Cuenta las preguntas con las que se abre cada hilo que el triaje clasificó como consulta."""
+    if not Path(db_path).exists():
+        return Counter()
+    conn = sqlite3.connect(db_path)
+    try:
+        rows = conn.execute(
+            "SELECT c.pregunta FROM conversation_history c "
+            "WHERE c.tipo = 'consulta' AND c.id = (SELECT MIN(id) FROM conversation_history WHERE thread_id = c.thread_id)"
+        ).fetchall()
+    finally:
+        conn.close()
+    return Counter(row[0].strip() for row in rows if row[0] and row[0].strip())
+
+
+def cluster_questions(questions: List[str], counts: List[int], embeddings: np.ndarray, threshold: float) -> List[Dict]:
+    """
+    Agrupa las preguntas por similitud coseno de sus embeddings.
+
+    Las preguntas se recorren de más a menos frecuente y cada una se asigna al primer grupo cuyo
+    representante (su pregunta más frecuente) supera el umbral; si no, abre un grupo nuevo.
+
+    Returns:
+        Los grupos ordenados por número de preguntas, con su representante y el embedding de este
+    """
+    embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+    order = np.argsort(-np.asarray(counts), kind="stable")
+    leaders: List[int] = []
+    clusters: List[Dict] = []
+    for i in order:
+        if leaders:
+            similarities = embeddings[leaders] @ embeddings[i]
+            best = int(np.argmax(similarities))
+            if similarities[best] >= threshold:
+                clusters[best]["size"] += counts[i]
+                clusters[best]["questions"].append(questions[i])
+                continue
+        leaders.append(i)
+        clusters.append({"question": questions[i], "embedding": embeddings[i], "size": counts[i], "questions": [questions[i]]})
+    return sorted(clusters, key=lambda c: -c["size"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precalienta la caché de respuestas con las preguntas frecuentes del historial")
+    parser.add_argument("--db-path", default="./data/sqlite/conversation_history.db")
+    parser.add_argument("--top", type=int, default=50, help="Grupos de preguntas que se precalculan")
+    parser.add_argument("--min-count", type=int, default=2, help="Tamaño mínimo de un grupo para precalcularlo")
+    parser.add_argument("--cluster-threshold", type=float, default=0.9, help="Similitud coseno para agrupar preguntas")
+    parser.add_argument("--max-concurrency", type=int, default=4, help="Preguntas con llamadas a los modelos en curso a la vez")
+    parser.add_argument("--purge-stale", action="store_true", help="Eliminar antes las entradas de versiones anteriores del corpus")
+    args = parser.parse_args()
+
+    # Se importa aquí porque carga los modelos y el grafo de agentes
+    from agents import answer_cache, inference, is_cacheable, rag, run_conversations
+
+    corpus_version = rag.corpus_version
+    if args.purge_stale:
+        answer_cache.purge_stale(corpus_version)
+
+    counter = load_history_questions(args.db_path)
+    if not counter:
+        print("Cache warmer: no questions in the conversation history")
+        return
+    questions, counts = list(counter), list(counter.values())
+    embeddings = np.asarray(inference.run(rag.model.encode, questions, batch_size=32), dtype=np.float32)
+    clusters = cluster_questions(questions, counts, embeddings, args.cluster_threshold)
+    selected = [c for c in clusters[:args.top] if c["size"] >= args.min_count and not answer_cache.has(c["question"], corpus_version)]
+    print(f"Cache warmer: {len(questions)} distinct questions in {len(clusters)} clusters; "
+          f"warming {len(selected)} for corpus version {corpus_version}")
+    if not selected:
+        return
+
+    start = time.perf_counter()
+    stored = 0
+    for index, result in run_conversations([c["question"] for c in selected], max_concurrency=args.max_concurrency, log=False):
+        cluster = selected[index]
+        if not is_cacheable(result):
+            print(f"  skipped ({result.get('tipo')}, {len(result.get('fragmentos') or [])} fragments): {cluster['question']}")
+            continue
+        answer_cache.put(cluster["question"], cluster["embedding"], corpus_version, result, source="warmer")
+        stored += 1
+        print(f"  cached [{cluster['size']:>4} questions] {cluster['question']}")
+    print(f"Cache warmer: {stored} of {len(selected)} answers cached in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
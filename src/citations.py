@@ -0,0 +1,272 @@
+"""
+Índice de citas de artículos y disposiciones para resolver consultas como "artículo 20 de la Ley 29/1987"
+sin pasar por la búsqueda vectorial.
+
+Se construye durante la ingesta a partir de las marcas de bloque del BOE que ya guarda split_markdown_BOE
+en la metadata de cada chunk ("[Bloque 25: #a20]" es el artículo 20, "#daprimera" la disposición adicional
+primera, ...) y del título de cada norma, del que se obtienen sus alias ("29/1987", "ley del impuesto sobre
+sucesiones y donaciones"). Se guarda como JSON por colección en ./data/citations.
+
+Para (re)construir el índice de una colección ya ingestada:
+    python -m src.citations --collection normativa_tributaria-RAG
+"""
+import argparse
+import json
+import os
+import re
+import threading
+import unicodedata
+from typing import Dict, List, Optional, Tuple
+
+from src.profiling import traced
+
+# Abreviaturas habituales que se expanden antes de buscar los alias por nombre
+ABBREVIATIONS = {
+    "lgt": "ley general tributaria",
+    "lisd": "ley del impuesto sobre sucesiones y donaciones",
+    "lip": "ley del impuesto sobre el patrimonio",
+    "litpajd": "ley del impuesto sobre transmisiones patrimoniales y actos juridicos documentados",
+    "lpac": "ley del procedimiento administrativo comun",
+    "lrjsp": "ley de regimen juridico del sector publico",
+}
+
+DISPOSITION_PREFIXES = {"adicional": "da", "transitoria": "dt", "final": "df", "derogatoria": "dd"}
+
+LAW_KINDS = r"(ley organica|ley|real decreto legislativo|real decreto|decreto legislativo|decreto-legislativo|decreto|resolucion|orden|rd)"
+TITLE_PATTERN = re.compile(LAW_KINDS + r"\s+(\d+/\d{4})(?:,\s*de\s+\d+\s+de\s+[a-z]+)?,?\s*(.*)$")
+LAW_NUMBER_PATTERN = re.compile(r"\b(?:" + LAW_KINDS + r"\s+)?(\d{1,4}/\d{4})\b")
+ARTICLE_PATTERN = re.compile(
+    r"\bart(?:iculos?|s?\.)\s*(\d+(?:\s*(?:bis|ter|quater|quinquies|sexies))?"
+    r"(?:\s*(?:,|y|e)\s*\d+(?:\s*(?:bis|ter|quater|quinquies|sexies))?)*)"
+)
+DISPOSITION_PATTERN = re.compile(r"\bdisposicion(?:es)?\s+(adicional|transitoria|final|derogatoria)\s+([a-z]+)")
+BLOCK_ANCHOR_PATTERN = re.compile(r"#([a-z0-9\-]+)\]?$")
+# Prefijos del título que se descartan para obtener el nombre de la norma
+NAME_PREFIXES = ("por el que se aprueba el texto refundido de la ", "por el que se aprueba el ",
+                 "por el que se aprueba la ", "de la ")
+
+# Palabras que no cuentan como contenido al decidir si, además de la cita, hace falta búsqueda vectorial
+FILLER_WORDS = {
+    "que", "dice", "establece", "regula", "el", "la", "los", "las", "de", "del", "en", "segun", "sobre",
+    "lo", "al", "y", "o", "se", "su", "contenido", "texto", "redaccion", "cual", "es", "indica", "dispone",
+}
+
+
+def normalize(text: str) -> str:
+    """Minúsculas y sin tildes, para comparar citas y alias."""
+    text = unicodedata.normalize("NFKD", text.lower())
+    return "".join(c for c in text if not unicodedata.combining(c))
+
+
+def block_key(block: Optional[str]) -> Optional[str]:
+    """Clave de un bloque a partir de su marca: "[Bloque 25: #a20]" -> "a20", "#daprimera" -> "daprimera"."""
+    if not block:
+        return None
+    match = BLOCK_ANCHOR_PATTERN.search(block.strip())
+    if not match:
+        return None
+    key = match.group(1).lower()
+    return key if re.match(r"^(a\d+[a-z]*|d[atfd][a-z0-9\-]*)$", key) else None
+
+
+def title_aliases(title: str) -> List[str]:
+    """Alias de una norma a partir de su título: número ("29/1987"), tipo y número, y nombre."""
+    match = TITLE_PATTERN.match(normalize(title).strip())
+    if not match:
+        return []
+    kind, number, rest = match.group(1), match.group(2), match.group(3).strip().rstrip(".")
+    aliases = [number, f"{kind} {number}"]
+    for prefix in NAME_PREFIXES:
+        if rest.startswith(prefix):
+            rest = rest[len(prefix):]
+            break
+    if rest.startswith(("ley ", "reglamento ", "texto refundido ")):
+        aliases.append(rest)
+    elif kind == "ley" and rest:
+        aliases.append(f"ley {rest}")
+    return aliases
+
+
+class CitationIndex:
+    """
+    Índice (document_id, artículo o disposición) -> ids de chunk, con los alias de cada norma.
+
+    Args:
+        collection_name: Colección a la que pertenecen los chunks indexados
+        path: Directorio donde se guarda el índice
+    """
+
+    def __init__(self, collection_name: str, path: str = "./data/citations"):
+        os.makedirs(path, exist_ok=True)
+        self.path = os.path.join(path, f"{collection_name}.json")
+        self.lock = threading.Lock()
+        self.aliases: Dict[str, List[str]] = {}
+        self.articles: Dict[str, Dict[str, List[str]]] = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self.aliases = data.get("aliases", {})
+            self.articles = data.get("articles", {})
+
+    # ------------------------------------------------------------------
+    # Construcción
+    # ------------------------------------------------------------------
+    def save(self) -> None:
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"aliases": self.aliases, "articles": self.articles}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def add_chunks(self, ids: List[str], metadatas: List[Dict], save: bool = True) -> None:
+        """Registra los chunks que pertenecen a un artículo o disposición identificable."""
+        with self.lock:
+            for id_, metadata in zip(ids, metadatas):
+                document_id = (metadata or {}).get("document_id")
+                if not document_id:
+                    continue
+                for alias in title_aliases(metadata.get("título", "")):
+                    documents = self.aliases.setdefault(alias, [])
+                    if document_id not in documents:
+                        documents.append(document_id)
+                key = block_key(metadata.get("block"))
+                if key:
+                    chunk_ids = self.articles.setdefault(document_id, {}).setdefault(key, [])
+                    if id_ not in chunk_ids:
+                        chunk_ids.append(id_)
+            if save:
+                self.save()
+
+    def remove_document(self, document_id: str) -> None:
+        with self.lock:
+            self.articles.pop(document_id, None)
+            for alias in list(self.aliases):
+                if document_id in self.aliases[alias]:
+                    self.aliases[alias].remove(document_id)
+                if not self.aliases[alias]:
+                    del self.aliases[alias]
+            self.save()
+
+    def clear(self) -> None:
+        with self.lock:
+            self.aliases, self.articles = {}, {}
+            self.save()
+
+    # ------------------------------------------------------------------
+    # Consulta
+    # ------------------------------------------------------------------
+    def _law_mentions(self, text: str) -> List[Tuple[int, int, List[str]]]:
+        """Menciones de normas en el texto normalizado: (inicio, fin, documentos)."""
+        mentions = []
+        for match in LAW_NUMBER_PATTERN.finditer(text):
+            kind, number = match.group(1), match.group(2)
+            documents = self.aliases.get(f"{kind} {number}") if kind else None
+            documents = documents or self.aliases.get(number)
+            if documents:
+                mentions.append((match.start(), match.end(), documents))
+        for alias in sorted(self.aliases, key=len, reverse=True):
+            if "/" in alias:
+                continue
+            for match in re.finditer(r"\b" + re.escape(alias) + r"\b", text):
+                # Un alias más largo ya cubre esta posición (p.ej. "reglamento del impuesto..." frente a "ley del impuesto...")
+                if not any(start <= match.start() < end for start, end, _ in mentions):
+                    mentions.append((match.start(), match.end(), self.aliases[alias]))
+        return mentions
+
+    @staticmethod
+    def _article_mentions(text: str) -> List[Tuple[int, int, List[str]]]:
+        """Menciones de artículos y disposiciones: (inicio, fin, claves de bloque)."""
+        mentions = []
+        for match in ARTICLE_PATTERN.finditer(text):
+            numbers = re.findall(r"\d+(?:\s*(?:bis|ter|quater|quinquies|sexies))?", match.group(1))
+            mentions.append((match.start(), match.end(), ["a" + n.replace(" ", "") for n in numbers]))
+        for match in DISPOSITION_PATTERN.finditer(text):
+            prefix, ordinal = DISPOSITION_PREFIXES[match.group(1)], match.group(2)
+            keys = [prefix + ordinal] + ([prefix] if ordinal == "unica" else [])
+            mentions.append((match.start(), match.end(), keys))
+        return mentions
+
+    @traced("citations")
+    def lookup(self, text: str, max_distance: int = 80) -> Tuple[List[str], bool]:
+        """
+        Busca en el texto citas de artículos o disposiciones de normas indexadas.
+
+        Cada artículo se asocia a la norma mencionada justo después ("artículo 20 de la Ley 29/1987") o,
+        si no hay, justo antes ("la Ley 29/1987, en su artículo 20"); si el texto menciona una sola norma,
+        a esa norma.
+
+        Returns:
+            Los ids de los chunks citados y si, además, el texto pide algo que requiera búsqueda vectorial
+        """
+        normalized = normalize(text)
+        for abbreviation, expansion in ABBREVIATIONS.items():
+            normalized = re.sub(r"\b" + abbreviation + r"\b", expansion, normalized)
+        with self.lock:
+            laws = self._law_mentions(normalized)
+            articles = self._article_mentions(normalized)
+            chunk_ids: List[str] = []
+            covered = [(start, end) for start, end, _ in laws]
+            for start, end, keys in articles:
+                following = [m for m in laws if 0 <= m[0] - end <= max_distance]
+                preceding = [m for m in laws if 0 <= start - m[1] <= max_distance]
+                if following:
+                    documents = min(following, key=lambda m: m[0] - end)[2]
+                elif preceding:
+                    documents = min(preceding, key=lambda m: start - m[1])[2]
+                elif len({tuple(m[2]) for m in laws}) == 1:
+                    documents = laws[0][2]
+                else:
+                    continue
+                found = False
+                for document_id in documents:
+                    for key in keys:
+                        for id_ in self.articles.get(document_id, {}).get(key, []):
+                            found = True
+                            if id_ not in chunk_ids:
+                                chunk_ids.append(id_)
+                if found:
+                    covered.append((start, end))
+
+        if not chunk_ids:
+            return [], True
+        # Lo que queda del texto sin las citas decide si hace falta también la búsqueda vectorial
+        remaining = normalized
+        for start, end in sorted(covered, reverse=True):
+            remaining = remaining[:start] + " " + remaining[end:]
+        content_words = [w for w in re.findall(r"[a-z]{3,}", remaining) if w not in FILLER_WORDS]
+        return chunk_ids, len(content_words) >= 3
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reconstruye el índice de citas de una colección ya ingestada")
+    parser.add_argument("--collection", default="normativa_tributaria-RAG")
+    parser.add_argument("--backend", default="chroma", choices=["chroma", "memmap"])
+    parser.add_argument("--page-size", type=int, default=5000)
+    args = parser.parse_args()
+
+    from src.collection_versions import CollectionAlias
+    # El índice se guarda por colección física: se reconstruye el de la versión a la que apunta el alias
+    name = CollectionAlias(args.collection).current()
+    if args.backend == "chroma":
+        import chromadb
+        collection = chromadb.PersistentClient(path="./data/chroma/vec").get_collection(name)
+    else:
+        from src.vector_store import MemmapCollection
+        collection = MemmapCollection(path="./data/memmap", name=name)
+
+    index = CitationIndex(name)
+    index.clear()
+    offset = 0
+    while True:
+        page = collection.get(include=["metadatas"], limit=args.page_size, offset=offset)
+        if not page["ids"]:
+            break
+        index.add_chunks(page["ids"], page["metadatas"], save=False)
+        offset += len(page["ids"])
+    index.save()
+    total = sum(len(keys) for keys in index.articles.values())
+    print(f"Citation index for {name}: {total} articles and dispositions in {len(index.articles)} documents, "
+          f"{len(index.aliases)} aliases")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""
+Colecciones versionadas detrás de un alias para actualizar el corpus sin cortes.
+
+El nombre lógico de una colección ("normativa_tributaria-RAG") es un alias: un fichero JSON en
+data/aliases que apunta a la colección física en uso ("normativa_tributaria-RAG--v20261019T101500-3f2a9c").
+La ingesta construye una versión nueva (sembrada con una copia de la actual para procesar solo los
+documentos cambiados), la valida y la promociona sustituyendo el fichero con os.replace, de modo que
+los lectores ven la versión anterior completa o la nueva completa, nunca una a medias. Los procesos que
+sirven consultas (VectorEmbeddings.refresh) detectan el cambio por la fecha de modificación del alias.
+Los índices auxiliares (bloques, citas, léxico, duplicados y versión del corpus) van por colección física.
+
+Si no existe el fichero de alias, la colección física es la del propio nombre lógico (colecciones
+creadas antes de las versiones).
+
+    status    Versión en uso, versión en construcción e historial
+    promote   Apunta el alias a una versión concreta (p.ej. para volver a la anterior)
+    gc        Elimina las versiones antiguas conservando las N más recientes
+
+Uso:
+    python -m src.collection_versions status --collection normativa_tributaria-RAG
+    python -m src.collection_versions promote --collection normativa_tributaria-RAG --version normativa_tributaria-RAG--v20261019T101500-3f2a9c
+    python -m src.collection_versions gc --collection normativa_tributaria-RAG --keep 2
+"""
+import argparse
+import json
+import os
+import time
+import uuid
+from datetime import datetime
+from typing import Dict, List, Optional
+
+VERSION_SEPARATOR = "--v"
+
+
+def version_name(alias: str) -> str:
+    """Nombre de una colección física nueva para el alias (válido como nombre de colección de Chroma)."""
+    return f"{alias}{VERSION_SEPARATOR}{datetime.now().strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:6]}"
+
+
+class CollectionAlias:
+    """
+    Fichero de alias de una colección lógica.
+
+    Estado: {"current": colección en uso, "building": versión en construcción,
+             "history": versiones promocionadas anteriormente, de la más reciente a la más antigua}
+
+    Args:
+        alias: Nombre lógico de la colección
+        path: Directorio de los ficheros de alias
+    """
+
+    def __init__(self, alias: str, path: str = "./data/aliases"):
+        self.alias = alias
+        self.path = os.path.join(path, f"{alias}.json")
+
+    def read(self) -> Dict:
+        if not os.path.exists(self.path):
+            return {"current": None, "building": None, "history": []}
+        with open(self.path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _write(self, state: Dict) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def mtime(self) -> Optional[float]:
+        try:
+            return os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def current(self) -> str:
+        """Colección física en uso."""
+        return self.read()["current"] or self.alias
+
+    def building(self) -> Optional[str]:
+        return self.read()["building"]
+
+    def start_build(self, physical: str) -> None:
+        state = self.read()
+        state["building"] = physical
+        self._write(state)
+
+    def abandon_build(self) -> None:
+        state = self.read()
+        state["building"] = None
+        self._write(state)
+
+    def promote(self, physical: str) -> Optional[str]:
+        """Apunta el alias a physical de forma atómica. Devuelve la colección que estaba en uso."""
+        state = self.read()
+        previous = state["current"] or self.alias
+        if previous == physical:
+            return None
+        state["history"] = [previous] + [name for name in state["history"] if name not in (previous, physical)]
+        state["current"] = physical
+        if state["building"] == physical:
+            state["building"] = None
+        state["promoted_at"] = datetime.now().isoformat()
+        self._write(state)
+        return previous
+
+    def forget(self, physical: str) -> None:
+        state = self.read()
+        state["history"] = [name for name in state["history"] if name != physical]
+        self._write(state)
+
+
+def copy_collection(source, target, page_size: int = 1000, pause: float = 0.0) -> int:
+    """Copia los registros (con sus embeddings) de una colección a otra por páginas."""
+    offset = 0
+    while True:
+        page = source.get(include=["embeddings", "documents", "metadatas"], limit=page_size, offset=offset)
+        if not page["ids"]:
+            return offset
+        target.add(ids=page["ids"], embeddings=page["embeddings"], documents=page["documents"], metadatas=page["metadatas"])
+        offset += len(page["ids"])
+        if pause:
+            time.sleep(pause)
+
+
+def validate_version(rag, rows: List[Dict], reference_count: int, min_ratio: float = 0.9,
+                     questions: List[str] = None) -> List[str]:
+    """
+    Comprueba una versión construida antes de promocionarla.
+
+    Args:
+        rag: VectorEmbeddings abierto sobre la versión
+        rows: Filas del ledger de ingesta de la versión
+        reference_count: Chunks de la versión en uso
+        min_ratio: Fracción mínima de chunks respecto a la versión en uso
+        questions: Preguntas de prueba que deben devolver resultados
+
+    Returns:
+        Los problemas encontrados (vacía si la versión es válida)
+    """
+    problems = []
+    pending = [row["document_id"] for row in rows if row["stage"] != "stored" or row["error"]]
+    if pending:
+        problems.append(f"{len(pending)} documentos sin almacenar: {pending}")
+    count = rag.collection.count()
+    if count == 0:
+        problems.append("La colección está vacía")
+    elif reference_count and count < min_ratio * reference_count:
+        problems.append(f"{count} chunks frente a {reference_count} de la versión en uso (mínimo {min_ratio:.0%})")
+    for question in questions or []:
+        if not rag.query_similar(question, score=-1e9, n_results=5):
+            problems.append(f"Sin resultados para la pregunta de prueba: {question}")
+    return problems
+
+
+def print_status(alias: CollectionAlias) -> None:
+    state = alias.read()
+    print(f"Alias {alias.alias}: current={alias.current()} building={state['building']} "
+          f"promoted_at={state.get('promoted_at', '-')}")
+    for name in state["history"]:
+        print(f"  previous: {name}")
+
+
+def main():
+    from src.RAG import VectorEmbeddings
+
+    parser = argparse.ArgumentParser(description="Versiones de una colección detrás de un alias")
+    parser.add_argument("command", choices=["status", "promote", "gc"])
+    parser.add_argument("--collection", default="normativa_tributaria-RAG", help="Nombre lógico (alias) de la colección")
+    parser.add_argument("--backend", default="chroma", choices=["chroma", "memmap"])
+    parser.add_argument("--version", default=None, help="Colección física que se promociona")
+    parser.add_argument("--keep", type=int, default=2, help="Versiones que conserva gc, incluida la actual")
+    args = parser.parse_args()
+
+    alias = CollectionAlias(args.collection)
+    if args.command == "status":
+        print_status(alias)
+        return
+    rag = VectorEmbeddings(args.collection, backend=args.backend)
+    if args.command == "promote":
+        if not args.version:
+            parser.error("promote necesita --version")
+        rag.promote_version(args.version)
+    else:
+        rag.gc_versions(keep=args.keep)
+    print_status(alias)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""
+Carga de los modelos de embeddings y reranking con precisión reducida para inferencia en CPU.
+
+Precisiones disponibles:
+    fp32  Modelos tal cual (referencia)
+    bf16  Pesos en bfloat16: la mitad de memoria; rápido en CPUs con AVX512-BF16/AMX
+    int8  Cuantización dinámica a int8 de las capas Linear (pesos en int8, activaciones cuantizadas al vuelo)
+    onnx  Embedder exportado a ONNX y ejecutado con onnxruntime (requiere optimum[onnxruntime]).
+          sentence-transformers 3.4 no admite backend ONNX en CrossEncoder, así que el reranker usa int8
+
+Antes de adoptar una precisión conviene comprobar la deriva frente a fp32 con src/precision_check.py.
+"""
+import torch
+from sentence_transformers import SentenceTransformer, CrossEncoder
+
+CPU_PRECISIONS = ("fp32", "bf16", "int8", "onnx")
+
+
+def _check_precision(precision: str) -> None:
+    if precision not in CPU_PRECISIONS:
+        raise ValueError(f"Precisión no soportada: {precision}. Opciones: {CPU_PRECISIONS}")
+
+
+def _quantize_int8(module: torch.nn.Module) -> torch.nn.Module:
+    return torch.quantization.quantize_dynamic(module.eval(), {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def load_embedder(path: str, precision: str = "fp32") -> SentenceTransformer:
+    """Carga el SentenceTransformer del directorio indicado con la precisión pedida."""
+    _check_precision(precision)
+    if precision == "onnx":
+        try:
+            return SentenceTransformer(path, trust_remote_code=True, backend="onnx", device="cpu")
+        except ImportError as e:
+            raise ImportError("La precisión onnx necesita optimum[onnxruntime] instalado") from e
+
+    model = SentenceTransformer(path, trust_remote_code=True, device="cpu" if precision != "fp32" else None)
+    if precision == "bf16":
+        model.to(torch.bfloat16)
+    elif precision == "int8":
+        model[0].auto_model = _quantize_int8(model[0].auto_model)
+    return model
+
+
+def load_reranker(path: str, precision: str = "fp32", max_length: int = 1024) -> CrossEncoder:
+    """Carga el CrossEncoder del directorio indicado con la precisión pedida (onnx se sirve con int8)."""
+    _check_precision(precision)
+    reranker = CrossEncoder(path, max_length=max_length, device="cpu" if precision != "fp32" else None)
+    if precision == "bf16":
+        reranker.model.to(torch.bfloat16)
+    elif precision in ("int8", "onnx"):
+        reranker.model = _quantize_int8(reranker.model)
+    return reranker
@@ -0,0 +1,465 @@
+"""
+Detección de chunks casi duplicados con MinHash y LSH.
+
+Los textos consolidados del BOE repiten fórmulas y unas normas reproducen literalmente artículos de otras
+(RD_ITPAJD y RD_828_1995, Ley_29_1987 y RD_1629_1991). Durante la ingesta, cada chunk se compara con los
+ya almacenados del mismo tipo de documento (el filtro por tipo de la búsqueda debe seguir encontrándolo)
+y, si su similitud de Jaccard estimada sobre shingles de palabras supera el umbral, no se vuelve a
+almacenar: se enlaza al chunk canónico y se guarda su texto y metadata en SQLite, para poder citar
+ambas normas en la respuesta y restaurarlo si se elimina el documento del canónico.
+
+    report  Chunks enlazados por documento y porcentaje del corpus deduplicado
+    scan    Reconstruye el índice desde una colección ya ingestada y detecta los casi duplicados que
+            ya estaban almacenados; con --apply los elimina de la colección y los enlaza
+
+Uso:
+    python -m src.dedup report --collection normativa_tributaria-RAG
+    python -m src.dedup scan --collection normativa_tributaria-RAG --apply
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from src.citations import normalize
+from src.profiling import traced
+
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+
+
+class NearDuplicateIndex:
+    """
+    Índice LSH de firmas MinHash de los chunks canónicos de una colección, con los enlaces de sus duplicados.
+
+    Args:
+        collection_name: Colección a la que pertenecen los chunks
+        db_path: Base de datos SQLite del índice
+        threshold: Similitud de Jaccard estimada a partir de la cual un chunk se considera duplicado
+        num_perm: Permutaciones de la firma MinHash
+        bands: Bandas del LSH (num_perm debe ser múltiplo). Con 128 permutaciones y 16 bandas, dos chunks
+            con Jaccard 0.9 comparten alguna banda con probabilidad > 0.99
+        shingle_size: Palabras de cada shingle
+        min_words: Los chunks con menos palabras no se deduplican (títulos, "(Derogado)", ...)
+    """
+
+    # Límite de parámetros por consulta en SQLite
+    MAX_PARAMS = 500
+
+    def __init__(self,
+                 collection_name: str,
+                 db_path: str = "./data/sqlite/dedup.db",
+                 threshold: float = 0.9,
+                 num_perm: int = 128,
+                 bands: int = 16,
+                 shingle_size: int = 5,
+                 min_words: int = 20):
+        if num_perm % bands:
+            raise ValueError(f"num_perm ({num_perm}) debe ser múltiplo de bands ({bands})")
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.collection = collection_name
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        self.min_words = min_words
+        rng = np.random.default_rng(1)
+        self.a = rng.integers(1, int(MERSENNE_PRIME), size=num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, int(MERSENNE_PRIME), size=num_perm, dtype=np.uint64)
+
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS dedup_signatures (
+                collection TEXT NOT NULL,
+                chunk_id TEXT NOT NULL,
+                document_id TEXT NOT NULL,
+                document_type TEXT NOT NULL,
+                signature BLOB NOT NULL,
+                PRIMARY KEY (collection, chunk_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS idx_dedup_signatures_document ON dedup_signatures (collection, document_id);
+            CREATE TABLE IF NOT EXISTS dedup_buckets (
+                collection TEXT NOT NULL,
+                document_type TEXT NOT NULL,
+                band INTEGER NOT NULL,
+                bucket BLOB NOT NULL,
+                chunk_id TEXT NOT NULL,
+                PRIMARY KEY (collection, document_type, band, bucket, chunk_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS idx_dedup_buckets_chunk ON dedup_buckets (collection, chunk_id);
+            CREATE TABLE IF NOT EXISTS dedup_links (
+                collection TEXT NOT NULL,
+                chunk_id TEXT NOT NULL,
+                canonical_id TEXT NOT NULL,
+                document_id TEXT NOT NULL,
+                similarity REAL NOT NULL,
+                content TEXT NOT NULL,
+                metadata TEXT NOT NULL,
+                created_at TEXT NOT NULL,
+                PRIMARY KEY (collection, chunk_id)
+            );
+            CREATE INDEX IF NOT EXISTS idx_dedup_links_canonical ON dedup_links (collection, canonical_id);
+            CREATE INDEX IF NOT EXISTS idx_dedup_links_document ON dedup_links (collection, document_id);
+            ''')
+            self.conn.commit()
+
+    # ------------------------------------------------------------------
+    # Firmas
+    # ------------------------------------------------------------------
+    def signature(self, text: str) -> Optional[np.ndarray]:
+        """Firma MinHash de los shingles de palabras del texto, o None si es demasiado corto."""
+        words = re.findall(r"\w+", normalize(text))
+        if len(words) < self.min_words:
+            return None
+        k = self.shingle_size
+        shingles = {" ".join(words[i:i + k]) for i in range(len(words) - k + 1)}
+        hashes = np.fromiter(
+            (int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=4).digest(), "little") for s in shingles),
+            dtype=np.uint64, count=len(shingles)
+        )
+        # Permutaciones (a*x + b) mod p; el desbordamiento de uint64 es intencionado, como en datasketch
+        permuted = (np.outer(hashes, self.a) + self.b) % MERSENNE_PRIME & MAX_HASH
+        return permuted.min(axis=0).astype(np.uint32)
+
+    @staticmethod
+    def similarity(a: np.ndarray, b: np.ndarray) -> float:
+        """Similitud de Jaccard estimada a partir de dos firmas."""
+        return float(np.mean(a == b))
+
+    def _band_buckets(self, signature: np.ndarray) -> List[bytes]:
+        return [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+
+    # ------------------------------------------------------------------
+    # Ingesta
+    # ------------------------------------------------------------------
+    def _match(self, signature: np.ndarray, document_type: str) -> Tuple[Optional[str], float]:
+        """Chunk canónico del mismo tipo de documento más parecido a la firma, si supera el umbral."""
+        candidates = set()
+        for band, bucket in enumerate(self._band_buckets(signature)):
+            rows = self.conn.execute(
+                "SELECT chunk_id FROM dedup_buckets WHERE collection = ? AND document_type = ? AND band = ? AND bucket = ?",
+                (self.collection, document_type, band, bucket)
+            ).fetchall()
+            candidates.update(row["chunk_id"] for row in rows)
+        best_id, best_similarity = None, 0.0
+        for chunk_id in candidates:
+            row = self.conn.execute(
+                "SELECT signature FROM dedup_signatures WHERE collection = ? AND chunk_id = ?",
+                (self.collection, chunk_id)
+            ).fetchone()
+            similarity = self.similarity(signature, np.frombuffer(row["signature"], dtype=np.uint32))
+            if similarity > best_similarity:
+                best_id, best_similarity = chunk_id, similarity
+        if best_similarity >= self.threshold:
+            return best_id, best_similarity
+        return None, best_similarity
+
+    def _add_canonical(self, chunk_id: str, metadata: Dict, signature: np.ndarray) -> None:
+        document_type = metadata.get("document_type", "")
+        self.conn.execute(
+            "INSERT OR REPLACE INTO dedup_signatures (collection, chunk_id, document_id, document_type, signature) VALUES (?, ?, ?, ?, ?)",
+            (self.collection, chunk_id, metadata.get("document_id", ""), document_type, signature.tobytes())
+        )
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO dedup_buckets (collection, document_type, band, bucket, chunk_id) VALUES (?, ?, ?, ?, ?)",
+            [(self.collection, document_type, band, bucket, chunk_id) for band, bucket in enumerate(self._band_buckets(signature))]
+        )
+
+    def deduplicate(self, ids: List[str], chunks: List[Dict]) -> Tuple[List[int], List[Tuple[int, str]]]:
+        """
+        Separa un lote de chunks en los que se deben almacenar y los que duplican un chunk ya almacenado.
+
+        Los chunks que se almacenan se registran como canónicos, de modo que también se detectan los
+        duplicados dentro del propio lote. Los duplicados se enlazan a su canónico.
+
+        Args:
+            ids: IDs de los chunks
+            chunks: Chunks con su contenido y metadata, tal y como los genera split_markdown_BOE
+
+        Returns:
+            Las posiciones de los chunks que se deben almacenar y, para cada duplicado, su posición y el id
+            de su canónico
+        """
+        kept, links = [], []
+        now = datetime.now().isoformat()
+        with self.lock:
+            for position, (chunk_id, chunk) in enumerate(zip(ids, chunks)):
+                metadata = chunk["metadata"]
+                signature = self.signature(chunk["content"])
+                if signature is None:
+                    kept.append(position)
+                    continue
+                canonical_id, similarity = self._match(signature, metadata.get("document_type", ""))
+                if canonical_id is None or canonical_id == chunk_id:
+                    self._add_canonical(chunk_id, metadata, signature)
+                    kept.append(position)
+                    continue
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO dedup_links (collection, chunk_id, canonical_id, document_id, similarity, content, metadata, created_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (self.collection, chunk_id, canonical_id, metadata.get("document_id", ""), similarity,
+                     chunk["content"], json.dumps(metadata, ensure_ascii=False), now)
+                )
+                links.append((position, canonical_id))
+            self.conn.commit()
+        return kept, links
+
+    def register(self, ids: List[str], chunks: List[Dict]) -> None:
+        """Registra chunks ya almacenados como canónicos sin buscar duplicados (p.ej. al importar un artefacto)."""
+        with self.lock:
+            for chunk_id, chunk in zip(ids, chunks):
+                signature = self.signature(chunk["content"])
+                if signature is not None:
+                    self._add_canonical(chunk_id, chunk["metadata"], signature)
+            self.conn.commit()
+
+    def remove_document(self, document_id: str) -> List[Dict]:
+        """
+        Elimina del índice los chunks y enlaces de un documento.
+
+        Los duplicados de otros documentos cuyo canónico pertenecía a este documento se quedarían sin texto
+        en la colección, así que se eliminan también del índice y se devuelven para volver a almacenarlos.
+
+        Returns:
+            Los duplicados huérfanos como {id, content, metadata}
+        """
+        with self.lock:
+            canonical_ids = [row["chunk_id"] for row in self.conn.execute(
+                "SELECT chunk_id FROM dedup_signatures WHERE collection = ? AND document_id = ?",
+                (self.collection, document_id)
+            ).fetchall()]
+            orphans = []
+            for start in range(0, len(canonical_ids), self.MAX_PARAMS):
+                batch = canonical_ids[start:start + self.MAX_PARAMS]
+                placeholders = ",".join("?" * len(batch))
+                rows = self.conn.execute(
+                    f"SELECT chunk_id, content, metadata FROM dedup_links WHERE collection = ? AND document_id != ? "
+                    f"AND canonical_id IN ({placeholders}) ORDER BY chunk_id",
+                    (self.collection, document_id, *batch)
+                ).fetchall()
+                orphans.extend({"id": row["chunk_id"], "content": row["content"], "metadata": json.loads(row["metadata"])}
+                               for row in rows)
+                self.conn.execute(f"DELETE FROM dedup_links WHERE collection = ? AND canonical_id IN ({placeholders})",
+                                  (self.collection, *batch))
+                self.conn.execute(f"DELETE FROM dedup_buckets WHERE collection = ? AND chunk_id IN ({placeholders})",
+                                  (self.collection, *batch))
+            self.conn.execute("DELETE FROM dedup_signatures WHERE collection = ? AND document_id = ?", (self.collection, document_id))
+            self.conn.execute("DELETE FROM dedup_links WHERE collection = ? AND document_id = ?", (self.collection, document_id))
+            self.conn.commit()
+        return orphans
+
+    def clear(self) -> None:
+        with self.lock:
+            for table in ("dedup_signatures", "dedup_buckets", "dedup_links"):
+                self.conn.execute(f"DELETE FROM {table} WHERE collection = ?", (self.collection,))
+            self.conn.commit()
+
+    def close(self) -> None:
+        with self.lock:
+            self.conn.close()
+
+    def copy_to(self, collection_name: str) -> None:
+        """Copia firmas, buckets y enlaces a otra colección (la versión nueva de una colección, ver src/collection_versions.py)."""
+        columns = {
+            "dedup_signatures": "chunk_id, document_id, document_type, signature",
+            "dedup_buckets": "document_type, band, bucket, chunk_id",
+            "dedup_links": "chunk_id, canonical_id, document_id, similarity, content, metadata, created_at",
+        }
+        with self.lock:
+            for table, names in columns.items():
+                self.conn.execute(f"INSERT OR REPLACE INTO {table} (collection, {names}) SELECT ?, {names} FROM {table} WHERE collection = ?",
+                                  (collection_name, self.collection))
+            self.conn.commit()
+
+    def iter_links(self, page_size: int = 1000) -> Iterator[Dict]:
+        """Recorre los enlaces de duplicados de la colección (p.ej. para exportarlos en un artefacto)."""
+        last_id = ""
+        while True:
+            with self.lock:
+                rows = self.conn.execute(
+                    "SELECT chunk_id, canonical_id, document_id, similarity, content, metadata FROM dedup_links "
+                    "WHERE collection = ? AND chunk_id > ? ORDER BY chunk_id LIMIT ?",
+                    (self.collection, last_id, page_size)
+                ).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield {"chunk_id": row["chunk_id"], "canonical_id": row["canonical_id"], "document_id": row["document_id"],
+                       "similarity": row["similarity"], "content": row["content"], "metadata": json.loads(row["metadata"])}
+            last_id = rows[-1]["chunk_id"]
+
+    def add_links(self, links: List[Dict]) -> None:
+        """Restaura enlaces de duplicados con el formato de iter_links (p.ej. al importar un artefacto)."""
+        now = datetime.now().isoformat()
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO dedup_links (collection, chunk_id, canonical_id, document_id, similarity, content, metadata, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(self.collection, link["chunk_id"], link["canonical_id"], link["document_id"], link["similarity"],
+                  link["content"], json.dumps(link["metadata"], ensure_ascii=False), now) for link in links]
+            )
+            self.conn.commit()
+
+    # ------------------------------------------------------------------
+    # Consulta
+    # ------------------------------------------------------------------
+    @traced("sqlite:dedup")
+    def duplicates_of(self, canonical_ids: List[str]) -> Dict[str, List[Dict]]:
+        """Metadata de los duplicados enlazados a cada chunk canónico."""
+        duplicates: Dict[str, List[Dict]] = {}
+        unique_ids = list(set(canonical_ids))
+        with self.lock:
+            for start in range(0, len(unique_ids), self.MAX_PARAMS):
+                batch = unique_ids[start:start + self.MAX_PARAMS]
+                placeholders = ",".join("?" * len(batch))
+                rows = self.conn.execute(
+                    f"SELECT chunk_id, canonical_id, metadata FROM dedup_links WHERE collection = ? AND canonical_id IN ({placeholders}) "
+                    f"ORDER BY chunk_id",
+                    (self.collection, *batch)
+                ).fetchall()
+                for row in rows:
+                    duplicates.setdefault(row["canonical_id"], []).append({"id": row["chunk_id"], "metadata": json.loads(row["metadata"])})
+        return duplicates
+
+    def stored_signatures(self, chunk_ids: List[str]) -> Dict[str, np.ndarray]:
+        """Firmas guardadas en la ingesta de los chunks que las tienen."""
+        signatures: Dict[str, np.ndarray] = {}
+        unique_ids = list(set(chunk_ids))
+        with self.lock:
+            for start in range(0, len(unique_ids), self.MAX_PARAMS):
+                batch = unique_ids[start:start + self.MAX_PARAMS]
+                placeholders = ",".join("?" * len(batch))
+                rows = self.conn.execute(
+                    f"SELECT chunk_id, signature FROM dedup_signatures WHERE collection = ? AND chunk_id IN ({placeholders})",
+                    (self.collection, *batch)
+                ).fetchall()
+                for row in rows:
+                    signatures[row["chunk_id"]] = np.frombuffer(row["signature"], dtype=np.uint32)
+        return signatures
+
+    def collapse(self, results: List[Dict]) -> List[Dict]:
+        """
+        Agrupa los resultados de una búsqueda que son casi duplicados entre sí antes de re-rankearlos.
+
+        Se conserva el de menor distancia y los demás se añaden a su lista 'duplicates'. Sirve para los
+        duplicados que ya estaban almacenados antes de deduplicar en la ingesta. Se usan las firmas
+        guardadas en la ingesta; solo se calcula la de los chunks que no la tienen.
+        """
+        stored = self.stored_signatures([result["id"] for result in results])
+        kept: List[Tuple[Dict, Optional[np.ndarray]]] = []
+        for result in sorted(results, key=lambda r: r.get("distance", 0.0)):
+            signature = stored.get(result["id"])
+            if signature is None:
+                signature = self.signature(result["document"])
+            if signature is not None:
+                match = next((r for r, s in kept if s is not None and self.similarity(signature, s) >= self.threshold), None)
+                if match is not None:
+                    match.setdefault("duplicates", []).append({"id": result["id"], "metadata": result["metadata"]})
+                    continue
+            kept.append((result, signature))
+        return [result for result, _ in kept]
+
+    # ------------------------------------------------------------------
+    # Informe
+    # ------------------------------------------------------------------
+    def report(self) -> List[Dict]:
+        """Por documento: chunks indexados, duplicados enlazados y documentos de sus canónicos."""
+        with self.lock:
+            stored = dict(self.conn.execute(
+                "SELECT document_id, COUNT(*) FROM dedup_signatures WHERE collection = ? GROUP BY document_id",
+                (self.collection,)
+            ).fetchall())
+            linked = self.conn.execute(
+                "SELECT l.document_id, s.document_id AS source, COUNT(*) AS n, SUM(LENGTH(l.content)) AS chars "
+                "FROM dedup_links l LEFT JOIN dedup_signatures s ON s.collection = l.collection AND s.chunk_id = l.canonical_id "
+                "WHERE l.collection = ? GROUP BY l.document_id, s.document_id",
+                (self.collection,)
+            ).fetchall()
+        rows: Dict[str, Dict] = {document_id: {"document_id": document_id, "stored": n, "linked": 0, "chars": 0, "sources": {}}
+                                 for document_id, n in stored.items()}
+        for row in linked:
+            entry = rows.setdefault(row["document_id"], {"document_id": row["document_id"], "stored": 0, "linked": 0, "chars": 0, "sources": {}})
+            entry["linked"] += row["n"]
+            entry["chars"] += row["chars"] or 0
+            entry["sources"][row["source"] or "?"] = row["n"]
+        return sorted(rows.values(), key=lambda r: r["document_id"])
+
+
+def print_report(rows: List[Dict]) -> None:
+    print(f"{'documento':<22} {'almacenados':>11} {'enlazados':>9} {'%':>6}  canónicos en")
+    total_stored = total_linked = total_chars = 0
+    for row in rows:
+        total = row["stored"] + row["linked"]
+        total_stored += row["stored"]
+        total_linked += row["linked"]
+        total_chars += row["chars"]
+        sources = ", ".join(f"{source} ({n})" for source, n in sorted(row["sources"].items(), key=lambda item: -item[1]))
+        print(f"{row['document_id']:<22} {row['stored']:>11} {row['linked']:>9} {100 * row['linked'] / max(1, total):>5.1f}%  {sources}")
+    total = total_stored + total_linked
+    print(f"{'total':<22} {total_stored:>11} {total_linked:>9} {100 * total_linked / max(1, total):>5.1f}%")
+    print(f"\n{total_linked} of {total} indexed chunks deduplicated ({total_chars / 1e6:.2f} M characters not stored)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Deduplicación de chunks casi duplicados")
+    parser.add_argument("command", choices=["report", "scan"])
+    parser.add_argument("--collection", default="normativa_tributaria-RAG")
+    parser.add_argument("--backend", default="chroma", choices=["chroma", "memmap"])
+    parser.add_argument("--threshold", type=float, default=0.9)
+    parser.add_argument("--page-size", type=int, default=1000)
+    parser.add_argument("--apply", action="store_true", help="Con scan, elimina de la colección los duplicados encontrados")
+    args = parser.parse_args()
+
+    if args.command == "report":
+        # El índice se guarda por colección física: se informa de la versión a la que apunta el alias
+        from src.collection_versions import CollectionAlias
+        print_report(NearDuplicateIndex(CollectionAlias(args.collection).current(), threshold=args.threshold).report())
+        return
+
+    from src.RAG import VectorEmbeddings
+    # Se abre la versión en uso del alias, con su colección física y sus índices auxiliares
+    rag = VectorEmbeddings(args.collection, backend=args.backend, dedup_threshold=args.threshold)
+    collection, index, citations = rag.collection, rag.dedup, rag.citations
+
+    # Se recorre la colección entera por orden de id para que el canónico sea siempre el mismo
+    index.clear()
+    ids = sorted(collection.get(include=[])["ids"])
+    duplicates: List[Tuple[str, str]] = []
+    for start in range(0, len(ids), args.page_size):
+        page = collection.get(ids=ids[start:start + args.page_size], include=["documents", "metadatas"])
+        chunks = [{"content": document, "metadata": metadata} for document, metadata in zip(page["documents"], page["metadatas"])]
+        _, links = index.deduplicate(page["ids"], chunks)
+        duplicates.extend((page["ids"][position], canonical_id) for position, canonical_id in links)
+    print_report(index.report())
+
+    if not duplicates:
+        return
+    if not args.apply:
+        print(f"\n{len(duplicates)} near-duplicate chunks are still stored in {rag.name}; run with --apply to remove them")
+        return
+    for start in range(0, len(duplicates), args.page_size):
+        batch = duplicates[start:start + args.page_size]
+        page = collection.get(ids=[chunk_id for chunk_id, _ in batch], include=["metadatas"])
+        metadatas = dict(zip(page["ids"], page["metadatas"]))
+        # Las citas de los artículos duplicados pasan a resolverse con su canónico
+        citations.add_chunks([canonical_id for _, canonical_id in batch], [metadatas[chunk_id] for chunk_id, _ in batch], save=False)
+        collection.delete(ids=[chunk_id for chunk_id, _ in batch])
+    citations.save()
+    # Las respuestas cacheadas pueden citar los chunks eliminados
+    rag._bump_corpus_version()
+    print(f"\nRemoved {len(duplicates)} near-duplicate chunks from {rag.name}")
+
+
+if __name__ == "__main__":
+    main()
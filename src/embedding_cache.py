@@ -0,0 +1,156 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+from src.profiling import traced
+
+
+class EmbeddingCache:
+    """
+    Caché persistente de embeddings direccionada por contenido.
+
+    Cada entrada se identifica por (id del modelo, hash SHA-256 del texto del chunk), de modo que al
+    cambiar los parámetros de troceado solo se codifican los chunks cuyo texto es nuevo. Junto al vector
+    denso se guardan, si se conocen, los pesos léxicos de bge-m3 del texto (ver src/sparse.py).
+    """
+
+    # Límite de parámetros por consulta en SQLite
+    MAX_PARAMS = 500
+
+    def __init__(self, db_path: str = "./data/sqlite/embedding_cache.db"):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model_id TEXT NOT NULL,
+                text_hash TEXT NOT NULL,
+                dim INTEGER NOT NULL,
+                vector BLOB NOT NULL,
+                sparse BLOB,
+                created_at TEXT NOT NULL,
+                PRIMARY KEY (model_id, text_hash)
+            ) WITHOUT ROWID
+            ''')
+            # Migración de cachés creadas antes de guardar los pesos léxicos
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(embeddings)")]
+            if "sparse" not in columns:
+                self.conn.execute("ALTER TABLE embeddings ADD COLUMN sparse BLOB")
+            self.conn.commit()
+
+    @staticmethod
+    def text_hash(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def pack_sparse(weights: Dict[int, float]) -> bytes:
+        """Pesos token -> peso como los ids de token (int32) seguidos de los pesos (float32)."""
+        tokens = np.fromiter(weights.keys(), dtype=np.int32, count=len(weights))
+        values = np.fromiter(weights.values(), dtype=np.float32, count=len(weights))
+        return tokens.tobytes() + values.tobytes()
+
+    @staticmethod
+    def unpack_sparse(blob: bytes) -> Dict[int, float]:
+        n = len(blob) // 8
+        tokens = np.frombuffer(blob[:4 * n], dtype=np.int32)
+        values = np.frombuffer(blob[4 * n:], dtype=np.float32)
+        return dict(zip(tokens.tolist(), values.tolist()))
+
+    @traced("sqlite:embedding_cache.get")
+    def get_many(self, model_id: str, texts: List[str], with_sparse: bool = False) -> List:
+        """
+        Recupera los embeddings guardados para una lista de textos.
+
+        Args:
+            model_id: Modelo con el que se codificaron
+            texts: Textos a buscar
+            with_sparse: Devolver también los pesos léxicos; las entradas guardadas sin ellos cuentan como ausentes
+
+        Returns:
+            Una lista alineada con texts con el vector (float32), o la tupla (vector, pesos) si with_sparse,
+            o None si no está en la caché
+        """
+        hashes = [self.text_hash(text) for text in texts]
+        found = {}
+        unique_hashes = list(set(hashes))
+        with self.lock:
+            for start in range(0, len(unique_hashes), self.MAX_PARAMS):
+                batch = unique_hashes[start:start + self.MAX_PARAMS]
+                placeholders = ",".join("?" * len(batch))
+                rows = self.conn.execute(
+                    f"SELECT text_hash, vector, sparse FROM embeddings WHERE model_id = ? AND text_hash IN ({placeholders})",
+                    (model_id, *batch)
+                ).fetchall()
+                for text_hash, vector, sparse in rows:
+                    vector = np.frombuffer(vector, dtype=np.float32)
+                    if not with_sparse:
+                        found[text_hash] = vector
+                    elif sparse is not None:
+                        found[text_hash] = (vector, self.unpack_sparse(sparse))
+        return [found.get(h) for h in hashes]
+
+    @traced("sqlite:embedding_cache.put")
+    def put_many(self, model_id: str, texts: List[str], embeddings: Iterable,
+                 sparse_weights: Optional[List[Dict[int, float]]] = None) -> None:
+        """
+        Guarda los embeddings de una lista de textos y, si se dan, sus pesos léxicos. Sin ellos se
+        conservan los que ya tuviera la entrada.
+        """
+        now = datetime.now().isoformat()
+        rows = []
+        for position, (text, embedding) in enumerate(zip(texts, embeddings)):
+            vector = np.asarray(embedding, dtype=np.float32)
+            sparse = self.pack_sparse(sparse_weights[position]) if sparse_weights is not None else None
+            rows.append((model_id, self.text_hash(text), int(vector.shape[0]), vector.tobytes(), sparse, now))
+        with self.lock:
+            self.conn.executemany(
+                """INSERT INTO embeddings (model_id, text_hash, dim, vector, sparse, created_at) VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (model_id, text_hash) DO UPDATE SET dim = excluded.dim, vector = excluded.vector,
+                    sparse = COALESCE(excluded.sparse, embeddings.sparse), created_at = excluded.created_at""",
+                rows
+            )
+            self.conn.commit()
+
+    def collect_garbage(self, model_id: str, referenced_hashes: Iterable[str]) -> int:
+        """
+        Elimina las entradas de un modelo que no están referenciadas por ninguna colección.
+
+        Args:
+            model_id: Modelo cuyas entradas se revisan
+            referenced_hashes: Hashes de los textos de todos los chunks que siguen almacenados
+
+        Returns:
+            Número de entradas eliminadas
+        """
+        with self.lock:
+            self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS referenced (text_hash TEXT PRIMARY KEY)")
+            self.conn.execute("DELETE FROM referenced")
+            self.conn.executemany("INSERT OR IGNORE INTO referenced (text_hash) VALUES (?)", ((h,) for h in referenced_hashes))
+            cursor = self.conn.execute(
+                "DELETE FROM embeddings WHERE model_id = ? AND text_hash NOT IN (SELECT text_hash FROM referenced)",
+                (model_id,)
+            )
+            deleted = cursor.rowcount
+            self.conn.execute("DROP TABLE referenced")
+            self.conn.commit()
+            self.conn.execute("VACUUM")
+        print(f"Embedding cache: deleted {deleted} unreferenced entries for {model_id}")
+        return deleted
+
+    def count(self, model_id: str = None) -> int:
+        with self.lock:
+            if model_id:
+                return self.conn.execute("SELECT COUNT(*) FROM embeddings WHERE model_id = ?", (model_id,)).fetchone()[0]
+            return self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
@@ -0,0 +1,103 @@
+"""
+Modelo de chat falso con retrasos y fallos inyectados para probar ResilientInvoker sin llamar a Gemini.
+
+Ejecutado directamente compara la latencia de llamadas directas frente a llamadas a través de
+ResilientInvoker con un modelo que tiene una cola lenta y errores ocasionales:
+    python -m src.fake_llm --calls 300
+"""
+import argparse
+import random
+import threading
+import time
+from typing import Callable, Optional
+
+from langchain_core.messages import AIMessage
+
+from src.resilience import ResilientInvoker
+
+
+class FakeChatModel:
+    """
+    Imita la interfaz invoke(messages) de los modelos de LangChain.
+
+    Args:
+        content: Texto de la respuesta
+        delay: Segundos de espera por llamada, o función sin argumentos que los devuelve
+        failure_rate: Probabilidad de que la llamada lance una excepción
+        seed: Semilla para que las simulaciones sean reproducibles
+    """
+
+    def __init__(self, content: str = "respuesta", delay=0.0, failure_rate: float = 0.0, seed: Optional[int] = None):
+        self.content = content
+        self.delay: Callable[[], float] = delay if callable(delay) else (lambda: delay)
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = 0
+
+    def invoke(self, messages):
+        with self.lock:
+            self.calls += 1
+            fails = self.random.random() < self.failure_rate
+        time.sleep(self.delay())
+        if fails:
+            raise RuntimeError("Fallo inyectado en FakeChatModel")
+        return AIMessage(content=self.content)
+
+
+def tail_delay(median_s: float, tail_s: float, tail_probability: float, seed: int = 0) -> Callable[[], float]:
+    """Retrasos casi constantes con una cola lenta en una fracción de las llamadas."""
+    rng = random.Random(seed)
+    lock = threading.Lock()
+
+    def delay() -> float:
+        with lock:
+            slow = rng.random() < tail_probability
+            jitter = rng.uniform(0.8, 1.2)
+        return (tail_s if slow else median_s) * jitter
+    return delay
+
+
+def percentile(values, p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulación de ResilientInvoker con un modelo falso")
+    parser.add_argument("--calls", type=int, default=300)
+    parser.add_argument("--median", type=float, default=0.05, help="Latencia típica en segundos")
+    parser.add_argument("--tail", type=float, default=1.0, help="Latencia de la cola lenta en segundos")
+    parser.add_argument("--tail-probability", type=float, default=0.05)
+    parser.add_argument("--failure-rate", type=float, default=0.02)
+    args = parser.parse_args()
+
+    lite = FakeChatModel("lite", delay=tail_delay(args.median, args.tail, args.tail_probability, seed=1), failure_rate=args.failure_rate, seed=1)
+    flash = FakeChatModel("flash", delay=tail_delay(args.median * 1.5, args.tail, args.tail_probability, seed=2), seed=2)
+
+    direct = []
+    for _ in range(args.calls):
+        start = time.perf_counter()
+        try:
+            lite.invoke([])
+        except RuntimeError:
+            pass
+        direct.append(time.perf_counter() - start)
+
+    invoker = ResilientInvoker({"lite": lite, "flash": flash}, deadlines_s={"nodo": 5.0}, backoff_base_s=0.01)
+    resilient = []
+    for _ in range(args.calls):
+        start = time.perf_counter()
+        invoker.invoke("lite", [], node="nodo")
+        resilient.append(time.perf_counter() - start)
+
+    print(f"{'':<12} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for name, values in (("directo", direct), ("resiliente", resilient)):
+        print(f"{name:<12} {percentile(values, 50) * 1000:>8.1f} {percentile(values, 95) * 1000:>8.1f} {percentile(values, 99) * 1000:>8.1f}")
+    summary = invoker.summary()
+    print(f"hedge_rate={summary['hedge_rate']:.3f} fallback_rate={summary['fallback_rate']:.3f} "
+          f"retries={summary['retries']} timeouts={summary['timeouts']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""
+Migración, retención y compactación de la base de datos del historial de conversaciones.
+
+    migrate   Añade las columnas nuevas y comprime contexto y respuesta de los registros antiguos
+    compact   Elimina contexto y respuesta intermedia de los hilos inactivos (conserva pregunta y revision)
+    purge     Elimina por completo los hilos inactivos
+    backfill-fts  Reconstruye el índice FTS5 de búsqueda de texto completo a partir de todo el historial
+Las órdenes de migración y retención terminan con VACUUM para devolver el espacio liberado al sistema.
+
+Uso:
+    python -m src.history_maintenance migrate
+    python -m src.history_maintenance compact --older-than-days 90
+    python -m src.history_maintenance purge --older-than-days 730
+    python -m src.history_maintenance backfill-fts
+"""
+import argparse
+
+from src.agent_handler import ConversationHistoryManager
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mantenimiento del historial de conversaciones")
+    parser.add_argument("command", choices=["migrate", "compact", "purge", "backfill-fts"])
+    parser.add_argument("--db-name", default="conversation_history.db")
+    parser.add_argument("--compression", default="zlib", choices=["none", "zlib", "zstd"])
+    parser.add_argument("--older-than-days", type=int, default=None, help="Antigüedad de la última interacción del hilo")
+    args = parser.parse_args()
+
+    if args.command in ("compact", "purge") and args.older_than_days is None:
+        parser.error(f"{args.command} necesita --older-than-days")
+
+    manager = ConversationHistoryManager(db_name=args.db_name, compression=args.compression)
+    if args.command == "backfill-fts":
+        manager.rebuild_fts()
+        manager.close()
+        return
+    if args.command == "migrate":
+        manager.compress_existing()
+    elif args.command == "compact":
+        manager.compact_threads(args.older_than_days)
+    else:
+        manager.purge_threads(args.older_than_days)
+    manager.vacuum()
+    manager.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""
+Barrido de parámetros del índice HNSW de Chroma (M, construction_ef y search_ef).
+
+Copia los vectores de la colección persistida a colecciones temporales construidas con cada
+combinación de parámetros y lanza contra todas las mismas preguntas, midiendo recall@k frente a la
+búsqueda exacta en float32, latencia de consulta (p50/p95) y tiempo de construcción. Recomienda la
+combinación con menor p95 entre las que alcanzan el recall objetivo.
+
+Las preguntas se leen de un fichero (una por línea) o, por defecto, de las consultas RAG guardadas en
+el historial de conversaciones, y se codifican con el mismo modelo de embeddings que la colección.
+
+Chroma fija los tres parámetros al crear la colección, así que cada combinación se construye por
+separado. Para aplicar la recomendada a la colección real:
+    VectorEmbeddings(nombre, hnsw_params=...).rebuild_index(hnsw_params)
+
+Uso:
+    python -m src.hnsw_sweep --collection normativa_tributaria-RAG --target-recall 0.98
+"""
+import argparse
+import itertools
+import shutil
+import sqlite3
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List
+
+import chromadb
+import numpy as np
+from huggingface_hub import snapshot_download
+from sentence_transformers import SentenceTransformer
+
+from src.RAG import EMBEDDING_MODEL_ID, batched, hnsw_metadata
+from src.benchmark_vector_store import exact_search, measure, recall
+
+
+def parse_grid(value: str) -> List[int]:
+    return [int(v) for v in value.split(",") if v.strip()]
+
+
+def load_questions(path: str = None, limit: int = 200) -> List[str]:
+    """Preguntas del fichero indicado o, si no hay, consultas RAG distintas del historial."""
+    if path:
+        with open(path, encoding="utf-8") as f:
+            questions = [line.strip() for line in f if line.strip()]
+        return questions[:limit]
+
+    db_path = Path(__file__).resolve().parent.parent / "data" / "sqlite" / "conversation_history.db"
+    if not db_path.exists():
+        return []
+    conn = sqlite3.connect(str(db_path))
+    try:
+        rows = conn.execute(
+            "SELECT DISTINCT consulta_RAG FROM conversation_history "
+            "WHERE consulta_RAG IS NOT NULL AND consulta_RAG != '' ORDER BY id DESC LIMIT ?",
+            (limit,)
+        ).fetchall()
+    finally:
+        conn.close()
+    return [row[0] for row in rows]
+
+
+def build_collection(client, name: str, params: Dict, data: Dict, batch_size: int = 1000):
+    """Crea una colección con los parámetros HNSW indicados y le añade todos los vectores."""
+    collection = client.create_collection(name=name, metadata=hnsw_metadata(params))
+    rows = range(len(data["ids"]))
+    for batch in batched(rows, batch_size):
+        start, end = batch[0], batch[-1] + 1
+        collection.add(
+            ids=data["ids"][start:end],
+            embeddings=data["embeddings"][start:end],
+            metadatas=data["metadatas"][start:end]
+        )
+    return collection
+
+
+def recommend(results: List[Dict], target_recall: float) -> Dict:
+    """Menor p95 entre las combinaciones con recall suficiente; si ninguna llega, la de más recall."""
+    eligible = [r for r in results if r["recall"] >= target_recall]
+    if eligible:
+        return min(eligible, key=lambda r: (r["p95_ms"], r["build_s"]))
+    return max(results, key=lambda r: (r["recall"], -r["p95_ms"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Barrido de parámetros HNSW de la colección de Chroma")
+    parser.add_argument("--collection", default="normativa_tributaria-RAG")
+    parser.add_argument("--chroma-path", default="./data/chroma/vec")
+    parser.add_argument("--questions", default=None, help="Fichero con una pregunta por línea (por defecto, el historial)")
+    parser.add_argument("--max-questions", type=int, default=200)
+    parser.add_argument("--k", type=int, default=50, help="Candidatos por consulta, como en query_similar")
+    parser.add_argument("--m", default="16,32,48")
+    parser.add_argument("--construction-ef", default="100,200,400")
+    parser.add_argument("--search-ef", default="10,50,100,200")
+    parser.add_argument("--target-recall", type=float, default=0.98)
+    args = parser.parse_args()
+
+    questions = load_questions(args.questions, args.max_questions)
+    if not questions:
+        print("No hay preguntas: indica un fichero con --questions o genera historial de conversaciones")
+        return
+
+    client = chromadb.PersistentClient(path=args.chroma_path)
+    source = client.get_collection(args.collection)
+    data = source.get(include=["embeddings", "metadatas"])
+    embeddings = np.asarray(data["embeddings"], dtype=np.float32)
+    data["embeddings"] = embeddings
+    print(f"Colección {args.collection}: {len(data['ids'])} chunks de dimensión {embeddings.shape[1]}, "
+          f"parámetros actuales {source.metadata}")
+
+    model = SentenceTransformer(snapshot_download(repo_id=EMBEDDING_MODEL_ID, local_dir="./models/BGE"), trust_remote_code=True)
+    queries = np.asarray(model.encode(questions, batch_size=32), dtype=np.float32)
+    k = min(args.k, len(data["ids"]))
+    truth = exact_search(embeddings, data["ids"], np.ones(len(data["ids"]), dtype=bool), queries, k)
+    print(f"{len(questions)} preguntas, recall@{k} frente a búsqueda exacta\n")
+
+    grid = itertools.product(parse_grid(args.m), parse_grid(args.construction_ef), parse_grid(args.search_ef))
+    tmp_dir = tempfile.mkdtemp(prefix="hnsw_sweep_")
+    results = []
+    try:
+        sweep_client = chromadb.PersistentClient(path=tmp_dir)
+        print(f"{'M':>4} {'constr_ef':>9} {'search_ef':>9} {'build s':>8} {'p50 ms':>8} {'p95 ms':>8} {f'recall@{k}':>10}")
+        for m, construction_ef, search_ef in grid:
+            params = {"M": m, "construction_ef": construction_ef, "search_ef": search_ef}
+            name = f"sweep-{m}-{construction_ef}-{search_ef}"
+            start = time.perf_counter()
+            collection = build_collection(sweep_client, name, params, data)
+            build_s = time.perf_counter() - start
+
+            # Calentamiento para no medir la carga inicial del índice
+            measure(collection, queries[:5], k)
+            stats = measure(collection, queries, k)
+            result = {
+                "params": params,
+                "build_s": build_s,
+                "p50_ms": float(np.percentile(stats["latencies"], 50)),
+                "p95_ms": float(np.percentile(stats["latencies"], 95)),
+                "recall": recall(stats["ids"], truth),
+            }
+            results.append(result)
+            print(f"{m:>4} {construction_ef:>9} {search_ef:>9} {build_s:>8.1f} {result['p50_ms']:>8.2f} "
+                  f"{result['p95_ms']:>8.2f} {result['recall']:>10.3f}")
+            sweep_client.delete_collection(name)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    best = recommend(results, args.target_recall)
+    if best["recall"] < args.target_recall:
+        print(f"\nNinguna combinación alcanza recall {args.target_recall}; la de más recall es:")
+    else:
+        print(f"\nCombinación recomendada (recall >= {args.target_recall} con menor p95):")
+    print(f"  hnsw_params={best['params']}  recall={best['recall']:.3f}  p95={best['p95_ms']:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+"""
+Ejecutor dedicado para la inferencia local (embeddings y reranker) compartida por todas las peticiones.
+
+Por defecto cada llamada a encode/predict usa tantos hilos intra-op de torch como núcleos, así que varias
+consultas concurrentes se pisan entre sí. InferenceExecutor limita las llamadas simultáneas a un número
+fijo de workers y fija en cada uno los hilos intra-op de torch de forma que workers x hilos = núcleos.
+torch.set_num_threads se llama en el propio hilo del worker: con el backend OpenMP (el de las ruedas de
+Linux) el número de hilos se aplica a las regiones paralelas que lanza ese hilo.
+
+Ejecutado directamente mide la curva de rendimiento de 1 a N consultas concurrentes, con y sin ejecutor:
+    python -m src.inference_pool --max-concurrency 8 --workers 2
+"""
+import argparse
+import contextvars
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
+
+import torch
+
+from src.profiling import span
+
+
+class LockedTokenizer:
+    """
+    Envoltorio de un tokenizer de Hugging Face que serializa sus llamadas.
+
+    Los tokenizers "fast" comparten estado en Rust y lanzan "Already borrowed" si se usan desde varios
+    hilos a la vez. Tokenizar es barato comparado con el modelo, así que un lock no limita el paralelismo.
+    """
+
+    def __init__(self, tokenizer):
+        self._tokenizer = tokenizer
+        self._lock = threading.Lock()
+
+    def __call__(self, *args, **kwargs):
+        with span("tokenize"), self._lock:
+            return self._tokenizer(*args, **kwargs)
+
+    def __getattr__(self, name):
+        attribute = getattr(self._tokenizer, name)
+        if not callable(attribute):
+            return attribute
+
+        def locked(*args, **kwargs):
+            with self._lock:
+                return attribute(*args, **kwargs)
+        return locked
+
+
+def guard_tokenizer(model) -> None:
+    """Sustituye el tokenizer de un SentenceTransformer o CrossEncoder por su versión con lock."""
+    if not isinstance(model.tokenizer, LockedTokenizer):
+        model.tokenizer = LockedTokenizer(model.tokenizer)
+
+
+class InferenceExecutor:
+    """
+    Pool de hilos para las llamadas a los modelos locales con hilos intra-op de torch controlados.
+
+    Args:
+        workers: Llamadas de inferencia que se ejecutan a la vez
+        threads_per_worker: Hilos intra-op de torch de cada worker
+        models: Modelos compartidos (SentenceTransformer, CrossEncoder) cuyo tokenizer se protege con un lock
+
+    Si falta alguno de los dos primeros se calcula a partir del otro para repartir todos los núcleos.
+    """
+
+    def __init__(self, workers: int = None, threads_per_worker: int = None, models: List = None):
+        cores = os.cpu_count() or 1
+        if workers is None and threads_per_worker is None:
+            threads_per_worker = min(4, cores)
+        if workers is None:
+            workers = max(1, cores // threads_per_worker)
+        if threads_per_worker is None:
+            threads_per_worker = max(1, cores // workers)
+        if workers * threads_per_worker > cores:
+            print(f"Warning: {workers} workers x {threads_per_worker} threads exceeds the {cores} available cores")
+
+        self.workers = workers
+        self.threads_per_worker = threads_per_worker
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="inference",
+                                           initializer=torch.set_num_threads, initargs=(threads_per_worker,))
+        for model in models or []:
+            guard_tokenizer(model)
+
+        self.lock = threading.Lock()
+        self.waiting = 0
+        self.running = 0
+        self.wait_times = deque(maxlen=500)
+        self.run_times = deque(maxlen=500)
+        self.calls = 0
+        print(f"Inference executor: {workers} workers x {threads_per_worker} torch threads ({cores} cores)")
+
+    def _execute(self, fn: Callable, submitted: float, args, kwargs):
+        start = time.perf_counter()
+        with self.lock:
+            self.waiting -= 1
+            self.running += 1
+            self.wait_times.append(start - submitted)
+        try:
+            with torch.inference_mode():
+                return fn(*args, **kwargs)
+        finally:
+            with self.lock:
+                self.running -= 1
+                self.calls += 1
+                self.run_times.append(time.perf_counter() - start)
+
+    def submit(self, fn: Callable, *args, **kwargs):
+        with self.lock:
+            self.waiting += 1
+        # Se copia el contexto para que la traza de la petición (src.profiling) siga en el worker
+        context = contextvars.copy_context()
+        return self.executor.submit(context.run, self._execute, fn, time.perf_counter(), args, kwargs)
+
+    def run(self, fn: Callable, *args, **kwargs):
+        """Ejecuta fn en un worker de inferencia y espera el resultado."""
+        return self.submit(fn, *args, **kwargs).result()
+
+    def summary(self) -> Dict:
+        with self.lock:
+            waits = sorted(self.wait_times)
+            runs = sorted(self.run_times)
+            summary = {"workers": self.workers, "threads_per_worker": self.threads_per_worker,
+                       "waiting": self.waiting, "running": self.running, "calls": self.calls}
+        summary["wait_p50_s"] = waits[len(waits) // 2] if waits else 0.0
+        summary["wait_p95_s"] = waits[min(len(waits) - 1, int(0.95 * len(waits)))] if waits else 0.0
+        summary["run_p50_s"] = runs[len(runs) // 2] if runs else 0.0
+        summary["run_p95_s"] = runs[min(len(runs) - 1, int(0.95 * len(runs)))] if runs else 0.0
+        return summary
+
+
+SAMPLE_QUESTIONS = [
+    "¿Cuál es el plazo para presentar la autoliquidación del Impuesto sobre Sucesiones?",
+    "¿Qué reducciones se aplican en Cantabria a las donaciones entre padres e hijos?",
+    "¿Cuándo prescribe el derecho de la Administración a liquidar una deuda tributaria?",
+    "¿Qué tipo de gravamen se aplica a la transmisión de un inmueble en Canarias?",
+    "¿Están exentas del Impuesto sobre el Patrimonio las participaciones en empresa familiar?",
+    "¿Qué requisitos tiene el recurso de reposición en materia tributaria?",
+    "¿Cómo se calcula la base imponible en una adquisición mortis causa?",
+    "¿Qué competencias normativas tienen las Comunidades Autónomas sobre los tributos cedidos?",
+]
+
+
+def measure(call: Callable[[str], object], questions: List[str], concurrency: int) -> Dict:
+    """Lanza las preguntas con concurrency clientes simultáneos y devuelve consultas/s y latencias."""
+    latencies = []
+    lock = threading.Lock()
+
+    def client(question: str):
+        start = time.perf_counter()
+        call(question)
+        with lock:
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as clients:
+        list(clients.map(client, questions))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {"qps": len(questions) / elapsed,
+            "p50_ms": latencies[len(latencies) // 2] * 1000,
+            "p95_ms": latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))] * 1000}
+
+
+def main():
+    from src.RAG import VectorEmbeddings
+
+    parser = argparse.ArgumentParser(description="Curva de rendimiento de la recuperación con consultas concurrentes")
+    parser.add_argument("--collection", default="normativa_tributaria-RAG")
+    parser.add_argument("--max-concurrency", type=int, default=8)
+    parser.add_argument("--queries-per-level", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--threads-per-worker", type=int, default=None)
+    args = parser.parse_args()
+
+    rag = VectorEmbeddings(collection_name=args.collection)
+    questions = [SAMPLE_QUESTIONS[i % len(SAMPLE_QUESTIONS)] for i in range(args.queries_per_level)]
+
+    def direct(question: str):
+        return rag.query_similar(query_text=question, score=0.6)
+
+    executor = InferenceExecutor(args.workers, args.threads_per_worker, models=[rag.model, rag.reranker])
+
+    def pooled(question: str):
+        return executor.run(rag.query_similar, query_text=question, score=0.6)
+
+    # Calentamiento para no medir la primera carga de los modelos
+    direct(questions[0])
+    pooled(questions[0])
+
+    print(f"\n{'clientes':>8} | {'directo qps':>11} {'p50 ms':>8} {'p95 ms':>8} | {'ejecutor qps':>12} {'p50 ms':>8} {'p95 ms':>8}")
+    for concurrency in range(1, args.max_concurrency + 1):
+        baseline = measure(direct, questions, concurrency)
+        pool = measure(pooled, questions, concurrency)
+        print(f"{concurrency:>8} | {baseline['qps']:>11.2f} {baseline['p50_ms']:>8.0f} {baseline['p95_ms']:>8.0f} | "
+              f"{pool['qps']:>12.2f} {pool['p50_ms']:>8.0f} {pool['p95_ms']:>8.0f}")
+
+
+if __name__ == "__main__":
+    main()
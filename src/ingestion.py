@@ -0,0 +1,401 @@
+"""
+Ingesta del corpus dirigida por un manifiesto, reanudable y con registro de etapas.
+
+Cada documento del manifiesto pasa por las etapas fetched (Markdown descargado con Docling),
+chunked (chunks generados), embedded (embeddings calculados) y stored (chunks en la colección).
+El resultado de cada etapa se guarda en disco y el ledger (SQLite) registra la última etapa completada
+de cada documento, de modo que al relanzar la ingesta se continúa exactamente donde se detuvo.
+
+Por defecto la ingesta no escribe en la colección que están leyendo las consultas: construye una versión
+nueva (sembrada con la actual, así que solo se procesan los documentos que han cambiado), la valida y
+apunta a ella el alias de la colección (ver src/collection_versions.py). --pause, --threads y --nice
+limitan los recursos que consume mientras el servicio sigue atendiendo consultas.
+
+Uso:
+    python -m src.ingestion --manifest data/manifest/corpus.json
+    python -m src.ingestion --manifest data/manifest/corpus.json --threads 2 --pause 0.5 --nice 10
+    python -m src.ingestion --manifest data/manifest/corpus.json --restart LGT
+    python -m src.ingestion --manifest data/manifest/corpus.json --warm-cache
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import time
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional
+
+import numpy as np
+import torch
+
+from src.RAG import VectorEmbeddings, DocumentType, batched
+from src.collection_versions import validate_version
+
+STAGES = ["fetched", "chunked", "embedded", "stored"]
+
+
+def load_manifest(path: str) -> Dict:
+    """Lee y valida el manifiesto del corpus."""
+    with open(path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    seen = set()
+    for entry in manifest["documents"]:
+        for key in ("document_id", "source", "document_type"):
+            if not entry.get(key):
+                raise ValueError(f"Entrada del manifiesto sin '{key}': {entry}")
+        if entry["document_id"] in seen:
+            raise ValueError(f"document_id duplicado en el manifiesto: {entry['document_id']}")
+        if entry["document_type"] not in DocumentType.__members__:
+            raise ValueError(f"document_type desconocido en {entry['document_id']}: {entry['document_type']}")
+        seen.add(entry["document_id"])
+    return manifest
+
+
+class IngestionLedger:
+    """Registro persistente de la etapa completada por cada documento y del tiempo invertido en cada etapa."""
+
+    def __init__(self, db_path: str = "./data/sqlite/ingestion_ledger.db"):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.conn = sqlite3.connect(db_path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('''
+        CREATE TABLE IF NOT EXISTS ingestion_ledger (
+            collection TEXT NOT NULL,
+            document_id TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            stage TEXT,
+            num_chunks INTEGER,
+            dim INTEGER,
+            seconds_fetched REAL DEFAULT 0,
+            seconds_chunked REAL DEFAULT 0,
+            seconds_embedded REAL DEFAULT 0,
+            seconds_stored REAL DEFAULT 0,
+            error TEXT,
+            updated_at TEXT NOT NULL,
+            PRIMARY KEY (collection, document_id)
+        )
+        ''')
+        self.conn.commit()
+
+    def get(self, collection: str, document_id: str) -> Optional[Dict]:
+        row = self.conn.execute(
+            "SELECT * FROM ingestion_ledger WHERE collection = ? AND document_id = ?", (collection, document_id)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def reset(self, collection: str, document_id: str, fingerprint: str) -> None:
+        self.conn.execute(
+            "INSERT OR REPLACE INTO ingestion_ledger (collection, document_id, fingerprint, stage, updated_at) VALUES (?, ?, ?, NULL, ?)",
+            (collection, document_id, fingerprint, datetime.now().isoformat())
+        )
+        self.conn.commit()
+
+    def complete(self, collection: str, document_id: str, stage: str, seconds: float, **fields) -> None:
+        assignments = ", ".join(f"{key} = ?" for key in fields)
+        extra = f", {assignments}" if assignments else ""
+        self.conn.execute(
+            f"UPDATE ingestion_ledger SET stage = ?, seconds_{stage} = ?, error = NULL, updated_at = ?{extra} "
+            "WHERE collection = ? AND document_id = ?",
+            (stage, seconds, datetime.now().isoformat(), *fields.values(), collection, document_id)
+        )
+        self.conn.commit()
+
+    def fail(self, collection: str, document_id: str, error: str) -> None:
+        self.conn.execute(
+            "UPDATE ingestion_ledger SET error = ?, updated_at = ? WHERE collection = ? AND document_id = ?",
+            (error, datetime.now().isoformat(), collection, document_id)
+        )
+        self.conn.commit()
+
+    def copy(self, source: str, target: str) -> None:
+        """Copia las filas de una colección a otra (la versión nueva sembrada con source)."""
+        self.conn.execute(
+            "INSERT OR REPLACE INTO ingestion_ledger SELECT ?, document_id, fingerprint, stage, num_chunks, dim, "
+            "seconds_fetched, seconds_chunked, seconds_embedded, seconds_stored, error, updated_at "
+            "FROM ingestion_ledger WHERE collection = ?",
+            (target, source)
+        )
+        self.conn.commit()
+
+    def rows(self, collection: str) -> List[Dict]:
+        return [dict(r) for r in self.conn.execute(
+            "SELECT * FROM ingestion_ledger WHERE collection = ? ORDER BY document_id", (collection,)
+        ).fetchall()]
+
+
+class IngestionJob:
+    """
+    Ejecuta la ingesta de un manifiesto sobre una instancia de VectorEmbeddings.
+
+    Args:
+        vector_db: Base de datos vectorial donde se almacenan los chunks
+        manifest_path: Ruta del manifiesto JSON con los documentos del corpus
+        work_dir: Carpeta donde se guardan los resultados intermedios de cada etapa
+        ledger: Ledger de ingesta (por defecto ./data/sqlite/ingestion_ledger.db)
+        pause: Segundos de espera tras cada lote codificado o almacenado, para ceder CPU y disco a las consultas
+    """
+
+    def __init__(self, vector_db: VectorEmbeddings, manifest_path: str, work_dir: str = "./data/ingestion",
+                 ledger: IngestionLedger = None, pause: float = 0.0):
+        self.db = vector_db
+        self.pause = pause
+        self.manifest = load_manifest(manifest_path)
+        self.collection = vector_db.name
+        self.work_dir = os.path.join(work_dir, self.collection)
+        self.ledger = ledger or IngestionLedger()
+
+    def fingerprint(self, entry: Dict) -> str:
+        """Huella de la entrada del manifiesto y de los parámetros que afectan a los chunks y embeddings."""
+        payload = json.dumps({
+            "entry": entry,
+            "chunk_size": self.db.chunk_size,
+            "chunk_overlap": self.db.chunk_overlap,
+            "model_id": self.db.model_id,
+        }, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _paths(self, document_id: str) -> Dict[str, str]:
+        doc_dir = os.path.join(self.work_dir, document_id)
+        os.makedirs(doc_dir, exist_ok=True)
+        return {
+            "dir": doc_dir,
+            "markdown": os.path.join(doc_dir, "document.md"),
+            "chunks": os.path.join(doc_dir, "chunks.jsonl"),
+            "embeddings": os.path.join(doc_dir, "embeddings.f32"),
+            # Pesos léxicos de cada chunk (una línea JSON por chunk), calculados junto con los embeddings
+            "sparse": os.path.join(doc_dir, "sparse.jsonl"),
+        }
+
+    @staticmethod
+    def _read_chunks(path: str) -> Iterator[Dict]:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                yield json.loads(line)
+
+    # ------------------------------------------------------------------
+    # Etapas
+    # ------------------------------------------------------------------
+    def _fetch(self, entry: Dict, paths: Dict, state: Dict) -> Dict:
+        md_content = self.db.extract_MD(entry["source"])
+        if not md_content:
+            raise ValueError("No Markdown content was extracted")
+        tmp_path = paths["markdown"] + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(md_content)
+        os.replace(tmp_path, paths["markdown"])
+        return {}
+
+    def _chunk(self, entry: Dict, paths: Dict, state: Dict) -> Dict:
+        with open(paths["markdown"], "r", encoding="utf-8") as f:
+            md_content = f.read()
+        base_metadata = self.db.build_base_metadata(
+            DocumentType[entry["document_type"]], entry["document_id"], entry.get("metadata"), entry.get("related_docs")
+        )
+        num_chunks = 0
+        tmp_path = paths["chunks"] + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for chunk in self.db.split_markdown_BOE(md_content, base_metadata):
+                f.write(json.dumps(chunk, ensure_ascii=False) + "\n")
+                num_chunks += 1
+        if num_chunks == 0:
+            raise ValueError("No chunks were generated from the document")
+        os.replace(tmp_path, paths["chunks"])
+        return {"num_chunks": num_chunks}
+
+    def _embed(self, entry: Dict, paths: Dict, state: Dict) -> Dict:
+        dim = None
+        tmp_path = paths["embeddings"] + ".tmp"
+        sparse_tmp_path = paths["sparse"] + ".tmp"
+        with open(tmp_path, "wb") as f, open(sparse_tmp_path, "w", encoding="utf-8") as sparse_f:
+            for batch in batched(self._read_chunks(paths["chunks"]), self.db.insert_batch_size):
+                embeddings, sparse_weights = self.db.encode_chunks([chunk["content"] for chunk in batch])
+                embeddings = np.asarray(embeddings, dtype=np.float32)
+                dim = embeddings.shape[1]
+                f.write(embeddings.tobytes())
+                for weights in sparse_weights or []:
+                    sparse_f.write(json.dumps(weights) + "\n")
+                if self.pause:
+                    time.sleep(self.pause)
+        if self.db.sparse_index is not None:
+            os.replace(sparse_tmp_path, paths["sparse"])
+        else:
+            os.remove(sparse_tmp_path)
+        os.replace(tmp_path, paths["embeddings"])
+        return {"dim": dim}
+
+    def _read_sparse(self, paths: Dict) -> Iterator[Optional[Dict[int, float]]]:
+        """Pesos léxicos guardados por _embed, o None por chunk si no hay índice léxico o no se guardaron."""
+        if self.db.sparse_index is None or not os.path.exists(paths["sparse"]):
+            if self.db.sparse_index is not None:
+                print(f"Warning: {paths['sparse']} not found; run python -m src.sparse build to index these chunks")
+            while True:
+                yield None
+        with open(paths["sparse"], "r", encoding="utf-8") as f:
+            for line in f:
+                yield {int(token): weight for token, weight in json.loads(line).items()}
+
+    def _store(self, entry: Dict, paths: Dict, state: Dict) -> Dict:
+        document_id = entry["document_id"]
+        embeddings = np.memmap(paths["embeddings"], dtype=np.float32, mode="r").reshape(state["num_chunks"], state["dim"])
+        # Se eliminan antes los chunks que hubiera de una ejecución interrumpida para no duplicarlos
+        self.db.delete_document(document_id)
+        blocks = self.db.block_index.builder()
+        sparse = self._read_sparse(paths)
+        offset = 0
+        for batch in batched(self._read_chunks(paths["chunks"]), self.db.insert_batch_size):
+            ids = [self.db.chunk_id(document_id, offset + i) for i in range(len(batch))]
+            sparse_weights = [next(sparse) for _ in batch]
+            # Los casi duplicados de chunks ya almacenados se enlazan a su canónico en lugar de almacenarse
+            kept = self.db.filter_duplicates(ids, batch)
+            if kept:
+                kept_ids, kept_chunks = [ids[i] for i in kept], [batch[i] for i in kept]
+                kept_embeddings = embeddings[offset:offset + len(batch)][kept].tolist()
+                kept_sparse = [sparse_weights[i] for i in kept]
+                self.db.store_chunks(kept_ids, kept_chunks, kept_embeddings,
+                                     kept_sparse if all(w is not None for w in kept_sparse) else None)
+                blocks.add(kept_ids, kept_chunks, kept_embeddings)
+            offset += len(batch)
+            if self.pause:
+                time.sleep(self.pause)
+        blocks.flush()
+        self.db.citations.save()
+        return {}
+
+    # ------------------------------------------------------------------
+    # Ejecución
+    # ------------------------------------------------------------------
+    def run(self, restart: List[str] = None, only: List[str] = None, keep_artifacts: bool = False) -> List[Dict]:
+        """
+        Procesa los documentos del manifiesto continuando desde la última etapa completada.
+
+        Args:
+            restart: IDs de documentos que se procesan desde cero aunque estuvieran completados
+            only: Si se indica, solo se procesan estos IDs de documentos
+            keep_artifacts: Si se conservan los resultados intermedios de los documentos ya almacenados
+
+        Returns:
+            Las filas del ledger para la colección tras la ejecución
+        """
+        restart = set(restart or [])
+        stage_functions = {"fetched": self._fetch, "chunked": self._chunk, "embedded": self._embed, "stored": self._store}
+        failures = []
+
+        for entry in self.manifest["documents"]:
+            document_id = entry["document_id"]
+            if only and document_id not in only:
+                continue
+            fingerprint = self.fingerprint(entry)
+            state = self.ledger.get(self.collection, document_id)
+            if state is None or state["fingerprint"] != fingerprint or document_id in restart:
+                self.ledger.reset(self.collection, document_id, fingerprint)
+                state = self.ledger.get(self.collection, document_id)
+
+            done = STAGES.index(state["stage"]) + 1 if state["stage"] else 0
+            if done == len(STAGES):
+                print(f"Ingestion: {document_id} already stored, skipping")
+                continue
+
+            paths = self._paths(document_id)
+            try:
+                for stage in STAGES[done:]:
+                    print(f"Ingestion: {document_id} -> {stage}")
+                    start = time.perf_counter()
+                    fields = stage_functions[stage](entry, paths, state)
+                    elapsed = time.perf_counter() - start
+                    self.ledger.complete(self.collection, document_id, stage, elapsed, **fields)
+                    state = self.ledger.get(self.collection, document_id)
+                if not keep_artifacts:
+                    shutil.rmtree(paths["dir"], ignore_errors=True)
+            except Exception as e:
+                print(f"Ingestion: error processing {document_id}: {str(e)}")
+                self.ledger.fail(self.collection, document_id, str(e))
+                failures.append(document_id)
+
+        rows = self.ledger.rows(self.collection)
+        self.print_summary(rows)
+        if failures:
+            print(f"Ingestion: {len(failures)} documents failed and will resume on the next run: {failures}")
+        return rows
+
+    @staticmethod
+    def print_summary(rows: List[Dict]) -> None:
+        """Muestra la etapa de cada documento y el tiempo invertido por etapa."""
+        print(f"\n{'documento':<22} {'etapa':<9} {'chunks':>7} " + " ".join(f"{s:>9}" for s in STAGES))
+        totals = {stage: 0.0 for stage in STAGES}
+        for row in rows:
+            for stage in STAGES:
+                totals[stage] += row[f"seconds_{stage}"] or 0.0
+            print(f"{row['document_id']:<22} {row['stage'] or '-':<9} {row['num_chunks'] or 0:>7} "
+                  + " ".join(f"{row[f'seconds_{s}'] or 0.0:>8.1f}s" for s in STAGES)
+                  + (f"  ERROR: {row['error']}" if row["error"] else ""))
+        print(f"{'total':<22} {'':<9} {'':>7} " + " ".join(f"{totals[s]:>8.1f}s" for s in STAGES))
+
+
+def main():
+    from src.inference_pool import SAMPLE_QUESTIONS
+
+    parser = argparse.ArgumentParser(description="Ingesta reanudable del corpus a partir de un manifiesto")
+    parser.add_argument("--manifest", default="data/manifest/corpus.json")
+    parser.add_argument("--collection", default=None, help="Colección destino (por defecto la del manifiesto)")
+    parser.add_argument("--restart", nargs="*", default=[], help="Documentos que se procesan desde cero")
+    parser.add_argument("--only", nargs="*", default=None, help="Procesar solo estos documentos")
+    parser.add_argument("--keep-artifacts", action="store_true")
+    parser.add_argument("--gpu", action="store_true", help="Mover el modelo de embeddings a la GPU")
+    parser.add_argument("--warm-cache", action="store_true",
+                        help="Precalentar la caché de respuestas con las preguntas frecuentes del historial (src/cache_warmer.py)")
+    parser.add_argument("--in-place", action="store_true",
+                        help="Escribir directamente en la colección en uso en lugar de construir una versión nueva")
+    parser.add_argument("--fresh", action="store_true", help="Descartar una versión en construcción y empezar otra")
+    parser.add_argument("--no-promote", action="store_true", help="Construir y validar la versión sin ponerla en uso")
+    parser.add_argument("--min-ratio", type=float, default=0.9,
+                        help="Fracción mínima de chunks de la versión nueva respecto a la actual para promocionarla")
+    parser.add_argument("--keep", type=int, default=2, help="Versiones que se conservan tras promocionar, incluida la nueva")
+    parser.add_argument("--pause", type=float, default=0.0, help="Segundos de pausa entre lotes")
+    parser.add_argument("--threads", type=int, default=None, help="Hilos de torch de la ingesta")
+    parser.add_argument("--nice", type=int, default=0, help="Incremento de la prioridad nice del proceso")
+    args = parser.parse_args()
+
+    if args.nice:
+        os.nice(args.nice)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    manifest = load_manifest(args.manifest)
+    legal_db = VectorEmbeddings(args.collection or manifest["collection"])
+    if args.gpu:
+        legal_db.move_to_gpu()
+    ledger = IngestionLedger()
+    reference_count = legal_db.collection.count()
+    if not args.in_place:
+        if args.fresh:
+            legal_db.alias.abandon_build()
+        version, seeded_from = legal_db.begin_version(pause=args.pause)
+        if seeded_from:
+            ledger.copy(seeded_from, version)
+    rows = IngestionJob(legal_db, args.manifest, ledger=ledger, pause=args.pause).run(
+        restart=args.restart, only=args.only, keep_artifacts=args.keep_artifacts)
+
+    if not args.in_place:
+        problems = validate_version(legal_db, rows, reference_count, min_ratio=args.min_ratio, questions=SAMPLE_QUESTIONS[:3])
+        if problems:
+            print(f"Ingestion: version {legal_db.name} not promoted; rerun to resume it or pass --fresh to discard it:")
+            for problem in problems:
+                print(f"  - {problem}")
+            sys.exit(1)
+        if args.no_promote:
+            print(f"Ingestion: version {legal_db.name} validated; promote it with python -m src.collection_versions promote "
+                  f"--collection {legal_db.alias.alias} --version {legal_db.name}")
+            return
+        legal_db.promote_version()
+        legal_db.gc_versions(keep=args.keep)
+    legal_db.gc_embedding_cache()
+    if args.warm_cache:
+        # En un proceso aparte para liberar antes la memoria de la ingesta
+        subprocess.run([sys.executable, "-m", "src.cache_warmer", "--purge-stale"], check=False)
+
+
+if __name__ == "__main__":
+    main()
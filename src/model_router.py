@@ -0,0 +1,158 @@
+import threading
+import time
+from typing import Dict, Tuple
+
+from src.RAG import DocumentType
+from src.profiling import span
+
+
+# Niveles de modelo ordenados del más rápido y barato al más lento y caro
+TIERS = ["lite", "flash", "pro", "thinking"]
+
+# Orden de los nodos del grafo que llaman a un modelo, para estimar lo que queda de petición
+NODE_ORDER = ["triage_agent", "reformulador", "especialista", "redactor"]
+
+# Temas del triaje que corresponden a una Comunidad Autónoma
+COMMUNITIES = {dt.name for dt in DocumentType if dt.value.startswith("Comunidad")}
+
+
+class ModelRouter:
+    """
+    Elige el modelo Gemini de cada nodo y petición a partir de señales que ya tiene el grafo:
+    número de temas del triaje (y cuántos son Comunidades Autónomas), longitud del contexto y
+    longitud del historial. Respeta un presupuesto opcional de latencia o coste por petición,
+    bajando de nivel cuando la estimación lo supera, y registra cada decisión.
+    """
+
+    # Estimaciones iniciales por llamada; la latencia se actualiza con las llamadas reales
+    DEFAULT_LATENCY_MS = {"lite": 800.0, "flash": 1200.0, "pro": 5000.0, "thinking": 8000.0}
+    DEFAULT_COST = {"lite": 1.0, "flash": 2.0, "pro": 10.0, "thinking": 8.0}
+    EWMA_ALPHA = 0.2
+
+    def __init__(self, models: Dict[str, object], latency_ms: Dict[str, float] = None, cost: Dict[str, float] = None, invoker=None):
+        """
+        Args:
+            models: Modelo a utilizar para cada nivel ("lite", "flash", "pro", "thinking")
+            latency_ms: Latencia estimada por llamada de cada nivel
+            cost: Coste relativo por llamada de cada nivel
+            invoker: ResilientInvoker opcional a través del que se hacen las llamadas (plazos, reintentos,
+                peticiones duplicadas y respaldo)
+        """
+        self.models = models
+        self.invoker = invoker
+        self.latency_ms = dict(latency_ms or self.DEFAULT_LATENCY_MS)
+        self.cost = dict(cost or self.DEFAULT_COST)
+        self.lock = threading.Lock()
+        self.stats: Dict[str, Dict[str, int]] = {node: {tier: 0 for tier in TIERS} for node in NODE_ORDER}
+
+    # ------------------------------------------------------------------
+    # Señales y reglas
+    # ------------------------------------------------------------------
+    @staticmethod
+    def signals(state: Dict) -> Dict:
+        topics = [t.strip().upper() for t in (state.get("contenido") or "").split(";") if t.strip()]
+        return {
+            "temas": len(topics),
+            "comunidades": sum(1 for t in topics if t in COMMUNITIES),
+            "contexto": len(state.get("contexto") or ""),
+            "historial": len(state.get("conversation_history") or []),
+        }
+
+    def preferred_tier(self, node: str, signals: Dict) -> Tuple[str, str]:
+        """Nivel que se usaría sin presupuesto, junto con el motivo."""
+        if node == "triage_agent":
+            return "flash", "el triaje necesita un JSON fiable"
+        if node == "reformulador":
+            if signals["historial"] == 0 and signals["temas"] <= 2:
+                return "lite", "pregunta sin historial y con pocos temas"
+            return "flash", "hay historial o varios temas que consolidar"
+        if node == "especialista":
+            if signals["comunidades"] >= 2 and (signals["contexto"] >= 24000 or signals["historial"] >= 4):
+                return "thinking", "varias comunidades con contexto o historial largos"
+            if signals["comunidades"] >= 2:
+                return "pro", "pregunta que abarca varias comunidades"
+            if signals["temas"] >= 3 or signals["contexto"] >= 12000 or signals["historial"] >= 2:
+                return "flash", "varios temas, contexto largo o historial"
+            return "lite", "pregunta simple"
+        if node == "redactor":
+            if signals["comunidades"] >= 2:
+                return "flash", "respuesta con varias comunidades"
+            return "lite" if signals["temas"] <= 2 else "flash", "redacción de la respuesta"
+        return "flash", "nodo sin reglas específicas"
+
+    def _spent(self, state: Dict) -> Tuple[float, float]:
+        decisions = state.get("decisiones_modelo") or []
+        latency = sum(d.get("latencia_ms", 0.0) for d in decisions)
+        cost = sum(self.cost[d["modelo"]] for d in decisions)
+        return latency, cost
+
+    def _remaining_estimate(self, node: str) -> Tuple[float, float]:
+        """Latencia y coste mínimos de los nodos que quedan después de node."""
+        remaining = NODE_ORDER[NODE_ORDER.index(node) + 1:] if node in NODE_ORDER else []
+        return (len(remaining) * min(self.latency_ms.values()), len(remaining) * min(self.cost.values()))
+
+    def choose(self, node: str, state: Dict) -> Dict:
+        """
+        Elige el nivel de modelo para un nodo y devuelve la decisión tomada.
+
+        El estado puede incluir "presupuesto_latencia_ms" y/o "presupuesto_coste" para la petición completa.
+        """
+        signals = self.signals(state)
+        tier, reason = self.preferred_tier(node, signals)
+
+        latency_budget = state.get("presupuesto_latencia_ms")
+        cost_budget = state.get("presupuesto_coste")
+        if latency_budget is not None or cost_budget is not None:
+            spent_latency, spent_cost = self._spent(state)
+            remaining_latency, remaining_cost = self._remaining_estimate(node)
+            # Se baja de nivel hasta que la petición completa quepa en el presupuesto. Cada paso elige el
+            # nivel inmediatamente inferior según la métrica excedida (el coste si se pasa del presupuesto de
+            # coste, si no la latencia estimada) y solo se acepta si la reduce
+            while True:
+                over_latency = latency_budget is not None and spent_latency + self.latency_ms[tier] + remaining_latency > latency_budget
+                over_cost = cost_budget is not None and spent_cost + self.cost[tier] + remaining_cost > cost_budget
+                if not (over_latency or over_cost):
+                    break
+                metric = self.cost if over_cost else self.latency_ms
+                cheaper = [t for t in TIERS if metric[t] < metric[tier]]
+                if not cheaper:
+                    break
+                tier = max(cheaper, key=lambda t: metric[t])
+                reason += "; rebajado por presupuesto"
+
+        with self.lock:
+            self.stats.setdefault(node, {t: 0 for t in TIERS})[tier] += 1
+        decision = {"nodo": node, "modelo": tier, "motivo": reason, "señales": signals}
+        print(f"Model router: {node} -> {tier} ({reason})")
+        return decision
+
+    def invoke(self, node: str, state: Dict, messages) -> Tuple[object, Dict]:
+        """
+        Elige el modelo para el nodo, lo invoca y devuelve la respuesta junto con la decisión
+        (incluida la latencia observada, que también actualiza la estimación del nivel).
+        """
+        decision = self.choose(node, state)
+        start = time.perf_counter()
+        answered_by = decision["modelo"]
+        with span(f"gemini:{decision['modelo']}"):
+            if self.invoker is not None:
+                response, info = self.invoker.invoke_with_info(decision["modelo"], messages, node=node)
+                answered_by = info["modelo"]
+                decision.update({"modelo_respuesta": answered_by, "intentos": info["intentos"],
+                                 "duplicada": info["duplicada"], "respaldo": info["respaldo"]})
+            else:
+                response = self.models[decision["modelo"]].invoke(messages)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        decision["latencia_ms"] = elapsed_ms
+        self.record_latency(answered_by, elapsed_ms)
+        return response, decision
+
+    def record_latency(self, tier: str, latency_ms: float) -> None:
+        with self.lock:
+            self.latency_ms[tier] = (1 - self.EWMA_ALPHA) * self.latency_ms[tier] + self.EWMA_ALPHA * latency_ms
+
+    def summary(self) -> Dict:
+        """Decisiones acumuladas por nodo y latencias estimadas actuales de cada nivel."""
+        with self.lock:
+            return {"decisiones": {node: dict(tiers) for node, tiers in self.stats.items()},
+                    "latencia_estimada_ms": dict(self.latency_ms)}
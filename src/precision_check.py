@@ -0,0 +1,144 @@
+"""
+Comprueba si una precisión reducida (bf16, int8 u onnx, ver src/cpu_inference.py) se puede adoptar.
+
+Compara los modelos con precisión reducida frente a los fp32 sobre el corpus real:
+- Deriva de los embeddings: similitud coseno entre el embedding fp32 y el reducido de cada chunk y pregunta.
+- Recuperación: solapamiento de los top-k chunks recuperados con los embeddings fp32 y los reducidos.
+- Reranking: correlación de Kendall entre las puntuaciones fp32 y reducidas de los candidatos de cada
+  pregunta y solapamiento de los top-n tras el rerank.
+- Coste: memoria de los pesos y latencia media de encode/predict.
+
+Uso:
+    python -m src.precision_check --precision int8 --chunks 2000
+"""
+import argparse
+import time
+from typing import Dict, List
+
+import chromadb
+import numpy as np
+import torch
+from huggingface_hub import snapshot_download
+
+from src.RAG import EMBEDDING_MODEL_ID, RERANKER_MODEL_ID
+from src.cpu_inference import CPU_PRECISIONS, load_embedder, load_reranker
+from src.hnsw_sweep import load_questions
+from src.inference_pool import SAMPLE_QUESTIONS
+
+
+def parameter_bytes(module) -> int:
+    """Memoria de los pesos (incluidos los empaquetados de las capas cuantizadas)."""
+    if not isinstance(module, torch.nn.Module):
+        return 0
+    state = module.state_dict()
+    total = 0
+    for value in state.values():
+        if isinstance(value, torch.Tensor):
+            total += value.numel() * value.element_size()
+        elif isinstance(value, tuple):
+            total += sum(v.numel() * v.element_size() for v in value if isinstance(v, torch.Tensor))
+    return total
+
+
+def normalize(embeddings: np.ndarray) -> np.ndarray:
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+
+def kendall_tau(a: np.ndarray, b: np.ndarray) -> float:
+    """Tau de Kendall (sin corrección de empates) entre dos listas de puntuaciones."""
+    n = len(a)
+    if n < 2:
+        return 1.0
+    i, j = np.triu_indices(n, k=1)
+    concordance = np.sign(a[i] - a[j]) * np.sign(b[i] - b[j])
+    return float(concordance.sum() / len(i))
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Deriva de los modelos con precisión reducida frente a fp32")
+    parser.add_argument("--precision", required=True, choices=[p for p in CPU_PRECISIONS if p != "fp32"])
+    parser.add_argument("--collection", default="normativa_tributaria-RAG")
+    parser.add_argument("--chroma-path", default="./data/chroma/vec")
+    parser.add_argument("--chunks", type=int, default=2000, help="Chunks del corpus que se codifican con ambos modelos")
+    parser.add_argument("--questions", default=None, help="Fichero con una pregunta por línea (por defecto, el historial)")
+    parser.add_argument("--k", type=int, default=10, help="Top-k para comparar la recuperación")
+    parser.add_argument("--candidates", type=int, default=50, help="Candidatos que se re-rankean por pregunta")
+    parser.add_argument("--top-n", type=int, default=5, help="Top-n para comparar el orden tras el rerank")
+    args = parser.parse_args()
+
+    collection = chromadb.PersistentClient(path=args.chroma_path).get_collection(args.collection)
+    ids = collection.get(include=[])["ids"]
+    rng = np.random.default_rng(0)
+    sample = [ids[i] for i in rng.choice(len(ids), size=min(args.chunks, len(ids)), replace=False)]
+    documents = collection.get(ids=sample, include=["documents"])["documents"]
+    questions = load_questions(args.questions) or SAMPLE_QUESTIONS
+    print(f"{len(documents)} chunks de {args.collection} y {len(questions)} preguntas\n")
+
+    embed_path = snapshot_download(repo_id=EMBEDDING_MODEL_ID, local_dir="./models/BGE")
+    rerank_path = snapshot_download(repo_id=RERANKER_MODEL_ID, local_dir="./models/Reranker")
+    models = {precision: (load_embedder(embed_path, precision), load_reranker(rerank_path, precision))
+              for precision in ("fp32", args.precision)}
+
+    # 1. Deriva de los embeddings y coste del encode
+    encoded: Dict[str, Dict[str, np.ndarray]] = {}
+    encode_seconds = {}
+    for precision, (embedder, _) in models.items():
+        chunks, seconds = timed(embedder.encode, documents, batch_size=32)
+        queries = embedder.encode(questions, batch_size=32)
+        encoded[precision] = {"chunks": normalize(chunks), "queries": normalize(queries)}
+        encode_seconds[precision] = seconds
+    reference, reduced = encoded["fp32"], encoded[args.precision]
+    chunk_cosine = np.sum(reference["chunks"] * reduced["chunks"], axis=1)
+    query_cosine = np.sum(reference["queries"] * reduced["queries"], axis=1)
+
+    # 2. Solapamiento de la recuperación sobre la muestra de chunks
+    k = min(args.k, len(documents))
+    top_reference = np.argsort(-(reference["queries"] @ reference["chunks"].T), axis=1)[:, :k]
+    top_reduced = np.argsort(-(reduced["queries"] @ reduced["chunks"].T), axis=1)[:, :k]
+    retrieval_overlap = np.mean([len(set(a) & set(b)) / k for a, b in zip(top_reference, top_reduced)])
+
+    # 3. Acuerdo del reranker sobre los candidatos fp32 de cada pregunta
+    candidates = np.argsort(-(reference["queries"] @ reference["chunks"].T), axis=1)[:, :args.candidates]
+    taus: List[float] = []
+    top_overlaps: List[float] = []
+    rerank_seconds = {precision: 0.0 for precision in models}
+    for q, rows in enumerate(candidates):
+        pairs = [(questions[q], documents[i]) for i in rows]
+        scores = {}
+        for precision, (_, reranker) in models.items():
+            scores[precision], seconds = timed(reranker.predict, pairs, batch_size=16, show_progress_bar=False)
+            scores[precision] = np.asarray(scores[precision], dtype=np.float32)
+            rerank_seconds[precision] += seconds
+        taus.append(kendall_tau(scores["fp32"], scores[args.precision]))
+        n = min(args.top_n, len(rows))
+        top_overlaps.append(len(set(np.argsort(-scores["fp32"])[:n]) & set(np.argsort(-scores[args.precision])[:n])) / n)
+
+    print(f"{'':<22} {'fp32':>12} {args.precision:>12}")
+    for label, values in (
+        ("pesos embedder (MB)", {p: parameter_bytes(m[0][0].auto_model) / 1e6 if hasattr(m[0][0], "auto_model") else float("nan") for p, m in models.items()}),
+        ("pesos reranker (MB)", {p: parameter_bytes(m[1].model) / 1e6 for p, m in models.items()}),
+        ("encode ms/chunk", {p: encode_seconds[p] / len(documents) * 1000 for p in models}),
+        ("rerank ms/par", {p: rerank_seconds[p] / max(1, candidates.size) * 1000 for p in models}),
+    ):
+        print(f"{label:<22} {values['fp32']:>12.2f} {values[args.precision]:>12.2f}")
+
+    print(f"\nCoseno fp32 vs {args.precision} (chunks):    media {chunk_cosine.mean():.4f}  p5 {np.percentile(chunk_cosine, 5):.4f}  mín {chunk_cosine.min():.4f}")
+    print(f"Coseno fp32 vs {args.precision} (preguntas): media {query_cosine.mean():.4f}  mín {query_cosine.min():.4f}")
+    print(f"Solapamiento top-{k} de la recuperación: {retrieval_overlap:.3f}")
+    print(f"Kendall tau del rerank (media / mín):   {np.mean(taus):.3f} / {np.min(taus):.3f}")
+    print(f"Solapamiento top-{args.top_n} tras el rerank:    {np.mean(top_overlaps):.3f}")
+
+    adoptable = chunk_cosine.mean() >= 0.99 and retrieval_overlap >= 0.9 and np.mean(top_overlaps) >= 0.9
+    print(f"\n{'Se puede adoptar' if adoptable else 'No se recomienda adoptar'} cpu_precision={args.precision} "
+          f"(criterio: coseno medio >= 0.99 y solapamientos >= 0.9)")
+
+
+if __name__ == "__main__":
+    main()
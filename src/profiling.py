@@ -0,0 +1,188 @@
+"""
+Perfilado bajo demanda en producción.
+
+- SamplingProfiler: muestrea durante una ventana de tiempo las pilas de todos los hilos del proceso
+  (sys._current_frames) y las agrega en formato "folded" (una línea "marco;marco;marco N" por pila),
+  el que leen flamegraph.pl, speedscope o inferno.
+- Trazas por petición: span() y @traced marcan etapas (nodos de LangGraph, etapas de VectorEmbeddings,
+  tokenización, llamadas a Gemini y a SQLite). Solo se registran si la petición tiene una traza activa
+  (start_trace); sin traza el coste es una lectura de una ContextVar por llamada. La traza se exporta
+  también en formato folded, con el tiempo propio de cada etapa en microsegundos como peso.
+
+La traza se propaga a los hilos con el contexto de contextvars: run_in_threadpool de Starlette ya lo
+copia y InferenceExecutor lo copia al enviar cada tarea.
+"""
+import functools
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+PROFILES_DIR = "./data/profiles"
+
+
+class Trace:
+    """Tiempos de las etapas de una petición, identificadas por su ruta de spans anidados."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.lock = threading.Lock()
+        self.totals: Dict[Tuple[str, ...], float] = {}
+        self.calls: Counter = Counter()
+        self.start = time.perf_counter()
+        self.elapsed = 0.0
+
+    def record(self, path: Tuple[str, ...], seconds: float) -> None:
+        with self.lock:
+            self.totals[path] = self.totals.get(path, 0.0) + seconds
+            self.calls[path] += 1
+
+    def folded(self) -> str:
+        """Pilas en formato folded con el tiempo propio (sin el de sus hijas) en microsegundos."""
+        totals = dict(self.totals)
+        totals[()] = self.elapsed
+        children: Dict[Tuple[str, ...], float] = {}
+        for path, seconds in totals.items():
+            if path:
+                children[path[:-1]] = children.get(path[:-1], 0.0) + seconds
+        lines = []
+        for path, seconds in sorted(totals.items()):
+            own = max(0.0, seconds - children.get(path, 0.0))
+            if own > 0:
+                lines.append(f"{';'.join((self.name,) + path)} {int(own * 1e6)}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> List[Dict]:
+        return [{"etapa": "/".join(path), "llamadas": self.calls[path], "ms": round(seconds * 1000, 2)}
+                for path, seconds in sorted(self.totals.items(), key=lambda item: -item[1])]
+
+
+_trace: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+_path: ContextVar[Tuple[str, ...]] = ContextVar("trace_path", default=())
+
+
+def start_trace(name: str = "request"):
+    """Activa una traza en el contexto actual. Devuelve el token para stop_trace."""
+    return _trace.set(Trace(name))
+
+
+def stop_trace(token) -> Trace:
+    """Cierra la traza activada con start_trace y la devuelve."""
+    trace = _trace.get()
+    _trace.reset(token)
+    trace.elapsed = time.perf_counter() - trace.start
+    return trace
+
+
+@contextmanager
+def _span(trace: Trace, name: str):
+    path = _path.get() + (name,)
+    token = _path.set(path)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.record(path, time.perf_counter() - start)
+        _path.reset(token)
+
+
+@contextmanager
+def _null_span():
+    yield
+
+
+def span(name: str):
+    """Context manager que mide una etapa si hay una traza activa."""
+    trace = _trace.get()
+    if trace is None:
+        return _null_span()
+    return _span(trace, name)
+
+
+def traced(name: str) -> Callable:
+    """Decorador que mide cada llamada a la función como una etapa de la traza activa."""
+    def decorator(fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            trace = _trace.get()
+            if trace is None:
+                return fn(*args, **kwargs)
+            with _span(trace, name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def save_profile(content: str, kind: str, label: str = "") -> str:
+    """Guarda un perfil folded en PROFILES_DIR y devuelve el nombre del fichero."""
+    os.makedirs(PROFILES_DIR, exist_ok=True)
+    suffix = f"-{label}" if label else ""
+    name = f"{kind}-{datetime.now().strftime('%Y%m%dT%H%M%S%f')}{suffix}.folded"
+    with open(os.path.join(PROFILES_DIR, name), "w", encoding="utf-8") as f:
+        f.write(content)
+    return name
+
+
+class SamplingProfiler:
+    """
+    Perfilador de muestreo de todos los hilos del proceso durante una ventana de tiempo.
+
+    Solo hay coste mientras se muestrea: un hilo que cada interval segundos lee las pilas de todos los
+    hilos con sys._current_frames. Solo se admite un perfil a la vez.
+
+    Args:
+        interval: Segundos entre muestras
+        max_depth: Profundidad máxima de las pilas
+    """
+
+    def __init__(self, interval: float = 0.005, max_depth: int = 128):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _label(frame) -> str:
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def _stack(self, frame) -> List[str]:
+        stack = []
+        while frame is not None and len(stack) < self.max_depth:
+            stack.append(self._label(frame))
+            frame = frame.f_back
+        return stack[::-1]
+
+    def run(self, seconds: float, include_idle: bool = False) -> str:
+        """
+        Muestrea durante seconds segundos y devuelve las pilas en formato folded (peso = número de muestras).
+
+        Args:
+            seconds: Duración de la ventana
+            include_idle: Incluir los hilos que están esperando (en wait, select, ...); por defecto se
+                descartan las pilas que terminan en una espera para que el perfil refleje uso de CPU
+        """
+        if not self.lock.acquire(blocking=False):
+            raise RuntimeError("Ya hay un perfil de muestreo en curso")
+        try:
+            own = threading.get_ident()
+            samples: Counter = Counter()
+            idle = {"wait", "select", "poll", "epoll", "accept", "sleep", "_worker", "get", "acquire", "recv_into", "run_forever"}
+            deadline = time.perf_counter() + seconds
+            while time.perf_counter() < deadline:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == own:
+                        continue
+                    if not include_idle and frame.f_code.co_name in idle:
+                        continue
+                    stack = [names.get(ident, str(ident))] + self._stack(frame)
+                    samples[";".join(stack)] += 1
+                time.sleep(self.interval)
+            return "".join(f"{stack} {count}\n" for stack, count in samples.most_common())
+        finally:
+            self.lock.release()
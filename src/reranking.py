@@ -0,0 +1,104 @@
+import threading
+import time
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+from sentence_transformers import CrossEncoder
+
+
+class RerankEngine:
+    """
+    Puntúa pares (consulta - documento) con un CrossEncoder agrupándolos por longitud en tokens.
+
+    Los pares se ordenan por su longitud tokenizada y se reparten en buckets cuyo tamaño se ajusta a un
+    presupuesto de tokens por batch: los chunks cortos se procesan en batches grandes y los largos en
+    batches pequeños, de modo que apenas se desperdicia cómputo en padding. La longitud máxima de
+    secuencia se fija explícitamente en el modelo para que la truncación sea predecible.
+    """
+
+    def __init__(self, cross_encoder: CrossEncoder, max_length: int = 1024, token_budget: int = 16384, max_batch_size: int = 128):
+        """
+        Args:
+            cross_encoder: Modelo CrossEncoder con el que se puntúan los pares
+            max_length: Longitud máxima (en tokens) de cada par; lo que exceda se trunca
+            token_budget: Número máximo de tokens (filas x longitud con padding) por batch
+            max_batch_size: Número máximo de pares por batch, aunque sobre presupuesto
+        """
+        self.cross_encoder = cross_encoder
+        self.cross_encoder.max_length = max_length
+        self.max_length = max_length
+        self.token_budget = token_budget
+        self.max_batch_size = max_batch_size
+        self.stats = {"pairs": 0, "seconds": 0.0, "batches": 0}
+        self.lock = threading.Lock()
+
+    def _token_lengths(self, pairs: Sequence[Tuple[str, str]]) -> np.ndarray:
+        queries = [q for q, _ in pairs]
+        documents = [d for _, d in pairs]
+        encoded = self.cross_encoder.tokenizer(
+            queries, documents, truncation="longest_first", max_length=self.max_length
+        )["input_ids"]
+        return np.fromiter((len(ids) for ids in encoded), dtype=np.int32, count=len(encoded))
+
+    def _buckets(self, sorted_lengths: np.ndarray) -> List[Tuple[int, int]]:
+        """Devuelve los rangos [inicio, fin) de cada batch sobre los pares ya ordenados por longitud."""
+        buckets = []
+        start = 0
+        for i, length in enumerate(sorted_lengths):
+            size = i - start + 1
+            # Al estar ordenados, la longitud con padding del batch es la del último par añadido
+            if size > self.max_batch_size or size * int(length) > self.token_budget:
+                if i > start:
+                    buckets.append((start, i))
+                start = i
+        if start < len(sorted_lengths):
+            buckets.append((start, len(sorted_lengths)))
+        return buckets
+
+    def score(self, pairs: Sequence[Tuple[str, str]]) -> np.ndarray:
+        """
+        Puntúa los pares y devuelve las puntuaciones en el mismo orden en que se recibieron.
+        """
+        if len(pairs) == 0:
+            return np.empty(0, dtype=np.float32)
+        start_time = time.perf_counter()
+
+        lengths = self._token_lengths(pairs)
+        order = np.argsort(lengths, kind="stable")
+        sorted_pairs = [pairs[i] for i in order]
+        buckets = self._buckets(lengths[order])
+
+        sorted_scores = np.empty(len(pairs), dtype=np.float32)
+        for start, end in buckets:
+            sorted_scores[start:end] = self.cross_encoder.predict(
+                sorted_pairs[start:end], batch_size=end - start, convert_to_numpy=True, show_progress_bar=False
+            )
+        scores = np.empty_like(sorted_scores)
+        scores[order] = sorted_scores
+
+        elapsed = time.perf_counter() - start_time
+        with self.lock:
+            self.stats["pairs"] += len(pairs)
+            self.stats["seconds"] += elapsed
+            self.stats["batches"] += len(buckets)
+        print(f"Reranked {len(pairs)} pairs in {len(buckets)} batches: {len(pairs) / elapsed:.1f} pairs/s")
+        return scores
+
+    @staticmethod
+    def select(results: List[Dict], scores: np.ndarray, threshold: float) -> List[Dict]:
+        """
+        Asocia las puntuaciones a los resultados y devuelve, ordenados de mayor a menor puntuación,
+        los que superan el umbral.
+        """
+        scores = np.asarray(scores, dtype=np.float32)
+        order = np.argsort(-scores, kind="stable")
+        order = order[scores[order] > threshold]
+        selected = []
+        for i in order:
+            results[i]["rerank_score"] = float(scores[i])
+            selected.append(results[i])
+        return selected
+
+    def throughput(self) -> float:
+        """Pares por segundo acumulados desde que se creó el motor."""
+        return self.stats["pairs"] / self.stats["seconds"] if self.stats["seconds"] else 0.0
@@ -0,0 +1,231 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Dict, Optional, Tuple
+
+
+class InvocationTimeout(Exception):
+    """Se ha agotado el plazo de un nodo sin obtener respuesta de ningún modelo."""
+
+
+class TierSaturated(Exception):
+    """El nivel tiene ya el máximo de llamadas en curso (normalmente abandonadas tras vencer su plazo)."""
+
+
+class ResilientInvoker:
+    """
+    Envoltorio de las llamadas .invoke a los modelos para recortar la latencia de cola.
+
+    Cada llamada tiene un plazo por nodo. Dentro de ese plazo:
+    - Si la respuesta tarda más que el percentil configurado de las latencias observadas del modelo,
+      se lanza una petición duplicada (hedged request) y se usa la primera que responda.
+    - Si la llamada falla, se reintenta con backoff exponencial.
+    - Si se agotan los reintentos, se pasa al modelo de respaldo configurado (p.ej. lite -> flash).
+
+    Las llamadas síncronas no se pueden cancelar: las que pierden la carrera o vencen el plazo terminan
+    en segundo plano y su resultado se descarta. Para que no acaparen los hilos, los clientes de los modelos
+    deben tener un timeout de petición (ver request_timeout_s) y cada nivel admite como mucho
+    max_in_flight_per_tier llamadas en curso: con el nivel lleno no se duplican peticiones y la llamada
+    pasa directamente al nivel de respaldo.
+    """
+
+    DEFAULT_FALLBACKS = {"lite": "flash", "flash": "lite", "pro": "flash", "thinking": "pro"}
+    DEFAULT_DEADLINES_S = {"triage_agent": 15.0, "reformulador": 15.0, "especialista": 45.0, "redactor": 30.0}
+
+    def __init__(self,
+                 models: Dict[str, object],
+                 fallbacks: Dict[str, str] = None,
+                 deadlines_s: Dict[str, float] = None,
+                 default_deadline_s: float = 30.0,
+                 max_retries: int = 2,
+                 backoff_base_s: float = 0.5,
+                 hedge_percentile: float = 95.0,
+                 hedge_min_samples: int = 20,
+                 latency_window: int = 200,
+                 primary_share: float = 0.6,
+                 max_workers: int = 32,
+                 max_in_flight_per_tier: int = 8):
+        """
+        Args:
+            models: Modelo de cada nivel; basta con que tenga un método invoke(messages)
+            fallbacks: Nivel de respaldo de cada nivel
+            deadlines_s: Plazo en segundos de cada nodo del grafo
+            default_deadline_s: Plazo de los nodos sin plazo específico
+            max_retries: Reintentos por nivel antes de pasar al de respaldo
+            backoff_base_s: Espera antes del primer reintento; se duplica en cada reintento
+            hedge_percentile: Percentil de latencia observada a partir del cual se lanza la petición duplicada
+            hedge_min_samples: Muestras necesarias antes de empezar a duplicar peticiones
+            latency_window: Número de latencias recientes que se guardan por nivel
+            primary_share: Fracción del plazo restante que puede consumir un nivel cuando hay respaldo
+            max_workers: Hilos disponibles para llamadas en curso (incluidas las duplicadas)
+            max_in_flight_per_tier: Llamadas en curso como máximo por nivel, incluidas las abandonadas tras
+                vencer el plazo, para que un nivel colgado no ocupe todos los hilos
+        """
+        self.models = models
+        self.fallbacks = dict(self.DEFAULT_FALLBACKS if fallbacks is None else fallbacks)
+        self.deadlines_s = dict(self.DEFAULT_DEADLINES_S if deadlines_s is None else deadlines_s)
+        self.default_deadline_s = default_deadline_s
+        self.max_retries = max_retries
+        self.backoff_base_s = backoff_base_s
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.primary_share = primary_share
+        self.max_in_flight_per_tier = max_in_flight_per_tier
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="llm")
+        self.lock = threading.Lock()
+        self.latencies = {tier: deque(maxlen=latency_window) for tier in models}
+        self.in_flight = {tier: 0 for tier in models}
+        self.metrics = {"calls": 0, "hedges": 0, "hedge_wins": 0, "retries": 0, "fallbacks": 0, "timeouts": 0, "errors": 0,
+                        "saturated": 0}
+
+    @classmethod
+    def request_timeout_s(cls, deadlines_s: Dict[str, float] = None, default_deadline_s: float = 30.0) -> float:
+        """
+        Timeout de petición para los clientes de los modelos: el plazo del nodo más largo, ya que cualquier
+        nivel puede atender cualquier nodo. Ninguna llamada abandonada sigue ocupando un hilo más allá.
+        """
+        deadlines = cls.DEFAULT_DEADLINES_S if deadlines_s is None else deadlines_s
+        return max([default_deadline_s, *deadlines.values()])
+
+    # ------------------------------------------------------------------
+    # Latencias y métricas
+    # ------------------------------------------------------------------
+    def _count(self, key: str, amount: int = 1) -> None:
+        with self.lock:
+            self.metrics[key] += amount
+
+    def _record_latency(self, tier: str, seconds: float) -> None:
+        with self.lock:
+            self.latencies.setdefault(tier, deque(maxlen=200)).append(seconds)
+
+    def hedge_delay(self, tier: str) -> Optional[float]:
+        """Retraso tras el que se duplica la petición, o None si aún no hay suficientes muestras."""
+        with self.lock:
+            samples = sorted(self.latencies.get(tier, ()))
+        if len(samples) < self.hedge_min_samples:
+            return None
+        index = min(len(samples) - 1, int(round(self.hedge_percentile / 100 * (len(samples) - 1))))
+        return samples[index]
+
+    def summary(self) -> Dict:
+        """Contadores acumulados y tasas de duplicación y respaldo."""
+        with self.lock:
+            metrics = dict(self.metrics)
+            metrics["in_flight"] = dict(self.in_flight)
+            latencies = {tier: sorted(values) for tier, values in self.latencies.items()}
+        calls = metrics["calls"] or 1
+        metrics["hedge_rate"] = metrics["hedges"] / calls
+        metrics["fallback_rate"] = metrics["fallbacks"] / calls
+        metrics["timeout_rate"] = metrics["timeouts"] / calls
+        metrics["latency_p50_s"] = {t: v[len(v) // 2] for t, v in latencies.items() if v}
+        metrics["latency_p99_s"] = {t: v[min(len(v) - 1, int(0.99 * len(v)))] for t, v in latencies.items() if v}
+        return metrics
+
+    # ------------------------------------------------------------------
+    # Invocación
+    # ------------------------------------------------------------------
+    def _timed_invoke(self, tier: str, messages) -> Tuple[object, float]:
+        start = time.perf_counter()
+        response = self.models[tier].invoke(messages)
+        return response, time.perf_counter() - start
+
+    def _release(self, tier: str) -> None:
+        with self.lock:
+            self.in_flight[tier] -= 1
+
+    def _submit(self, tier: str, messages):
+        """Lanza una llamada al nivel si no ha alcanzado su máximo de llamadas en curso; si no, devuelve None."""
+        with self.lock:
+            if self.in_flight.get(tier, 0) >= self.max_in_flight_per_tier:
+                return None
+            self.in_flight[tier] = self.in_flight.get(tier, 0) + 1
+        future = self.executor.submit(self._timed_invoke, tier, messages)
+        future.add_done_callback(lambda _: self._release(tier))
+        return future
+
+    def _hedged_call(self, tier: str, messages, timeout: float) -> Tuple[object, bool]:
+        """Lanza la llamada y, si tarda más que el retraso de duplicación, una segunda idéntica."""
+        deadline = time.monotonic() + timeout
+        future = self._submit(tier, messages)
+        if future is None:
+            self._count("saturated")
+            raise TierSaturated(f"{tier} tiene {self.max_in_flight_per_tier} llamadas en curso")
+        futures = [future]
+        delay = self.hedge_delay(tier)
+        hedged = False
+
+        done, _ = wait(futures, timeout=min(delay, timeout) if delay is not None else timeout)
+        if not done and delay is not None and time.monotonic() < deadline:
+            hedge = self._submit(tier, messages)
+            if hedge is not None:
+                futures.append(hedge)
+                hedged = True
+                self._count("hedges")
+
+        error = None
+        pending = set(futures)
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    response, seconds = future.result()
+                    self._record_latency(tier, seconds)
+                    if hedged and future is futures[1]:
+                        self._count("hedge_wins")
+                    return response, hedged
+                error = future.exception()
+        if error is not None and not pending:
+            raise error
+        self._count("timeouts")
+        raise InvocationTimeout(f"Sin respuesta de {tier} en {timeout:.1f}s")
+
+    def invoke_with_info(self, tier: str, messages, node: str = None) -> Tuple[object, Dict]:
+        """
+        Invoca el modelo del nivel indicado con plazo, reintentos, duplicación y respaldo.
+
+        Returns:
+            La respuesta y un diccionario con el nivel que respondió, los intentos y si hubo duplicación
+        """
+        self._count("calls")
+        deadline = time.monotonic() + self.deadlines_s.get(node, self.default_deadline_s)
+        tiers = [tier]
+        if self.fallbacks.get(tier) and self.fallbacks[tier] in self.models and self.fallbacks[tier] != tier:
+            tiers.append(self.fallbacks[tier])
+
+        attempts = 0
+        last_error: Exception = InvocationTimeout(f"Plazo agotado para {node or tier}")
+        for position, current in enumerate(tiers):
+            if position > 0:
+                self._count("fallbacks")
+                print(f"Resilient invoker: falling back from {tier} to {current} ({node})")
+            for retry in range(self.max_retries + 1):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                if retry > 0:
+                    self._count("retries")
+                attempts += 1
+                # Si queda un nivel de respaldo se le reserva parte del plazo
+                timeout = remaining if position == len(tiers) - 1 else remaining * self.primary_share
+                try:
+                    response, hedged = self._hedged_call(current, messages, timeout)
+                    return response, {"modelo": current, "intentos": attempts, "duplicada": hedged, "respaldo": position > 0}
+                except (InvocationTimeout, TierSaturated) as e:
+                    # Tras agotar el plazo o con el nivel lleno no tiene sentido reintentar el mismo nivel
+                    last_error = e
+                    break
+                except Exception as e:
+                    last_error = e
+                    self._count("errors")
+                    print(f"Resilient invoker: error calling {current} ({node}): {str(e)}")
+                    backoff = self.backoff_base_s * (2 ** retry)
+                    time.sleep(max(0.0, min(backoff, deadline - time.monotonic())))
+        raise last_error
+
+    def invoke(self, tier: str, messages, node: str = None):
+        response, _ = self.invoke_with_info(tier, messages, node=node)
+        return response
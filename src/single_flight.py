@@ -0,0 +1,128 @@
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+# Resultado de SingleFlight.run: la petición calculó la respuesta, esperó a otra idéntica en curso o
+# recibió la respuesta ya terminada de una petición idéntica reciente
+LEADER = "leader"
+COALESCED = "coalesced"
+REPLAYED = "replayed"
+
+
+class IdempotencyConflict(Exception):
+    """Se ha reutilizado una Idempotency-Key con una petición distinta (422)."""
+
+    def __init__(self, detail: str):
+        super().__init__(detail)
+        self.status_code = 422
+        self.detail = detail
+
+
+def _digest(*parts) -> str:
+    return hashlib.sha256(json.dumps(parts, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class SingleFlight:
+    """
+    Deduplicación de peticiones idénticas a /generate-response.
+
+    Los reintentos por timeout del frontend y los dobles clics llegan como peticiones duplicadas. La primera
+    calcula la respuesta; las duplicadas que llegan mientras tanto esperan a ese mismo resultado y las que
+    llegan después, dentro de ttl_s, reciben el resultado guardado sin volver a ejecutar la conversación
+    (ni registrarla otra vez en el historial). Los errores no se guardan: un reintento tras un error vuelve
+    a calcular. Todas las operaciones se hacen en el bucle de eventos, por lo que no necesita locks.
+    """
+
+    def __init__(self, ttl_s: float = 120.0, max_entries: int = 1024):
+        """
+        Args:
+            ttl_s: Segundos durante los que se responde a los reintentos con el resultado terminado
+            max_entries: Resultados terminados que se guardan como máximo (se descartan los más antiguos)
+        """
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        self.in_flight: Dict[str, Tuple[str, asyncio.Future]] = {}
+        self.completed: "OrderedDict[str, Tuple[float, str, Any]]" = OrderedDict()
+        self.counters = {LEADER: 0, COALESCED: 0, REPLAYED: 0, "failed": 0, "conflicts": 0}
+
+    @staticmethod
+    def key(client_id: str, thread_id: Optional[str], message: str, idempotency_key: Optional[str] = None) -> str:
+        """
+        Clave de deduplicación: la Idempotency-Key del cliente si la envía; si no, el hilo y el mensaje.
+        Las conversaciones nuevas (sin thread_id) se distinguen por cliente.
+        """
+        if idempotency_key:
+            return "idempotency:" + _digest(client_id, idempotency_key)
+        return "message:" + _digest(thread_id or f"client:{client_id}", " ".join(message.split()))
+
+    @staticmethod
+    def fingerprint(*parts) -> str:
+        """Huella del cuerpo de la petición, para detectar una Idempotency-Key reutilizada con otra petición."""
+        return _digest(*parts)
+
+    def _expire(self, now: float) -> None:
+        while self.completed:
+            key, (expires, _, _) = next(iter(self.completed.items()))
+            if expires > now and len(self.completed) <= self.max_entries:
+                return
+            del self.completed[key]
+
+    def _check(self, key: str, stored_fingerprint: str, fingerprint: str) -> None:
+        # Solo una Idempotency-Key promete que la petición es la misma; un reintento por hilo y mensaje
+        # puede llevar otros presupuestos y recibe igualmente la respuesta compartida
+        if key.startswith("idempotency:") and stored_fingerprint != fingerprint:
+            self.counters["conflicts"] += 1
+            raise IdempotencyConflict("La Idempotency-Key ya se ha usado con una petición distinta")
+
+    async def run(self, key: str, fingerprint: str, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, str]:
+        """
+        Devuelve el resultado de fn() para la clave, ejecutándola solo si no hay una petición idéntica
+        en curso ni un resultado terminado vigente. Devuelve también cómo se ha obtenido (LEADER,
+        COALESCED o REPLAYED). Si la petición en curso de la que se espera el resultado se cancela
+        (p.ej. porque su cliente se desconecta), la que esperaba pasa a calcularlo ella misma.
+        """
+        self._expire(time.monotonic())
+        if key in self.completed:
+            _, stored_fingerprint, result = self.completed[key]
+            self._check(key, stored_fingerprint, fingerprint)
+            self.counters[REPLAYED] += 1
+            return result, REPLAYED
+        while key in self.in_flight:
+            stored_fingerprint, future = self.in_flight[key]
+            self._check(key, stored_fingerprint, fingerprint)
+            try:
+                # shield: si esta petición se cancela no se cancela la de la que depende
+                result = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                continue
+            self.counters[COALESCED] += 1
+            return result, COALESCED
+
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight[key] = (fingerprint, future)
+        self.counters[LEADER] += 1
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            self.counters["failed"] += 1
+            future.set_exception(e)
+            # Se marca como recuperada para que asyncio no avise si no había peticiones esperando
+            future.exception()
+            raise
+        finally:
+            del self.in_flight[key]
+        future.set_result(result)
+        self.completed[key] = (time.monotonic() + self.ttl_s, fingerprint, result)
+        return result, LEADER
+
+    def metrics(self) -> Dict:
+        self._expire(time.monotonic())
+        return {"in_flight": len(self.in_flight), "completed": len(self.completed), **self.counters}
@@ -0,0 +1,328 @@
+"""
+Recuperación léxica con los pesos dispersos de bge-m3 y fusión con la búsqueda densa.
+
+bge-m3 puntúa cada token de un texto con una capa lineal (sparse_linear.pt) sobre el último estado
+oculto: el peso de un término es relu(w · h). Los pesos de cada chunk se guardan en un índice invertido
+en SQLite (token -> chunks) y una consulta se puntúa como la suma de los productos de los pesos de los
+tokens que comparte con cada chunk, lo que recupera bien términos exactos como "AJD", "base liquidable"
+o "29/1987" que la búsqueda densa diluye. Si el modelo no incluye sparse_linear.pt se usan pesos
+1 + log(tf) por token del tokenizer e idf en la consulta.
+
+La búsqueda densa y la léxica se combinan con reciprocal rank fusion: score = Σ 1 / (k + rango).
+
+    build      Indexa los chunks de una colección ya ingestada
+    benchmark  Recall y latencia de la primera etapa densa frente a la híbrida
+
+Uso:
+    python -m src.sparse build --collection normativa_tributaria-RAG
+    python -m src.sparse benchmark --collection normativa_tributaria-RAG --limit 100
+"""
+import argparse
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Tuple
+
+import numpy as np
+import torch
+
+from src.profiling import traced
+
+
+class SparseEncoder:
+    """
+    Pesos léxicos de bge-m3 a partir del SentenceTransformer ya cargado.
+
+    Args:
+        model: SentenceTransformer de bge-m3
+        model_path: Directorio del modelo, donde se busca sparse_linear.pt
+        batch_size: Textos por pasada del modelo (los estados ocultos por token ocupan mucha memoria)
+    """
+
+    def __init__(self, model, model_path: str, batch_size: int = 16):
+        self.model = model
+        self.batch_size = batch_size
+        self.special_ids = set(model.tokenizer.all_special_ids)
+        self.linear = None
+        weights_path = os.path.join(model_path, "sparse_linear.pt")
+        if os.path.exists(weights_path):
+            state = torch.load(weights_path, map_location="cpu")
+            self.linear = torch.nn.Linear(state["weight"].shape[1], state["weight"].shape[0])
+            self.linear.load_state_dict(state)
+            self.linear.eval()
+        else:
+            print(f"Warning: {weights_path} not found; sparse retrieval uses log-tf token weights")
+
+    @property
+    def learned(self) -> bool:
+        """Si los pesos son los aprendidos por bge-m3 (si no, log-tf con idf en la consulta)."""
+        return self.linear is not None
+
+    def _weights(self, input_ids: torch.Tensor, token_embeddings: torch.Tensor, attention_mask: torch.Tensor) -> Dict[int, float]:
+        length = int(attention_mask.sum())
+        ids = input_ids[:length].tolist()
+        if self.linear is None:
+            counts = Counter(i for i in ids if i not in self.special_ids)
+            return {token: 1.0 + math.log(tf) for token, tf in counts.items()}
+        with torch.inference_mode():
+            scores = torch.relu(self.linear(token_embeddings[:length].float())).squeeze(-1).tolist()
+        weights: Dict[int, float] = {}
+        for token, score in zip(ids, scores):
+            if token not in self.special_ids and score > weights.get(token, 0.0):
+                weights[token] = score
+        return weights
+
+    def encode(self, texts: List[str], with_dense: bool = False) -> Tuple[List[Dict[int, float]], np.ndarray]:
+        """
+        Pesos dispersos de cada texto y, si se pide, su embedding denso, con una sola pasada del modelo.
+
+        Returns:
+            (pesos token -> peso de cada texto, embeddings densos o None)
+        """
+        sparse, dense = [], []
+        for start in range(0, len(texts), self.batch_size):
+            features = self.model.encode(texts[start:start + self.batch_size], output_value=None, batch_size=self.batch_size)
+            for row in features:
+                sparse.append(self._weights(row["input_ids"], row["token_embeddings"], row["attention_mask"]))
+                if with_dense:
+                    dense.append(row["sentence_embedding"].float().cpu().numpy())
+        return sparse, (np.stack(dense) if with_dense and dense else None)
+
+
+class SparseIndex:
+    """
+    Índice invertido token -> (chunk, peso) de una colección en SQLite.
+
+    Args:
+        collection_name: Colección a la que pertenecen los chunks
+        db_path: Base de datos SQLite del índice
+        min_weight: Peso mínimo de un término para guardarlo
+        max_query_tokens: Términos de la consulta con más peso que se usan en la búsqueda
+    """
+
+    def __init__(self, collection_name: str, db_path: str = "./data/sqlite/sparse_index.db",
+                 min_weight: float = 0.01, max_query_tokens: int = 24):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.collection = collection_name
+        self.min_weight = min_weight
+        self.max_query_tokens = max_query_tokens
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS sparse_chunks (
+                collection TEXT NOT NULL,
+                chunk_id TEXT NOT NULL,
+                document_id TEXT NOT NULL,
+                document_type TEXT NOT NULL,
+                PRIMARY KEY (collection, chunk_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS idx_sparse_chunks_document ON sparse_chunks (collection, document_id);
+            CREATE TABLE IF NOT EXISTS sparse_postings (
+                collection TEXT NOT NULL,
+                token_id INTEGER NOT NULL,
+                chunk_id TEXT NOT NULL,
+                weight REAL NOT NULL,
+                PRIMARY KEY (collection, token_id, chunk_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS idx_sparse_postings_chunk ON sparse_postings (collection, chunk_id);
+            ''')
+            self.conn.commit()
+
+    def count(self) -> int:
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM sparse_chunks WHERE collection = ?", (self.collection,)).fetchone()[0]
+
+    def add(self, ids: List[str], metadatas: List[Dict], weights: List[Dict[int, float]]) -> None:
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO sparse_chunks (collection, chunk_id, document_id, document_type) VALUES (?, ?, ?, ?)",
+                [(self.collection, id_, metadata.get("document_id", ""), metadata.get("document_type", ""))
+                 for id_, metadata in zip(ids, metadatas)]
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO sparse_postings (collection, token_id, chunk_id, weight) VALUES (?, ?, ?, ?)",
+                [(self.collection, token, id_, weight) for id_, chunk_weights in zip(ids, weights)
+                 for token, weight in chunk_weights.items() if weight >= self.min_weight]
+            )
+            self.conn.commit()
+
+    def remove_document(self, document_id: str) -> None:
+        with self.lock:
+            self.conn.execute(
+                "DELETE FROM sparse_postings WHERE collection = ? AND chunk_id IN "
+                "(SELECT chunk_id FROM sparse_chunks WHERE collection = ? AND document_id = ?)",
+                (self.collection, self.collection, document_id)
+            )
+            self.conn.execute("DELETE FROM sparse_chunks WHERE collection = ? AND document_id = ?", (self.collection, document_id))
+            self.conn.commit()
+
+    def clear(self) -> None:
+        with self.lock:
+            self.conn.execute("DELETE FROM sparse_postings WHERE collection = ?", (self.collection,))
+            self.conn.execute("DELETE FROM sparse_chunks WHERE collection = ?", (self.collection,))
+            self.conn.commit()
+
+    def close(self) -> None:
+        with self.lock:
+            self.conn.close()
+
+    def copy_to(self, collection_name: str) -> None:
+        """Copia el índice de la colección a otra (la versión nueva de una colección, ver src/collection_versions.py)."""
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO sparse_chunks (collection, chunk_id, document_id, document_type) "
+                "SELECT ?, chunk_id, document_id, document_type FROM sparse_chunks WHERE collection = ?",
+                (collection_name, self.collection)
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO sparse_postings (collection, token_id, chunk_id, weight) "
+                "SELECT ?, token_id, chunk_id, weight FROM sparse_postings WHERE collection = ?",
+                (collection_name, self.collection)
+            )
+            self.conn.commit()
+
+    def _idf(self, tokens: List[int]) -> Dict[int, float]:
+        total = self.conn.execute("SELECT COUNT(*) FROM sparse_chunks WHERE collection = ?", (self.collection,)).fetchone()[0]
+        idf = {}
+        for token in tokens:
+            df = self.conn.execute("SELECT COUNT(*) FROM sparse_postings WHERE collection = ? AND token_id = ?",
+                                   (self.collection, token)).fetchone()[0]
+            idf[token] = math.log(1 + (total - df + 0.5) / (df + 0.5))
+        return idf
+
+    @traced("sqlite:sparse_index")
+    def search(self, weights: Dict[int, float], n_results: int = 50, document_types: List[str] = None,
+               document_ids: List[str] = None, use_idf: bool = False) -> List[Tuple[str, float]]:
+        """
+        Chunks con mayor puntuación léxica para los pesos de una consulta.
+
+        Args:
+            weights: Pesos token -> peso de la consulta
+            n_results: Número de chunks que se devuelven
+            document_types: Valores de document_type permitidos
+            document_ids: IDs de documentos permitidos
+            use_idf: Multiplicar los pesos de la consulta por el idf (pesos log-tf sin sparse_linear.pt)
+
+        Returns:
+            Lista de (id del chunk, puntuación) de mayor a menor puntuación
+        """
+        query = sorted(weights.items(), key=lambda item: -item[1])[:self.max_query_tokens]
+        if not query:
+            return []
+        with self.lock:
+            if use_idf:
+                idf = self._idf([token for token, _ in query])
+                query = [(token, weight * idf[token]) for token, weight in query]
+            values = ",".join("(?, ?)" for _ in query)
+            params: List = [value for pair in query for value in pair] + [self.collection, self.collection]
+            filters = ""
+            for column, allowed in (("document_type", document_types), ("document_id", document_ids)):
+                if allowed:
+                    filters += f" AND c.{column} IN ({','.join('?' * len(allowed))})"
+                    params.extend(allowed)
+            params.append(n_results)
+            rows = self.conn.execute(
+                f"WITH q(token_id, weight) AS (VALUES {values}) "
+                f"SELECT p.chunk_id, SUM(p.weight * q.weight) AS score FROM q "
+                f"JOIN sparse_postings p ON p.collection = ? AND p.token_id = q.token_id "
+                f"JOIN sparse_chunks c ON c.collection = ? AND c.chunk_id = p.chunk_id{filters} "
+                f"GROUP BY p.chunk_id ORDER BY score DESC LIMIT ?",
+                params
+            ).fetchall()
+        return [(chunk_id, float(score)) for chunk_id, score in rows]
+
+
+def reciprocal_rank_fusion(rankings: List[List[str]], k: int = 60) -> List[str]:
+    """Fusiona varias listas ordenadas de ids: cada id suma 1 / (k + rango) en cada lista en la que aparece."""
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, id_ in enumerate(ranking, start=1):
+            scores[id_] = scores.get(id_, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=lambda id_: -scores[id_])
+
+
+def build(rag, page_size: int = 256) -> int:
+    """Indexa los pesos léxicos de todos los chunks de la colección."""
+    rag.sparse_index.clear()
+    offset = 0
+    while True:
+        page = rag.collection.get(include=["documents", "metadatas"], limit=page_size, offset=offset)
+        if not page["ids"]:
+            break
+        weights, _ = rag.sparse_encoder.encode(page["documents"])
+        rag.sparse_index.add(page["ids"], page["metadatas"], weights)
+        offset += len(page["ids"])
+        print(f"Sparse index: {offset} chunks")
+    return offset
+
+
+def benchmark(rag, questions: List[str], n_results: int, pool: int, k: int) -> None:
+    """
+    Recall de la primera etapa densa y de la híbrida frente a los k mejores según el reranker.
+
+    La referencia de cada pregunta son los k chunks con mayor puntuación del CrossEncoder dentro de la
+    unión de los pool candidatos densos y los pool léxicos.
+    """
+    stats = {"dense": {"seconds": 0.0, "recall": []}, "hybrid": {"seconds": 0.0, "recall": []}}
+    for question in questions:
+        start = time.perf_counter()
+        embeddings = rag.model.encode([question]).tolist()
+        dense = rag.collection.query(query_embeddings=embeddings, n_results=n_results, include=[])["ids"][0]
+        stats["dense"]["seconds"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        hybrid_embeddings, weights = rag._encode_queries(rag.stores, [question], hybrid=True)
+        hybrid = rag._search(rag.stores, hybrid_embeddings, n_results, None, query_sparse=weights)["ids"][0]
+        stats["hybrid"]["seconds"] += time.perf_counter() - start
+
+        lexical = [id_ for id_, _ in rag.sparse_index.search(weights[0], pool, use_idf=not rag.sparse_encoder.learned)]
+        dense_pool = rag.collection.query(query_embeddings=embeddings, n_results=pool, include=[])["ids"][0]
+        candidates = rag.get_chunks(list(dict.fromkeys(dense_pool + lexical)))
+        scores = rag.rerank_engine.score([(question, c["document"]) for c in candidates])
+        reference = {candidates[i]["id"] for i in np.argsort(-np.asarray(scores))[:k]}
+        for name, retrieved in (("dense", dense), ("hybrid", hybrid)):
+            stats[name]["recall"].append(len(reference & set(retrieved)) / len(reference) if reference else 1.0)
+
+    n = len(questions)
+    print(f"\n{'primera etapa':<14} {'ms/consulta':>12} {f'recall@{n_results} (top-{k} rerank)':>28}")
+    for name, label in (("dense", "densa"), ("hybrid", "híbrida")):
+        print(f"{label:<14} {stats[name]['seconds'] / n * 1000:>12.1f} {np.mean(stats[name]['recall']):>28.3f}")
+
+
+def main():
+    from src.RAG import VectorEmbeddings
+    from src.hnsw_sweep import load_questions
+    from src.inference_pool import SAMPLE_QUESTIONS
+
+    parser = argparse.ArgumentParser(description="Índice léxico con los pesos dispersos de bge-m3")
+    parser.add_argument("command", choices=["build", "benchmark"])
+    parser.add_argument("--collection", default="normativa_tributaria-RAG")
+    parser.add_argument("--backend", default="chroma", choices=["chroma", "memmap"])
+    parser.add_argument("--questions", default=None, help="Fichero con una pregunta por línea (por defecto, el historial)")
+    parser.add_argument("--limit", type=int, default=100, help="Preguntas del benchmark")
+    parser.add_argument("--n-results", type=int, nargs="+", default=[10, 20, 50], help="Candidatos de la primera etapa")
+    parser.add_argument("--pool", type=int, default=100, help="Candidatos densos y léxicos que se re-rankean para la referencia")
+    parser.add_argument("--k", type=int, default=5, help="Chunks de referencia por pregunta")
+    args = parser.parse_args()
+
+    rag = VectorEmbeddings(collection_name=args.collection, backend=args.backend)
+    if args.command == "build":
+        start = time.perf_counter()
+        count = build(rag)
+        print(f"Sparse index for {args.collection}: {count} chunks in {time.perf_counter() - start:.1f}s")
+        return
+    if rag.sparse_index.count() == 0:
+        parser.error(f"La colección {args.collection} no tiene índice léxico; lanza antes build")
+    questions = load_questions(args.questions, limit=args.limit) or SAMPLE_QUESTIONS
+    print(f"{len(questions)} preguntas, {rag.sparse_index.count()} chunks indexados "
+          f"({'pesos bge-m3' if rag.sparse_encoder.learned else 'pesos log-tf'})")
+    for n_results in args.n_results:
+        benchmark(rag, questions, n_results, args.pool, args.k)
+
+
+if __name__ == "__main__":
+    main()
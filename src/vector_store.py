@@ -0,0 +1,358 @@
+import json
+import os
+import threading
+from typing import List, Dict, Union, Optional
+
+import numpy as np
+
+
+class MemmapCollection:
+    """
+    Almacén vectorial compacto alternativo a Chroma para corpus pequeños.
+
+    Los vectores se guardan normalizados y cuantizados (float16 o int8 con escala por fila) en un fichero
+    binario que se abre con np.memmap, y la búsqueda es exacta mediante productos matriciales (BLAS).
+    Los metadatos se mantienen en columnas para poder filtrar de forma vectorizada con la misma sintaxis
+    `where` de Chroma ($eq, $ne, $in, $nin, $gt, $gte, $lt, $lte, $and, $or).
+
+    Expone el subconjunto de la interfaz de chromadb.Collection que utiliza VectorEmbeddings
+    (add, query, get, delete y count), de modo que puede sustituirla directamente.
+    """
+
+    DTYPES = ("float16", "int8")
+    BLOCK_SIZE = 8192
+
+    def __init__(self, path: str, name: str, dtype: str = "float16"):
+        if dtype not in self.DTYPES:
+            raise ValueError(f"Tipo de cuantización no soportado: {dtype}. Opciones: {self.DTYPES}")
+        self.name = name
+        self.dir = os.path.join(path, name)
+        os.makedirs(self.dir, exist_ok=True)
+        self._meta_path = os.path.join(self.dir, "meta.json")
+        self._vectors_path = os.path.join(self.dir, "vectors.bin")
+        self._scales_path = os.path.join(self.dir, "scales.bin")
+        self._records_path = os.path.join(self.dir, "records.jsonl")
+        self._pending_meta_path = os.path.join(self.dir, "meta.pending.json")
+        self._lock = threading.RLock()
+
+        self._finish_rewrite()
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path, "r", encoding="utf-8") as f:
+                self.meta = json.load(f)
+        else:
+            self.meta = {"dim": None, "dtype": dtype, "count": 0, "space": "cosine"}
+        self._load()
+
+    # ------------------------------------------------------------------
+    # Carga y persistencia
+    # ------------------------------------------------------------------
+    def _load(self):
+        """Abre los vectores en modo memmap y carga ids, documentos y metadatos en columnas."""
+        count = self.meta["count"]
+        self.ids: List[str] = []
+        self.documents: List[str] = []
+        self.columns: Dict[str, List] = {}
+        self._codes_cache: Dict[str, tuple] = {}
+
+        if count and os.path.exists(self._records_path):
+            with open(self._records_path, "r", encoding="utf-8") as f:
+                for i, line in enumerate(f):
+                    if i >= count:
+                        break
+                    record = json.loads(line)
+                    self._append_record(record["id"], record["document"], record["metadata"])
+
+        self._id_index = {id_: i for i, id_ in enumerate(self.ids)}
+        self._open_vectors()
+
+    def _open_vectors(self):
+        """(Re)abre los ficheros de vectores en modo memmap de solo lectura."""
+        count = self.meta["count"]
+        self.vectors = None
+        self.scales = None
+        if count:
+            dim = self.meta["dim"]
+            self.vectors = np.memmap(self._vectors_path, dtype=self.meta["dtype"], mode="r", shape=(count, dim))
+            if self.meta["dtype"] == "int8":
+                self.scales = np.memmap(self._scales_path, dtype=np.float32, mode="r", shape=(count,))
+
+    def _append_record(self, id_: str, document: str, metadata: Dict):
+        n = len(self.ids)
+        self.ids.append(id_)
+        self.documents.append(document)
+        metadata = metadata or {}
+        for key in metadata:
+            if key not in self.columns:
+                self.columns[key] = [None] * n
+        for key, values in self.columns.items():
+            values.append(metadata.get(key))
+
+    def _save_meta(self, meta: Dict = None, path: str = None):
+        path = path or self._meta_path
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(meta if meta is not None else self.meta, f)
+        os.replace(tmp_path, path)
+
+    def _finish_rewrite(self):
+        """
+        Completa una reescritura de delete interrumpida. Si llegó a escribirse el meta pendiente, los
+        ficheros temporales están completos y se ponen en su sitio; si no, se descartan y la colección
+        queda como antes de la reescritura.
+        """
+        pending = os.path.exists(self._pending_meta_path)
+        for path in (self._vectors_path, self._scales_path, self._records_path):
+            if os.path.exists(path + ".tmp"):
+                if pending:
+                    os.replace(path + ".tmp", path)
+                else:
+                    os.remove(path + ".tmp")
+        if pending:
+            os.replace(self._pending_meta_path, self._meta_path)
+
+    def _quantize(self, embeddings: np.ndarray):
+        """Normaliza los vectores y los cuantiza al tipo configurado."""
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        embeddings = embeddings / norms
+        if self.meta["dtype"] == "float16":
+            return embeddings.astype(np.float16), None
+        scales = np.abs(embeddings).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        quantized = np.round(embeddings / scales[:, None]).astype(np.int8)
+        return quantized, scales.astype(np.float32)
+
+    # ------------------------------------------------------------------
+    # Interfaz compatible con chromadb.Collection
+    # ------------------------------------------------------------------
+    def count(self) -> int:
+        return self.meta["count"]
+
+    def add(self, ids: List[str], embeddings: List[List[float]], documents: List[str] = None, metadatas: List[Dict] = None):
+        """Añade registros al final de los ficheros; solo se reescribe meta.json para confirmar la escritura."""
+        with self._lock:
+            duplicated = [id_ for id_ in ids if id_ in self._id_index]
+            if duplicated:
+                raise ValueError(f"IDs ya existentes en la colección {self.name}: {duplicated[:5]}")
+            embeddings = np.asarray(embeddings, dtype=np.float32)
+            if self.meta["dim"] is None:
+                self.meta["dim"] = int(embeddings.shape[1])
+            elif embeddings.shape[1] != self.meta["dim"]:
+                raise ValueError(f"Dimensión {embeddings.shape[1]} distinta de la de la colección ({self.meta['dim']})")
+            documents = documents or [""] * len(ids)
+            metadatas = metadatas or [{}] * len(ids)
+
+            quantized, scales = self._quantize(embeddings)
+            count = self.meta["count"]
+            self._truncate(count)
+            with open(self._vectors_path, "ab") as f:
+                f.write(quantized.tobytes())
+            if scales is not None:
+                with open(self._scales_path, "ab") as f:
+                    f.write(scales.tobytes())
+            with open(self._records_path, "ab") as f:
+                for id_, document, metadata in zip(ids, documents, metadatas):
+                    f.write((json.dumps({"id": id_, "document": document, "metadata": metadata}, ensure_ascii=False) + "\n").encode("utf-8"))
+                records_bytes = f.tell()
+
+            self.meta["count"] = count + len(ids)
+            self.meta["records_bytes"] = records_bytes
+            self._save_meta()
+            for id_, document, metadata in zip(ids, documents, metadatas):
+                self._id_index[id_] = len(self.ids)
+                self._append_record(id_, document, metadata)
+            self._codes_cache = {}
+            self._open_vectors()
+
+    def _truncate(self, count: int):
+        """Descarta restos de una escritura interrumpida posterior al último meta.json confirmado."""
+        dim = self.meta["dim"]
+        itemsize = np.dtype(self.meta["dtype"]).itemsize
+        if os.path.exists(self._vectors_path):
+            with open(self._vectors_path, "r+b") as f:
+                f.truncate(count * dim * itemsize)
+        if os.path.exists(self._scales_path):
+            with open(self._scales_path, "r+b") as f:
+                f.truncate(count * 4)
+        if os.path.exists(self._records_path):
+            with open(self._records_path, "r+b") as f:
+                f.truncate(self.meta.get("records_bytes", 0))
+
+    def delete(self, ids: List[str] = None, where: Dict = None):
+        """
+        Elimina registros reescribiendo la colección (operación poco frecuente). Las filas que se conservan
+        se copian, sin volver a cuantizarlas, a ficheros temporales que sustituyen a los actuales solo
+        cuando están completos, de modo que una interrupción nunca deja la colección a medias.
+        """
+        with self._lock:
+            mask = self._where_mask(where) if where else np.zeros(self.count(), dtype=bool)
+            if ids:
+                for id_ in ids:
+                    if id_ in self._id_index:
+                        mask[self._id_index[id_]] = True
+            keep = np.flatnonzero(~mask)
+            if len(keep) == self.count():
+                return
+
+            meta = dict(self.meta, count=int(len(keep)))
+            with open(self._vectors_path + ".tmp", "wb") as f:
+                if len(keep):
+                    f.write(np.asarray(self.vectors[keep]).tobytes())
+            if self.scales is not None:
+                with open(self._scales_path + ".tmp", "wb") as f:
+                    if len(keep):
+                        f.write(np.asarray(self.scales[keep]).tobytes())
+            with open(self._records_path + ".tmp", "wb") as f:
+                for i in keep:
+                    record = {"id": self.ids[i], "document": self.documents[i], "metadata": self._metadata(i)}
+                    f.write((json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8"))
+                meta["records_bytes"] = f.tell()
+            # El meta pendiente confirma que los temporales están completos (ver _finish_rewrite)
+            self._save_meta(meta, self._pending_meta_path)
+            self._finish_rewrite()
+            self.meta = meta
+            self._load()
+
+    def get(self, ids: List[str] = None, where: Dict = None, include: List[str] = None, limit: int = None, offset: int = None) -> Dict:
+        include = include if include is not None else ["documents", "metadatas"]
+        # Con el lock para no leer la colección mientras add o delete la están modificando
+        with self._lock:
+            mask = self._where_mask(where)
+            if ids is not None:
+                id_mask = np.zeros(self.count(), dtype=bool)
+                for id_ in ids:
+                    if id_ in self._id_index:
+                        id_mask[self._id_index[id_]] = True
+                mask &= id_mask
+            rows = np.flatnonzero(mask)
+            if offset:
+                rows = rows[offset:]
+            if limit is not None:
+                rows = rows[:limit]
+            return self._rows_to_result(rows, include)
+
+    def query(self, query_embeddings: List[List[float]], n_results: int = 10, where: Dict = None, include: List[str] = None) -> Dict:
+        """Búsqueda exacta por similitud coseno sobre las filas que cumplen el filtro."""
+        include = include if include is not None else ["documents", "metadatas", "distances"]
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        if queries.ndim == 1:
+            queries = queries[None, :]
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+
+        with self._lock:
+            result = {key: [] for key in ["ids", "documents", "metadatas", "distances", "embeddings"]}
+            candidates = np.flatnonzero(self._where_mask(where)) if where else None
+            if self.count() == 0 or (candidates is not None and len(candidates) == 0):
+                for _ in range(len(queries)):
+                    for key in result:
+                        result[key].append([])
+                return self._filter_include(result, include)
+
+            similarities = self._similarities(queries, candidates)
+            k = min(n_results, similarities.shape[1])
+            for q in range(len(queries)):
+                sims = similarities[q]
+                top = np.argpartition(-sims, k - 1)[:k] if k < len(sims) else np.arange(len(sims))
+                top = top[np.argsort(-sims[top])]
+                rows = candidates[top] if candidates is not None else top
+                row_result = self._rows_to_result(rows, include)
+                for key in ["ids", "documents", "metadatas", "embeddings"]:
+                    result[key].append(row_result.get(key))
+                result["distances"].append((1.0 - sims[top]).tolist())
+            return self._filter_include(result, include)
+
+    # ------------------------------------------------------------------
+    # Búsqueda
+    # ------------------------------------------------------------------
+    def _similarities(self, queries: np.ndarray, rows: Optional[np.ndarray]) -> np.ndarray:
+        """Calcula la similitud coseno por bloques para no descuantizar toda la matriz a la vez."""
+        total = self.count() if rows is None else len(rows)
+        similarities = np.empty((len(queries), total), dtype=np.float32)
+        for start in range(0, total, self.BLOCK_SIZE):
+            end = min(start + self.BLOCK_SIZE, total)
+            block_rows = np.arange(start, end) if rows is None else rows[start:end]
+            similarities[:, start:end] = queries @ self._dequantize(block_rows).T
+        return similarities
+
+    def _dequantize(self, rows: np.ndarray) -> np.ndarray:
+        if isinstance(rows, np.ndarray) and len(rows) and np.all(np.diff(rows) == 1):
+            # Rango contiguo y creciente: se lee directamente del memmap sin indexación avanzada
+            # (las filas de query llegan en orden de similitud, así que no basta con comparar los extremos)
+            block = np.asarray(self.vectors[rows[0]:rows[-1] + 1], dtype=np.float32)
+            scales = self.scales[rows[0]:rows[-1] + 1] if self.scales is not None else None
+        else:
+            block = np.asarray(self.vectors[rows], dtype=np.float32)
+            scales = self.scales[rows] if self.scales is not None else None
+        if scales is not None:
+            block *= np.asarray(scales, dtype=np.float32)[:, None]
+        return block
+
+    def _metadata(self, row: int) -> Dict:
+        return {key: values[row] for key, values in self.columns.items() if values[row] is not None}
+
+    def _rows_to_result(self, rows: np.ndarray, include: List[str]) -> Dict:
+        result = {"ids": [self.ids[i] for i in rows]}
+        if "documents" in include:
+            result["documents"] = [self.documents[i] for i in rows]
+        if "metadatas" in include:
+            result["metadatas"] = [self._metadata(i) for i in rows]
+        if "embeddings" in include:
+            result["embeddings"] = self._dequantize(np.asarray(rows)).tolist() if len(rows) else []
+        return result
+
+    @staticmethod
+    def _filter_include(result: Dict, include: List[str]) -> Dict:
+        return {key: value for key, value in result.items() if key == "ids" or key in include}
+
+    # ------------------------------------------------------------------
+    # Filtros `where` vectorizados
+    # ------------------------------------------------------------------
+    def _column_codes(self, key: str):
+        """Codifica una columna como enteros (diccionario de valores) para compararla con NumPy."""
+        if key not in self._codes_cache:
+            values = self.columns.get(key, [None] * self.count())
+            vocabulary: Dict = {}
+            codes = np.fromiter((vocabulary.setdefault(v, len(vocabulary)) for v in values), dtype=np.int32, count=len(values))
+            self._codes_cache[key] = (codes, vocabulary)
+        return self._codes_cache[key]
+
+    def _where_mask(self, where: Union[Dict, None]) -> np.ndarray:
+        if not where:
+            return np.ones(self.count(), dtype=bool)
+        if "$and" in where:
+            mask = np.ones(self.count(), dtype=bool)
+            for condition in where["$and"]:
+                mask &= self._where_mask(condition)
+            return mask
+        if "$or" in where:
+            mask = np.zeros(self.count(), dtype=bool)
+            for condition in where["$or"]:
+                mask |= self._where_mask(condition)
+            return mask
+
+        mask = np.ones(self.count(), dtype=bool)
+        for key, condition in where.items():
+            if not isinstance(condition, dict):
+                condition = {"$eq": condition}
+            for operator, value in condition.items():
+                mask &= self._condition_mask(key, operator, value)
+        return mask
+
+    def _condition_mask(self, key: str, operator: str, value) -> np.ndarray:
+        codes, vocabulary = self._column_codes(key)
+        if operator in ("$eq", "$ne", "$in", "$nin"):
+            wanted = value if operator in ("$in", "$nin") else [value]
+            wanted_codes = [vocabulary[v] for v in wanted if v in vocabulary]
+            mask = np.isin(codes, wanted_codes)
+            return ~mask if operator in ("$ne", "$nin") else mask
+        if operator in ("$gt", "$gte", "$lt", "$lte"):
+            # Comparación sobre el vocabulario (pocos valores distintos) y proyección a las filas
+            compare = {
+                "$gt": lambda v: v > value,
+                "$gte": lambda v: v >= value,
+                "$lt": lambda v: v < value,
+                "$lte": lambda v: v <= value,
+            }[operator]
+            matching = [code for v, code in vocabulary.items() if isinstance(v, (int, float)) and compare(v)]
+            return np.isin(codes, matching)
+        raise ValueError(f"Operador no soportado en el filtro: {operator}")
@@ -0,0 +1,107 @@
+"""Pruebas de ResilientInvoker con modelos falsos con retrasos y fallos inyectados."""
+import threading
+import time
+
+import pytest
+
+from src.resilience import InvocationTimeout, ResilientInvoker
+
+
+class ScriptedModel:
+    """Modelo falso: cada llamada espera el siguiente retraso del guion (el último se repite) y devuelve su nombre."""
+
+    def __init__(self, name: str, delays=(0.0,), fail: bool = False):
+        self.name = name
+        self.delays = list(delays)
+        self.fail = fail
+        self.lock = threading.Lock()
+        self.calls = 0
+
+    def invoke(self, messages):
+        with self.lock:
+            delay = self.delays[min(self.calls, len(self.delays) - 1)]
+            self.calls += 1
+        time.sleep(delay)
+        if self.fail:
+            raise RuntimeError(f"Fallo inyectado en {self.name}")
+        return self.name
+
+
+def make_invoker(lite, flash, **kwargs) -> ResilientInvoker:
+    options = {"deadlines_s": {"nodo": 0.5}, "backoff_base_s": 0.0, "hedge_min_samples": 5}
+    options.update(kwargs)
+    return ResilientInvoker({"lite": lite, "flash": flash}, fallbacks={"lite": "flash"}, **options)
+
+
+def test_hedged_request_wins_over_slow_primary():
+    # Cinco llamadas rápidas fijan el retraso de duplicación; la sexta se cuelga y la duplicada responde
+    lite = ScriptedModel("lite", delays=[0.01] * 5 + [2.0, 0.01])
+    invoker = make_invoker(lite, ScriptedModel("flash"), deadlines_s={"nodo": 1.0})
+    for _ in range(5):
+        assert invoker.invoke("lite", [], node="nodo") == "lite"
+
+    response, info = invoker.invoke_with_info("lite", [], node="nodo")
+
+    assert response == "lite"
+    assert info["duplicada"] and not info["respaldo"]
+    summary = invoker.summary()
+    assert summary["hedges"] == 1
+    assert summary["hedge_wins"] == 1
+    assert summary["timeouts"] == 0
+    assert summary["fallbacks"] == 0
+
+
+def test_timeout_falls_back_within_deadline():
+    invoker = make_invoker(ScriptedModel("lite", delays=[2.0]), ScriptedModel("flash", delays=[0.01]))
+
+    start = time.monotonic()
+    response, info = invoker.invoke_with_info("lite", [], node="nodo")
+
+    assert time.monotonic() - start < 0.5
+    assert response == "flash"
+    assert info["respaldo"]
+    summary = invoker.summary()
+    assert summary["timeouts"] == 1
+    assert summary["fallbacks"] == 1
+    assert summary["hedges"] == 0
+
+
+def test_errors_are_retried_then_fall_back():
+    invoker = make_invoker(ScriptedModel("lite", fail=True), ScriptedModel("flash"), max_retries=2)
+
+    response, info = invoker.invoke_with_info("lite", [], node="nodo")
+
+    assert response == "flash"
+    assert info["intentos"] == 4
+    summary = invoker.summary()
+    assert summary["errors"] == 3
+    assert summary["retries"] == 2
+    assert summary["fallbacks"] == 1
+
+
+def test_saturated_tier_skips_to_fallback():
+    lite = ScriptedModel("lite", delays=[1.0])
+    invoker = make_invoker(lite, ScriptedModel("flash"), max_in_flight_per_tier=1)
+    # La primera llamada vence su plazo y queda en curso en segundo plano ocupando el único hueco de lite
+    assert invoker.invoke("lite", [], node="nodo") == "flash"
+
+    assert invoker.invoke("lite", [], node="nodo") == "flash"
+
+    assert lite.calls == 1
+    summary = invoker.summary()
+    assert summary["saturated"] == 1
+    assert summary["in_flight"]["lite"] == 1
+
+
+def test_timeout_without_fallback_raises():
+    invoker = ResilientInvoker({"lite": ScriptedModel("lite", delays=[1.0])}, fallbacks={},
+                               deadlines_s={"nodo": 0.1})
+
+    with pytest.raises(InvocationTimeout):
+        invoker.invoke("lite", [], node="nodo")
+    assert invoker.summary()["timeouts"] == 1
+
+
+def test_request_timeout_covers_longest_deadline():
+    assert ResilientInvoker.request_timeout_s() == max(ResilientInvoker.DEFAULT_DEADLINES_S.values())
+    assert ResilientInvoker.request_timeout_s({"nodo": 5.0}, default_deadline_s=10.0) == 10.0